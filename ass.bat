@@ -271,9 +271,9 @@ set /A FILECOUNT+=1
 findstr /r /c:"^[	 ]*let " "%SRCFILE%" >nul 2>&1 && (
   echo exprass: compiling %SRCFILE%
   if "%VERBOSE%"=="1" (
-    echo exprass.py -c "%SRCFILE%"
+    echo exprass -c "%SRCFILE%"
   )
-  exprass.py -c "%SRCFILE%"
+  call exprass -c "%SRCFILE%"
   if ERRORLEVEL 1 (
     echo ERROR: exprass failed for %SRCFILE%
     exit /B 1
@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+"""
+ass - assemble ca65 sources into PRG files
+
+Python version of ass.sh with the same options. exprass runs in-process on
+all sources containing let statements, and the cl65 runs of separately
+assembled files run in parallel (-j), with their output kept in file order.
+Builds whose inputs are unchanged are restored from a local build cache
+without running cl65.
+
+Usage: ass [options] file1.s [file2.s ...] [startaddr]
+
+Author: Wil Elmenreich
+"""
+
+__version__ = "0.37"
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+from pathlib import Path
+
+# Target name and library for each target option
+TARGET_OPTIONS = {
+    '-64': 'c64', '-c64': 'c64',
+    '-128': 'c128', '-c128': 'c128',
+    '-20': 'vic20', '-vc20': 'vic20', '-vic20': 'vic20',
+}
+LIBRARIES = {'c64': 'LAMAlib.lib', 'c128': 'LAMAlib128.lib', 'vic20': 'LAMAlib20.lib'}
+
+# Sources with a let statement (leading spaces or tabs + let) are run through exprass
+LET_PATTERN = re.compile(r'^[\t ]*let ', re.MULTILINE)
+
+USAGE = """\
+Usage: ass [options] file1.s [file2.s ...] [startaddr]
+
+Assemble ca65 sources into PRG files for C64/C128/VIC-20
+Automatically runs exprass on sources containing "let" statements
+
+Options:
+  -l              Link multiple files together (default: assemble separately)
+  -o <file>       Output filename (only valid with single file or -l mode)
+  -v              Verbose mode
+  -d <symbol> [value]  Define assembler symbol, optionally with value
+                       Examples: -d DEBUG  or  -d LEVEL 5  or  -d RAZY=1
+  -C <cfg>        Use alternate linker config (default: {target}-basicfriendly-asm.cfg)
+  -j <n>          Run up to n cl65 jobs in parallel, 0 for one per CPU (default: 0)
+  --no-cache      Always run cl65, don't use the build cache
+  --cache-stats   Show size and hit rate of the build cache and exit
+  -64, -c64       Target C64 (default)
+  -128, -c128     Target C128
+  -20, -vic20     Target VIC-20
+  -h, -?          Show this help
+
+Start address (optional last argument):
+  Must be hex ($xxxx or 0xXXXX) or decimal digits
+  Omit for automatic BASIC stub
+
+Examples:
+  ass main.s                        Assemble single file to main.prg
+  ass -l main.s util.s              Link two files into main.prg
+  ass -l -o game.prg main.s util.s  Link into game.prg
+  ass *.s                           Assemble all .s files separately
+  ass -j 4 *.s                      Assemble with up to 4 cl65 jobs at a time
+  ass -d DEBUG main.s               Define DEBUG symbol
+  ass -d LEVEL 5 main.s             Define LEVEL=5
+  ass -d RAZY=1 main.s              Define RAZY=1 (= gets split, then recombined)
+  ass main.s $c000                  Assemble to address $c000
+  ass --cache-stats                 Show build cache statistics
+
+The build cache is kept in ASS_CACHE_DIR if set, otherwise in the per-user
+cache directory
+"""
+
+class Options:
+    """Settings from the command line, with the defaults of ass.sh"""
+
+    def __init__(self):
+        self.target = 'c64'
+        self.asm_defines = []  # --asm-define arguments
+        self.verbose = False
+        self.link = False
+        self.output = None
+        self.config = None
+        self.jobs = 0
+        self.use_cache = True
+        self.start_address = None
+        self.sources = []
+
+def show_usage():
+    print(USAGE, end="")
+    sys.exit(1)
+
+def fail(message):
+    print(f"ERROR: {message}")
+    sys.exit(1)
+
+def is_number(value):
+    """True for a hex ($xxxx, 0xXXXX) or decimal number"""
+    if not value:
+        return False
+    return value.startswith('$') or value[:2].lower() == '0x' or value.isdigit()
+
+def parse_args(argv):
+    """Parse the command line like ass.sh: options first, then files and start address"""
+    if not argv:
+        show_usage()
+    if argv == ['--cache-stats']:
+        show_cache_stats()
+        sys.exit(0)
+    options = Options()
+    args = list(argv)
+
+    while args:
+        arg = args[0]
+        if arg in ('-h', '-?'):
+            show_usage()
+        elif arg == '-v':
+            options.verbose = True
+            args.pop(0)
+        elif arg == '-l':
+            options.link = True
+            args.pop(0)
+        elif arg == '-o':
+            if len(args) < 2:
+                fail("-o requires output filename")
+            options.output = args[1]
+            del args[:2]
+        elif arg == '-d':
+            if len(args) < 2:
+                fail("-d requires symbol definition")
+            if len(args) > 2 and is_number(args[2]):
+                options.asm_defines.append(f"{args[1]}={args[2]}")
+                del args[:3]
+            else:
+                options.asm_defines.append(args[1])
+                del args[:2]
+        elif arg in TARGET_OPTIONS:
+            options.target = TARGET_OPTIONS[arg]
+            args.pop(0)
+        elif arg == '-C':
+            if len(args) < 2:
+                fail("-C requires a config filename")
+            options.config = args[1]
+            del args[:2]
+        elif arg == '-j':
+            if len(args) < 2 or not args[1].isdigit():
+                fail("-j requires a number of jobs")
+            options.jobs = int(args[1])
+            del args[:2]
+        elif arg == '--no-cache':
+            options.use_cache = False
+            args.pop(0)
+        elif arg.startswith('-'):
+            print(f"ERROR: Unknown option: {arg}")
+            print()
+            show_usage()
+        else:
+            break
+
+    # Collect files and optional start address
+    for arg in args:
+        if '.' not in arg and is_number(arg):
+            options.start_address = arg
+        elif any(char in arg for char in '*?['):
+            # Expand wildcards, needed where the shell doesn't
+            import glob
+            options.sources.extend(sorted(glob.glob(arg)) or [arg])
+        else:
+            options.sources.append(arg)
+
+    if not options.sources:
+        fail("no source files given")
+    if options.output and len(options.sources) > 1 and not options.link:
+        fail("-o can only be used with a single file or with -l (link mode)")
+    if not options.config:
+        options.config = f"{options.target}-basicfriendly-asm.cfg"
+    return options
+
+def read_text(path):
+    """Contents of a source file, empty if it cannot be read"""
+    try:
+        with open(path, 'r', errors='replace') as f:
+            return f.read()
+    except OSError:
+        return ""
+
+def run_exprass(sources, verbose):
+    """
+    Compile the sources containing let statements with exprass in this
+    process, including their includes. Returns the files to assemble.
+    """
+    let_sources = [source for source in sources if LET_PATTERN.search(read_text(source))]
+    if not let_sources:
+        return list(sources)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import exprass
+    for source in let_sources:
+        print(f"exprass: compiling {source}")
+    if verbose:
+        print("exprass -c " + " ".join(f'"{source}"' for source in let_sources))
+
+    args = exprass.build_arg_parser().parse_args(['-c'] + let_sources)
+    failed_files, _ = exprass.compile_inputs(args)
+    sys.stdout.flush()
+    if failed_files:
+        fail(f"exprass failed for {' '.join(failed_files)}")
+
+    compiled = set(let_sources)
+    return [os.path.splitext(source)[0] + '.asm' if source in compiled else source
+            for source in sources]
+
+def cl65_command(options, files, output, labels, has_makesys):
+    """The cl65 command line to assemble and link files into output"""
+    command = ['cl65', '-t', options.target]
+    for define in options.asm_defines:
+        command += ['--asm-define', define]
+    command += ['-g'] + files
+    command += ['-lib', LIBRARIES[options.target], '-C', options.config, '-Ln', labels]
+    if options.start_address:
+        command += ['--start-addr', options.start_address]
+    elif not has_makesys:
+        # Add the BASIC stub unless the code provides one
+        command += ['-u', '__EXEHDR__']
+    return command + ['-o', output]
+
+# Size limit of the build cache contents in bytes
+BUILD_CACHE_LIMIT = 64 * 1024 * 1024
+
+# Files that go into the assembled program: .include and .incbin directives
+DEPENDENCY_PATTERN = re.compile(r'^[\t ]*\.(?:include|incbin)\s+["\']([^"\']+)["\']',
+                                re.IGNORECASE | re.MULTILINE)
+
+def get_cache_dir():
+    """
+    Return the directory of the build cache.
+
+    ASS_CACHE_DIR overrides the default, which is the per-user cache
+    directory (LOCALAPPDATA on Windows, XDG_CACHE_HOME or ~/.cache elsewhere).
+    """
+    override = os.environ.get('ASS_CACHE_DIR')
+    if override:
+        return Path(override)
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME')
+    if base:
+        return Path(base) / 'ass'
+    return Path.home() / '.cache' / 'ass'
+
+def cc65_dirs(variable, subdir):
+    """Directories where cc65 looks for asminc, cfg or lib files"""
+    dirs = []
+    if os.environ.get(variable):
+        dirs.append(Path(os.environ[variable]))
+    if os.environ.get('CC65_HOME'):
+        dirs.append(Path(os.environ['CC65_HOME']) / subdir)
+    cl65 = shutil.which('cl65')
+    if cl65:
+        # Installed as /usr/bin/cl65 with /usr/share/cc65, or as cc65/bin/cl65
+        root = Path(cl65).resolve().parent.parent
+        dirs += [root / 'share' / 'cc65' / subdir, root / subdir]
+    return dirs
+
+def find_cc65_file(name, directories):
+    """Locate a file given directly or in one of the directories, None if not found"""
+    for directory in [Path('.')] + directories:
+        candidate = directory / name
+        if candidate.is_file():
+            return candidate
+    return None
+
+class BuildCache:
+    """
+    Local cache of assembled programs.
+
+    The key is a hash of everything the build depends on: the cl65 command
+    line without output names, the cl65 executable, the linker config, the
+    library and the contents of the assembled files with all files they
+    include. An entry is a directory named after the key, holding the PRG
+    file and the label file. Entries are used in LRU order by the
+    modification time of their directory, and the least recently used ones
+    beyond the size limit are evicted when the cache is closed. Hit and miss
+    counts are kept in stats.json for --cache-stats.
+    """
+
+    def __init__(self, path, limit=BUILD_CACHE_LIMIT):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.limit = limit
+        self.hits = 0
+        self.misses = 0
+        self.digests = {}  # File path -> content hash, each file is read once per run
+        self.asminc_dirs = cc65_dirs('CA65_INC', 'asminc')
+
+    def file_digest(self, path):
+        """Hash of the file contents, None if it cannot be read"""
+        key = os.path.abspath(path)
+        if key not in self.digests:
+            try:
+                with open(path, 'rb') as f:
+                    self.digests[key] = hashlib.sha1(f.read()).hexdigest()
+            except OSError:
+                self.digests[key] = None
+        return self.digests[key]
+
+    def dependencies(self, asm_file):
+        """Hashes of the source and all files it includes, transitively"""
+        found = {}
+        pending = [Path(asm_file)]
+        while pending:
+            path = pending.pop()
+            key = os.path.abspath(path)
+            if key in found:
+                continue
+            found[key] = self.file_digest(path)
+            if path.suffix.lower() in ('.bin', '.prg'):
+                continue
+            for name in DEPENDENCY_PATTERN.findall(read_text(path)):
+                # ca65 searches the directory of the source, then the include paths
+                include = find_cc65_file(name, [path.parent] + self.asminc_dirs)
+                if include is None:
+                    found[name] = None
+                else:
+                    pending.append(include)
+        return sorted(found.items())
+
+    def make_key(self, options, command, files):
+        """Cache key of a cl65 command assembling files"""
+        cl65 = shutil.which('cl65')
+        if cl65 is None:
+            return None
+        stat = os.stat(cl65)
+        # Output names don't change the program, so the entry is reusable for other names
+        inputs = [arg for i, arg in enumerate(command)
+                  if arg not in ('-o', '-Ln') and command[i - 1] not in ('-o', '-Ln')]
+        config = find_cc65_file(options.config, cc65_dirs('LD65_CFG', 'cfg'))
+        library = find_cc65_file(LIBRARIES[options.target], cc65_dirs('LD65_LIB', 'lib'))
+        key = [__version__, stat.st_size, stat.st_mtime_ns, inputs,
+               config and self.file_digest(config), library and self.file_digest(library),
+               [self.dependencies(asm_file) for asm_file in files]]
+        return hashlib.sha1(json.dumps(key).encode()).hexdigest()
+
+    def restore(self, key, output, labels):
+        """Copy the cached program and labels to output and labels, False on a miss"""
+        entry = self.path / key
+        try:
+            shutil.copyfile(entry / 'prg', output)
+            if (entry / 'labels').exists():
+                shutil.copyfile(entry / 'labels', labels)
+            os.utime(entry)
+        except OSError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def store(self, key, output, labels):
+        """Add the program and labels cl65 just built"""
+        if not os.path.exists(output):
+            return
+        tmp_entry = self.path / f"{key}.{os.getpid()}.tmp"
+        try:
+            tmp_entry.mkdir()
+            shutil.copyfile(output, tmp_entry / 'prg')
+            if os.path.exists(labels):
+                shutil.copyfile(labels, tmp_entry / 'labels')
+            # Renaming makes the entry appear complete, or not at all
+            os.replace(tmp_entry, self.path / key)
+        except OSError:
+            # The cache is only an accelerator, losing entries is harmless
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+    def entries(self):
+        """List of (last use, size, path) of all entries"""
+        result = []
+        for entry in self.path.iterdir():
+            if entry.is_dir() and not entry.name.endswith('.tmp'):
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                result.append((entry.stat().st_mtime, size, entry))
+        return result
+
+    def close(self):
+        """Add the hit and miss counts to the statistics and evict old entries"""
+        try:
+            stats = read_cache_stats(self.path)
+            stats['hits'] += self.hits
+            stats['misses'] += self.misses
+            tmp_file = self.path / f"stats.{os.getpid()}.tmp"
+            tmp_file.write_text(json.dumps(stats))
+            os.replace(tmp_file, self.path / 'stats.json')
+
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            if total > self.limit:
+                # Evict down to 90% of the limit, so that not every run has to evict
+                for _, size, entry in entries:
+                    if total <= self.limit * 0.9:
+                        break
+                    shutil.rmtree(entry, ignore_errors=True)
+                    total -= size
+        except OSError:
+            pass
+
+def read_cache_stats(path):
+    """Accumulated hit and miss counts of the build cache in path"""
+    try:
+        stats = json.loads((Path(path) / 'stats.json').read_text())
+        return {'hits': int(stats['hits']), 'misses': int(stats['misses'])}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {'hits': 0, 'misses': 0}
+
+def open_build_cache(options):
+    """Return the build cache, or None if it is disabled or cannot be opened"""
+    if not options.use_cache:
+        return None
+    try:
+        return BuildCache(get_cache_dir())
+    except OSError:
+        return None
+
+def show_cache_stats():
+    """Print location, size and hit rate of the build cache"""
+    cache_dir = get_cache_dir()
+    print(f"Build cache: {cache_dir}")
+    if not cache_dir.is_dir():
+        print("  Empty")
+        return
+    cache = BuildCache(cache_dir)
+    entries = cache.entries()
+    size = sum(size for _, size, _ in entries)
+    stats = read_cache_stats(cache_dir)
+    lookups = stats['hits'] + stats['misses']
+    print(f"  Entries: {len(entries)} ({size / 1024 / 1024:.1f} of "
+          f"{cache.limit / 1024 / 1024:.1f} MB)")
+    if lookups:
+        print(f"  Hits: {stats['hits']}, misses: {stats['misses']} "
+              f"(hit rate {100 * stats['hits'] / lookups:.1f}%)")
+    else:
+        print("  Hits: 0, misses: 0")
+
+def show_command(command):
+    """Printable form of a command line"""
+    import subprocess
+    return subprocess.list2cmdline(command)
+
+def run_cl65(command):
+    """Run cl65, returns (return code, its stdout and stderr output)"""
+    import subprocess
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, errors='replace')
+    except FileNotFoundError:
+        return 127, "ERROR: cl65 not found, cc65 needs to be installed and in your path\n"
+    return result.returncode, result.stdout
+
+def assemble_separately(options, files, cache=None):
+    """Assemble each file into its own PRG, running up to options.jobs cl65 at a time"""
+    print(f"Assembling files separately for target {options.target}...")
+    jobs = []
+    for asm_file in files:
+        base = os.path.splitext(asm_file)[0]
+        output = options.output or base + '.prg'
+        labels = f"{base}_labels.txt"
+        command = cl65_command(options, [asm_file], output, labels,
+                               'makesys' in read_text(asm_file))
+        key = cache and cache.make_key(options, command, [asm_file])
+        jobs.append((asm_file, output, labels, command, key))
+
+    from concurrent.futures import ThreadPoolExecutor
+    workers = options.jobs or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+        # Cache hits are restored right away, only the misses run cl65
+        futures = [None if key and cache.restore(key, output, labels)
+                   else pool.submit(run_cl65, command)
+                   for _, output, labels, command, key in jobs]
+        # Report in file order, stop at the first failure like ass.sh
+        for (asm_file, output, labels, command, key), future in zip(jobs, futures):
+            if options.verbose:
+                print(f"Assembling {asm_file} to {output}..." + (" (cached)" if future is None else ""))
+                print(show_command(command))
+            if future is None:
+                continue
+            returncode, text = future.result()
+            print(text, end="")
+            sys.stdout.flush()
+            if returncode != 0:
+                for pending in futures:
+                    if pending is not None:
+                        pending.cancel()
+                return 1
+            if key:
+                cache.store(key, output, labels)
+    print("done.")
+    return 0
+
+def assemble_linked(options, files, main_file, cache=None):
+    """Assemble and link all files into one PRG"""
+    output = options.output or main_file + '.prg'
+    if options.start_address:
+        print(f"Assembling and linking {' '.join(files)} to start address "
+              f"{options.start_address} for target {options.target}...")
+    else:
+        print(f"Assembling and linking {' '.join(files)} for target {options.target}...")
+    has_makesys = any('makesys' in read_text(asm_file) for asm_file in files)
+    command = cl65_command(options, files, output, "labels.txt", has_makesys)
+    key = cache and cache.make_key(options, command, files)
+    if options.verbose:
+        print(show_command(command) + (" (cached)" if key and (cache.path / key).is_dir() else ""))
+    sys.stdout.flush()
+    if not (key and cache.restore(key, output, "labels.txt")):
+        returncode, text = run_cl65(command)
+        print(text, end="")
+        if returncode != 0:
+            return 1
+        if key:
+            cache.store(key, output, "labels.txt")
+    print("done.")
+    return 0
+
+def main():
+    options = parse_args(sys.argv[1:])
+    # First source file defines the default output name in link mode
+    main_file = os.path.splitext(options.sources[0])[0]
+    files = run_exprass(options.sources, options.verbose)
+    cache = open_build_cache(options)
+    if options.link:
+        result = assemble_linked(options, files, main_file, cache)
+    else:
+        result = assemble_separately(options, files, cache)
+    if cache:
+        if options.verbose:
+            print(f"Build cache: {cache.hits} hit(s), {cache.misses} miss(es)")
+        cache.close()
+    sys.exit(result)
+
+if __name__ == '__main__':
+    main()
@@ -8,17 +8,20 @@ December 2025
 """
 __version__ = "0.62"
 
-import ply.lex as lex
-import ply.yacc as yacc
 import argparse
+import os
 import sys
 import re
-import shutil
-import copy
-import itertools
-import glob
+import time
+import heapq
+import threading
+import weakref
+from collections import namedtuple
 from pathlib import Path
 
+# exprass runs once per source file during a build, so modules that only
+# some runs need (ply, shutil, glob) are imported where they are used
+
 
 
 # ============================================================================
@@ -93,14 +96,74 @@ def detect_assembly_assignments(line):
     
     return assigned
 
+# Instructions that only change registers and flags, so the values of
+# variables stay the same over them
+REGISTER_ONLY_INSTRUCTIONS = {
+    'lda', 'ldx', 'ldy', 'tax', 'tay', 'txa', 'tya', 'tsx', 'cmp', 'cpx', 'cpy', 'bit',
+    'clc', 'sec', 'cli', 'sei', 'clv', 'cld', 'sed', 'nop', 'pha', 'pla', 'php', 'plp',
+    'and', 'ora', 'eor', 'adc', 'sbc', 'ldax', 'cmpax',
+}
+
+def is_assembly_barrier(line):
+    """
+    Check if a line of raw assembly code may change variables in ways that
+    detect_assembly_assignments doesn't see, or may be a jump target or
+    jump. let statements on both sides of a barrier don't share values.
+    
+    Not barriers are the instructions that only change registers and stores
+    to a plain variable (sta variable / stax variable, which
+    detect_assembly_assignments reports).
+    """
+    stripped = line.strip()
+    comment_pos = stripped.find(';')
+    if comment_pos >= 0:
+        stripped = stripped[:comment_pos].strip()
+    if not stripped:
+        return False
+    
+    match = re.match(r'([a-zA-Z_.][a-zA-Z0-9_]*)(?:\s+(.*))?$', stripped)
+    if not match:
+        # Labels and anything unusual
+        return True
+    opcode = match.group(1).lower()
+    operand = (match.group(2) or '').strip()
+    if opcode in REGISTER_ONLY_INSTRUCTIONS:
+        return False
+    if opcode in ('asl', 'lsr', 'rol', 'ror'):
+        # Only the accumulator form leaves memory alone
+        return operand.lower() not in ('', 'a')
+    if opcode in ('sta', 'stx', 'sty', 'stax'):
+        store = re.fullmatch(r'([a-zA-Z_][a-zA-Z0-9_]*)(?:\+1)?', operand)
+        # Indexed and indirect stores may hit any variable, and the temps
+        # belong to the compiled code
+        return store is None or bool(TEMP_PATTERN.fullmatch(store.group(1)) or
+                                     SHARED_TEMP_PATTERN.fullmatch(store.group(1)))
+    return True
+
 # ============================================================================
 # CODE GENERATOR
 # ============================================================================
 
+class SearchPruned(Exception):
+    """Raised when a variant under construction cannot beat the best one found"""
+    pass
+
+class StatementPlanned(Exception):
+    """
+    Raised by the statement code generation while planning common
+    subexpressions, with the assigned variable (None for a register) and
+    the expression tree (None for a compound assignment)
+    """
+    def __init__(self, target, tree):
+        super().__init__(target)
+        self.target = target
+        self.tree = tree
+
 class CodeGenerator:
     """Manages code generation and variable tracking"""
     
-    def __init__(self, temp_start=10, verbose=False):
+    def __init__(self, temp_start=10, verbose=False, search='auto', budget=None, use_cache=False,
+                 optimize='balanced', cse=False, zp_temps=0):
         self.variables = set()  # All variables
         self.assigned_vars = set()  # Variables assigned to (left side of let)
         self.referenced_vars = set()  # Variables only referenced (right side)
@@ -108,6 +171,22 @@ class CodeGenerator:
         self.temp_counter = temp_start
         self.temp_start = temp_start
         self.verbose = verbose
+        self.search = search  # Operand order search: 'auto', 'exhaustive' or 'fast'
+        self.budget = budget  # Search budget per statement: None, ('variants', n) or ('ms', n)
+        self.optimize = optimize  # Objective: 'speed', 'size' or 'balanced'
+        self.zp_temps = zp_temps  # Number of temps from temp_start on that are in the zero page
+        self.cost_model = get_cost_model(optimize, temp_start + zp_temps if zp_temps else None)
+        self.temp_limit = None  # get_temp() raises SearchPruned when reaching this number
+        self.cse = cse  # Compute common subexpressions once, only with --cse
+        self.available = {}  # Values of earlier statements in shared temps: ExprNode -> name
+        self.publish = {}  # Values to store in shared temps for later statements: ExprNode -> name
+        self.planning = False  # The statement code generation raises StatementPlanned
+        self.optimizer_removed = 0  # Operations removed by the peephole optimizer
+        self.use_cache = use_cache  # Look up statements in the persistent statement cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.var_log = None  # Records (assigned, name) of the statement being compiled
+        self.profile = None  # StatementProfile of the statement being compiled, for --stats
         # Register usage flags (set during parsing, used in compile_line)
         self._uses_ax = False
         self._uses_a = False
@@ -119,9 +198,11 @@ class CodeGenerator:
         self.temp_counter = self.temp_start
     
     def get_temp(self):
-        """Generate a temporary variable name"""
-        tmp = f"tmp{self.temp_counter}"
-        self.temp_vars.add(tmp)
+        """Allocate a temporary variable, returns its number (tmpN)"""
+        if self.temp_limit is not None and self.temp_counter >= self.temp_limit:
+            raise SearchPruned()
+        tmp = self.temp_counter
+        self.temp_vars.add(temp_name(tmp))
         self.temp_counter += 1
         return tmp
     
@@ -129,11 +210,15 @@ class CodeGenerator:
         """Register a variable as assigned"""
         self.variables.add(name)
         self.assigned_vars.add(name)
+        if self.var_log is not None:
+            self.var_log.append((True, name))
     
     def reference_variable(self, name):
         """Register a variable as referenced"""
         self.variables.add(name)
         self.referenced_vars.add(name)
+        if self.var_log is not None:
+            self.var_log.append((False, name))
     
     def get_warnings(self):
         """Get warnings about variables referenced but never assigned"""
@@ -171,76 +256,527 @@ class CodeGenerator:
         
         return lines
 
+# ============================================================================
+# INSTRUCTION REPRESENTATION
+# ============================================================================
+
+# Addressing modes of an Instr
+IMPLIED = 'imp'       # tax, absax                - operand is None
+IMMEDIATE = 'imm'     # ldax #5                   - operand is the value
+MEMORY = 'mem'        # ldax var                  - operand is the symbol or address
+TEMP = 'tmp'          # stax tmp10                - operand is the temp number
+TEMP_HIGH = 'tmphi'   # sta tmp10+1               - operand is the temp number
+ARGS = 'args'         # restore X,to,A / peek ax  - operand is the argument text
+
+def temp_name(number):
+    """Name of the temp variable with the given number"""
+    return f"tmp{number}"
+
+def shared_temp_name(number):
+    """Name of the shared temp with the given number, which passes a value to later statements"""
+    return f"cse{number}"
+
+# Shared temp references like cse1, cse2, etc.
+SHARED_TEMP_PATTERN = re.compile(r'\bcse(\d+)\b')
+
+# Bytes of the ZEROPAGE segment in the {target}-basicfriendly-asm.cfg linker configs
+ZEROPAGE_SEGMENT_SIZES = {'c64': 0x12, 'c128': 0x20, 'vic20': 0x22}
+
+# Bytes of the ZEROPAGE segment that LAMAlib's library routines may claim:
+# _llzp_word1-3, _llzp_byte1-3 and _zp_ptr1. The modules are not counted,
+# see module_zeropage_bytes.
+LAMALIB_ZEROPAGE_BYTES = 11
+
+# Numeric settings of the source, e.g. MAXSPRITES = 8 before including a module
+SETTING_PATTERN = re.compile(r'(\w+)\s*=\s*(\$[0-9a-f]+|\d+)\s*(?:;|$)', re.IGNORECASE)
+
+def module_zeropage_bytes(name, settings):
+    """
+    Bytes of the ZEROPAGE segment that an included LAMAlib module takes with
+    the settings of the source, 0 for modules that don't use the zero page
+    """
+    name = os.path.splitext(os.path.basename(name))[0].lower()
+    if name == 'm_sprmultiplexer':
+        return 0 if settings.get('SPRMUX_NO_ZP') else settings.get('MAXSPRITES', 16)
+    if name == 'm_displaypetscii':
+        return 2 if settings.get('FRUGAL_ZP') else 4
+    return 0
+
+class Instr(namedtuple('Instr', ['opcode', 'mode', 'operand'], defaults=(IMPLIED, None))):
+    """
+    A generated instruction or LAMAlib macro call.
+    Code generation, the peephole optimizer, scoring and temp renumbering
+    all work on this form; the text is rendered once when writing output.
+    """
+    __slots__ = ()
+    
+    def operand_text(self):
+        """Operand as written in assembly, '' for implied instructions"""
+        mode = self.mode
+        if mode == IMPLIED:
+            return ''
+        if mode == IMMEDIATE:
+            return f"#{self.operand}"
+        if mode == TEMP:
+            return temp_name(self.operand)
+        if mode == TEMP_HIGH:
+            return temp_name(self.operand) + '+1'
+        return str(self.operand)
+    
+    def render(self):
+        """Assembly text of this instruction"""
+        if self.mode == IMPLIED:
+            return self.opcode
+        return f"{self.opcode} {self.operand_text()}"
+    
+    __str__ = render
+    
+    @property
+    def is_simple_load(self):
+        """True for ldax of a variable or temp, which can become an operand"""
+        return self.opcode == 'ldax' and self.mode in (MEMORY, TEMP)
+    
+    @property
+    def is_immediate_load(self):
+        return self.opcode == 'ldax' and self.mode == IMMEDIATE
+    
+    @classmethod
+    def parse(cls, text):
+        """Parse one line of assembly text (without comment) into an Instr"""
+        parts = text.split(None, 1)
+        opcode = parts[0]
+        if len(parts) == 1:
+            return cls(opcode)
+        operand = parts[1].strip()
+        if operand.startswith('#'):
+            value = operand[1:]
+            return cls(opcode, IMMEDIATE, int(value) if value.isdigit() else value)
+        match = re.fullmatch(r'tmp(\d+)(\+1)?', operand)
+        if match:
+            return cls(opcode, TEMP_HIGH if match.group(2) else TEMP, int(match.group(1)))
+        if re.fullmatch(r'[A-Za-z_$0-9][A-Za-z0-9_]*', operand):
+            return cls(opcode, MEMORY, operand)
+        return cls(opcode, ARGS, operand)
+
+def as_operand(load, opcode):
+    """Turn a simple or immediate ldax into opcode with the same operand"""
+    return Instr(opcode, load.mode, load.operand)
+
+def render_code(code_lines):
+    """Render a list of Instr and text lines to text lines"""
+    return [line if isinstance(line, str) else line.render() for line in code_lines]
+
 # ============================================================================
 # SCORING SYSTEM FOR CODE QUALITY
 # ============================================================================
 
-def score_instruction(instr):
+# Objectives of --optimize: weights of the cycles and bytes of the code in
+# its score. speed and size break ties with the other measure.
+OPTIMIZE_OBJECTIVES = {
+    'speed': (1024, 1),
+    'size': (1, 65536),
+    'balanced': (1, 1),
+}
+
+# Average cycles of the LAMAlib subroutines, without the jsr: the shift-add
+# loops of fastmultiply16.s and divide16.s with half of the bits set
+MUL16_CYCLES = 435
+DIV16_CYCLES = 779
+
+# Cycles and bytes of the LAMAlib macros and 6502 instructions without operand
+IMPLIED_COSTS = {
+    'tax': (2, 1), 'tay': (2, 1), 'txa': (2, 1), 'tya': (2, 1), 'nop': (2, 1),
+    'pha': (3, 1), 'pla': (4, 1), 'rts': (6, 1),
+    'aslax': (15, 6),  # asl, pha, txa, rol, tax, pla
+    'lsrax': (15, 6),  # pha, txa, lsr, tax, pla, ror
+    'rorax': (15, 6),  # pha, txa, ror, tax, pla, ror
+    'negax': (21, 13),  # clc, eor #, adc #, pha, txa, eor #, adc #, tax, pla
+    'absax': (25, 17),  # cpx #, bcc, negax, for a negative value
+    'incax': (8, 6),  # clc, adc #, bne, inx
+    'decax': (8, 6),  # cmp #, bne, dex, sbc #
+}
+
+# pha, txa, <op> #hi / <op> addr+1, tax, pla around the high byte, without the <op>
+HIGH_BYTE_COST = (11, 4)
+
+def memory_cost(instr, zp_limit=None):
     """
-    Score a single instruction.
-    Lower score is better.
-    
-    Scoring:
-    - ldax, stax: 1 point
-    - addax, subax, absax: 3 points
-    - mul16: 50 points
-    - div16, mod16: 95 points
-    - Single 6502 commands (tya, txa, ldx #N, ldy #N, lda #N, tax, tay): 1 point
-    - store/restore: 1 point
-    - peek, peekw: 1 point
-    - All other commands (lsrax, aslax, andax, orax, eorax): 2 points
+    Cycles and bytes of one 6502 instruction (lda, sta, ...) with the
+    operand of instr. Temps with a number below zp_limit are in the zero page.
     """
-    instr = instr.strip()
-    if not instr or instr.startswith(';'):
-        return 0
-    
-    # Extract the opcode (first word)
-    parts = instr.split()
-    if not parts:
-        return 0
-    opcode = parts[0].lower()
-    
-    # 1-point ops: ldax, stax
-    if opcode in ['ldax', 'stax']:
-        return 1
-    
-    # 3-point ops: addax, subax
-    if opcode in ['addax', 'subax', 'absax']:
-        return 3
-    
-    # 50-point ops: mul16
+    if instr.mode == IMMEDIATE:
+        return (2, 2)
+    operand = instr.operand
+    if instr.mode == MEMORY:
+        if isinstance(operand, str) and operand.isdigit():
+            operand = int(operand)
+        if isinstance(operand, int) and 0 <= operand < 256:
+            return (3, 2)
+    elif instr.mode in (TEMP, TEMP_HIGH) and zp_limit is not None and operand < zp_limit:
+        return (3, 2)
+    # Variables and the other temps are reserved with .res outside the zero page
+    return (4, 3)
+
+def immediate_bytes(instr):
+    """Low and high byte of an immediate operand, None for a symbolic one"""
+    if isinstance(instr.operand, int):
+        return instr.operand & 0xFF, (instr.operand >> 8) & 0xFF
+    return None
+
+def instruction_cost(instr, zp_limit=None):
+    """
+    Cycles and bytes of an Instr as the LAMAlib macros in
+    LAMAlib-macros16.inc, LAMAlib-routines.inc and LAMAlib-structured.inc
+    expand it, including the special cases for immediate operands.
+    Subroutine calls count the jsr and the average run time of the routine.
+    Temps with a number below zp_limit are in the zero page.
+    """
+    opcode = instr.opcode
+    if instr.mode == IMPLIED:
+        return IMPLIED_COSTS.get(opcode, (2, 1))
+    if opcode in ('lda', 'ldx', 'ldy', 'sta', 'stx', 'sty', 'and', 'ora', 'eor', 'adc', 'sbc'):
+        return memory_cost(instr, zp_limit)
+    cycles, size = memory_cost(instr, zp_limit)
+    if opcode == 'ldax':
+        if instr.mode == IMMEDIATE:
+            # lda #lo, tax when both bytes are equal, else lda #lo, ldx #hi
+            value = immediate_bytes(instr)
+            return (4, 3) if value and value[0] == value[1] else (4, 4)
+        return (2 * cycles, 2 * size)
+    address_in_ax = opcode in ('peek', 'peekw') and str(instr.operand).lower().startswith('ax')
+    if opcode in ('stax', 'peekw') and not address_in_ax:
+        return (2 * cycles, 2 * size)
+    if opcode in ('addax', 'subax'):
+        # clc or sec, then the low and high byte
+        return (2 * cycles + HIGH_BYTE_COST[0] + 2, 2 * size + HIGH_BYTE_COST[1] + 1)
+    if opcode in ('andax', 'orax', 'eorax'):
+        value = immediate_bytes(instr) if instr.mode == IMMEDIATE else None
+        if value is None:
+            return (2 * cycles + HIGH_BYTE_COST[0], 2 * size + HIGH_BYTE_COST[1])
+        # Bytes that don't change the value are skipped
+        neutral = 255 if opcode == 'andax' else 0
+        low = (0, 0) if value[0] == neutral else (2, 2)
+        high = (0, 0) if value[1] == neutral else (HIGH_BYTE_COST[0] + 2, HIGH_BYTE_COST[1] + 2)
+        return (low[0] + high[0], low[1] + high[1])
     if opcode == 'mul16':
-        return 50
-    
-    # 95-point ops: div16, mod16
-    if opcode in ['div16', 'mod16']:
-        return 95
-    
-    # 1-point single 6502 commands
-    single_6502 = ['tya', 'txa', 'tax', 'tay', 'ldx', 'ldy', 'lda', 
-                   'store', 'restore', 'peek', 'peekw', 'nop', 'rts', 'pha', 'pla']
-    if opcode in single_6502:
-        return 1
-    
-    # 2-point: other LAMAlib macros
-    other_ops = ['lsrax', 'aslax', 'andax', 'orax', 'eorax', 'negax', 'incax', 'decax']
-    if opcode in other_ops:
-        return 2
+        # ldy arg, sty _fastmul16_arg (zero page) for both bytes, jsr
+        return (2 * cycles + 6 + 6 + MUL16_CYCLES, 2 * size + 4 + 3)
+    if opcode in ('div16', 'mod16'):
+        value = instr.operand if instr.mode == IMMEDIATE and isinstance(instr.operand, int) else None
+        if value is not None and value in POWERS_OF_TWO:
+            shifts = POWERS_OF_TWO[value]
+            if opcode == 'mod16':
+                # and #mask, ldx #0 or txa, ldx #0 for 256
+                return (4, 3) if shifts == 8 else (4, 4)
+            if shifts == 8:
+                # sta _div16_rem, txa, ldx #0, stx _div16_rem+1
+                return (10, 7)
+            # The remainder is saved, then the quotient is shifted
+            return (17 + shifts * IMPLIED_COSTS['lsrax'][0], 10 + shifts * IMPLIED_COSTS['lsrax'][1])
+        # Divisor bytes into the subroutine (absolute), jsr, mod16 loads the remainder
+        cost = (2 * cycles + 8 + 6 + DIV16_CYCLES, 2 * size + 6 + 3)
+        if opcode == 'mod16':
+            cost = (cost[0] + 6, cost[1] + 4)
+        return cost
+    if opcode == 'store':
+        # sta/stx/sty into the operand of the restore (self-modifying code)
+        return (8, 6) if instr.operand.upper() == 'AX' else (4, 3)
+    if opcode == 'restore':
+        # lda #0 / ldx #0 / ldy #0 with the stored value as operand
+        return (4, 4) if instr.operand.upper() == 'AX' else (2, 2)
+    if opcode == 'peek':
+        if address_in_ax:
+            # Address in AX: sta, stx into a self-modified load
+            return (12, 9)
+        return (cycles, size)
+    if opcode == 'peekw':
+        # Address in AX: two self-modified loads
+        return (28, 21)
+    return (cycles, size)
+
+# Exponent of the powers of two that div16 and mod16 special-case
+POWERS_OF_TWO = {1 << n: n for n in range(1, 9)}
+
+class CostModel:
+    """
+    Scores code by the 6502 cycles and bytes of its LAMAlib macro
+    expansions, weighted for an --optimize objective. Lower is better.
+    Temps with a number below zp_limit are in the zero page (--zp-temps).
+    Scores are cached per instruction.
+    """
     
-    # Default: 1 point for unknown
-    return 1
+    def __init__(self, objective='balanced', zp_limit=None):
+        self.objective = objective
+        self.zp_limit = zp_limit
+        self.cycle_weight, self.byte_weight = OPTIMIZE_OBJECTIVES[objective]
+        self.scores = {}
+        self.chains = {}  # Best multiplication chain by factor, see best_chain()
+        self.horner = {}  # Shift and add steps by factor, see horner_steps()
+        self.divisions = {}  # Best division or modulo chain by (opcode, divisor), see best_division()
+    
+    def score(self, instr):
+        """Score of one Instr"""
+        score = self.scores.get(instr)
+        if score is None:
+            cycles, size = instruction_cost(instr, self.zp_limit)
+            score = self.scores[instr] = cycles * self.cycle_weight + size * self.byte_weight
+        return score
+    
+    def score_code(self, code_lines):
+        """Score of a list of Instr"""
+        scores = self.scores
+        total = 0
+        for instr in code_lines:
+            score = scores.get(instr)
+            total += score if score is not None else self.score(instr)
+        return total
+    
+    def cheapest(self, instrs):
+        """Lowest score among alternative instructions"""
+        return min(self.score(instr) for instr in instrs)
+
+# Cost model of each objective, shared by all code generators
+COST_MODELS = {objective: CostModel(objective) for objective in OPTIMIZE_OBJECTIVES}
+
+# Cost models with zero page temps by (objective, zp_limit), made on first use
+_zp_cost_models = {}
+
+def get_cost_model(objective, zp_limit=None):
+    """Shared cost model of an objective, with the temps below zp_limit in the zero page"""
+    if zp_limit is None:
+        return COST_MODELS[objective]
+    key = (objective, zp_limit)
+    cost_model = _zp_cost_models.get(key)
+    if cost_model is None:
+        cost_model = _zp_cost_models.setdefault(key, CostModel(objective, zp_limit))
+    return cost_model
+
+def score_instruction(instr, cost_model=None):
+    """
+    Score a single instruction with the cost model of an objective
+    (balanced by default). Lower score is better.
+    instr is an Instr or a line of assembly text.
+    """
+    if not isinstance(instr, Instr):
+        instr = instr.strip()
+        if not instr or instr.startswith(';'):
+            return 0
+        instr = Instr.parse(instr)
+    return (cost_model or COST_MODELS['balanced']).score(instr)
 
-def score_code(code_lines):
-    """Score a complete code sequence. Lower is better."""
+def score_code(code_lines, cost_model=None):
+    """Score a complete code sequence of Instr and text lines. Lower is better."""
+    cost_model = cost_model or COST_MODELS['balanced']
     total = 0
     for line in code_lines:
-        if isinstance(line, str):
-            total += score_instruction(line)
+        if isinstance(line, Instr):
+            total += cost_model.score(line)
+        else:
+            total += score_instruction(line, cost_model)
     return total
 
 def count_instructions(code_lines):
     """Count actual assembly instructions (exclude empty lines and comments)"""
-    return len([line for line in code_lines if line and not line.strip().startswith(';')])
+    return len([line for line in code_lines
+                if isinstance(line, Instr) or (line and not line.strip().startswith(';'))])
+
+# ============================================================================
+# STRENGTH REDUCTION
+# ============================================================================
+
+def shift_code(op, count):
+    """
+    Code that shifts AX by count bits, op is 'aslax' or 'lsrax'.
+    From 8 bits on, the low byte moves into the high byte (or back) and only
+    that byte is shifted further. 16 bits or more leave 0.
+    """
+    if count >= 16:
+        return [Instr('ldax', IMMEDIATE, 0)]
+    if count < 8:
+        return [Instr(op)] * count
+    if op == 'aslax':
+        return [Instr('asl')] * (count - 8) + [Instr('tax'), Instr('lda', IMMEDIATE, 0)]
+    return [Instr('txa')] + [Instr('lsr')] * (count - 8) + [Instr('ldx', IMMEDIATE, 0)]
+
+def horner_steps(factor, cost_model):
+    """
+    Cheapest shifts, additions and subtractions of temp 0 that turn AX into
+    AX * factor (1..65536) when temp 0 holds the original AX. The factor
+    is built from its highest bit down, each odd step goes through factor-1
+    (addax) or factor+1 (subax), whichever is cheaper with cost_model.
+    """
+    steps = cost_model.horner.get(factor)
+    if steps is None:
+        if factor == 1:
+            steps = []
+        elif factor % 2 == 0:
+            shifts = (factor & -factor).bit_length() - 1
+            steps = horner_steps(factor >> shifts, cost_model) + shift_code('aslax', shifts)
+        else:
+            steps = min(horner_steps(factor - 1, cost_model) + [Instr('addax', TEMP, 0)],
+                        horner_steps(factor + 1, cost_model) + [Instr('subax', TEMP, 0)],
+                        key=cost_model.score_code)
+        cost_model.horner[factor] = steps
+    return steps
+
+def chain_temps(chain):
+    """Number of temps a multiplication chain uses"""
+    return len({instr.operand for instr in chain if instr.mode == TEMP})
+
+def rebase_chain(chain, offset):
+    """Chain with its temps numbered from offset"""
+    return [Instr(instr.opcode, TEMP, instr.operand + offset) if instr.mode == TEMP else instr
+            for instr in chain]
+
+def best_chain(factor, cost_model):
+    """
+    Cheapest code without mul16 that multiplies AX by factor (0..65535),
+    with its temps numbered from 0. Besides the shift and add steps, it tries
+    multiplying by two factors in a row (x*45 = x*5*9) and negating the
+    product for factors above 32768 (x*65533 = -(x*3)).
+    """
+    chain = cost_model.chains.get(factor)
+    if chain is None:
+        if factor == 0:
+            candidates = [[Instr('ldax', IMMEDIATE, 0)]]
+        else:
+            steps = horner_steps(factor, cost_model)
+            candidates = [([Instr('stax', TEMP, 0)] if chain_temps(steps) else []) + steps]
+        divisor = 3
+        while divisor * divisor <= factor:
+            if factor % divisor == 0:
+                for first, second in ((divisor, factor // divisor), (factor // divisor, divisor)):
+                    head = best_chain(first, cost_model)
+                    candidates.append(head + rebase_chain(best_chain(second, cost_model), chain_temps(head)))
+            divisor += 2
+        if factor > 32768:
+            candidates.append(best_chain(65536 - factor, cost_model) + [Instr('negax')])
+        chain = cost_model.chains[factor] = min(candidates, key=cost_model.score_code)
+    return chain
+
+def multiply_chain(factor, cost_model):
+    """
+    Chain of best_chain() for AX * factor, or None if mul16 #factor
+    scores better with cost_model
+    """
+    chain = best_chain(factor & 0xFFFF, cost_model)
+    if cost_model.score_code(chain) < cost_model.score(Instr('mul16', IMMEDIATE, factor)):
+        return chain
+    return None
+
+def reciprocal_exact(multiplier, shift, divisor, bits):
+    """True if x * multiplier >> shift equals x // divisor for all x below 2**bits"""
+    error = multiplier * divisor - (1 << shift)
+    if ((1 << bits) - 1) * error < (1 << shift):
+        return True
+    if divisor > 1024:
+        return False
+    # Each remainder is worst at the largest x that has it
+    return all((x % divisor << shift) + x * error < divisor << shift
+               for x in range(max(0, (1 << bits) - divisor), 1 << bits))
+
+def reciprocal_steps(multiplier, shift):
+    """
+    Code that turns AX into AX * multiplier >> shift when temp 0 holds AX.
+    The product is built from the lowest bit of the multiplier up, shifting
+    right after each bit: addax leaves bit 16 of the sum in the carry and
+    rorax shifts it back in, so the sum never needs more than 17 bits and
+    the dropped bits never change the result.
+    """
+    while multiplier % 2 == 0:
+        multiplier >>= 1
+        shift -= 1
+    # The lowest bit is AX itself
+    steps = [Instr('lsrax')]
+    for bit in range(1, multiplier.bit_length()):
+        if multiplier >> bit & 1:
+            steps += [Instr('addax', TEMP, 0), Instr('rorax')]
+        else:
+            steps.append(Instr('lsrax'))
+    return steps + shift_code('lsrax', shift - multiplier.bit_length())
+
+def best_division(opcode, divisor, cost_model):
+    """
+    Cheapest code without div16 or mod16 for AX / divisor or AX % divisor
+    (opcode 'div16' or 'mod16', divisor 1..65535), with its temps numbered
+    from 0. The quotient shifts out the factors of two of the divisor and
+    multiplies by the reciprocal of the rest, with the shortest exact
+    fixed point multiplier. The remainder is AX - quotient * divisor.
+    """
+    key = (opcode, divisor)
+    chain = cost_model.divisions.get(key)
+    if chain is None:
+        shifts = (divisor & -divisor).bit_length() - 1
+        odd = divisor >> shifts
+        if opcode == 'mod16':
+            if odd == 1:
+                candidates = [[Instr('andax', IMMEDIATE, divisor - 1)]]
+            else:
+                # Temp 0 keeps the dividend, the quotient may have shifted it
+                quotient = best_division('div16', divisor, cost_model)
+                if shifts:
+                    quotient = [Instr('stax', TEMP, 0)] + rebase_chain(quotient, 1)
+                product = multiply_chain(divisor, cost_model) or [Instr('mul16', IMMEDIATE, divisor)]
+                product = rebase_chain(product, chain_temps(quotient))
+                result = chain_temps(quotient) + chain_temps(product)
+                candidates = [quotient + product + [Instr('stax', TEMP, result), Instr('ldax', TEMP, 0),
+                                                    Instr('subax', TEMP, result)]]
+        elif odd == 1:
+            candidates = [shift_code('lsrax', shifts)]
+        else:
+            bits = 16 - shifts
+            candidates = []
+            for shift in range(bits, bits + odd.bit_length() + 1):
+                multiplier = -(-(1 << shift) // odd)
+                if reciprocal_exact(multiplier, shift, odd, bits):
+                    candidates.append(shift_code('lsrax', shifts) + [Instr('stax', TEMP, 0)] +
+                                      reciprocal_steps(multiplier, shift))
+        chain = cost_model.divisions[key] = min(candidates, key=cost_model.score_code)
+    return chain
+
+def division_chain(opcode, divisor, cost_model):
+    """
+    Chain of best_division() for AX / divisor or AX % divisor, or None if
+    the div16 or mod16 macro scores better with cost_model
+    """
+    if not 0 < divisor < 65536:
+        return None
+    chain = best_division(opcode, divisor, cost_model)
+    if cost_model.score_code(chain) < cost_model.score(Instr(opcode, IMMEDIATE, divisor)):
+        return chain
+    return None
+
+def reduced_chain(opcode, operand, cost_model):
+    """
+    Chain template for a mul16, div16 or mod16 with a constant operand as
+    shifts, additions and subtractions, or None if the operation itself
+    scores better with cost_model
+    """
+    if not isinstance(operand, int):
+        return None
+    if opcode == 'mul16':
+        return multiply_chain(operand, cost_model)
+    if opcode in ('div16', 'mod16'):
+        return division_chain(opcode, operand, cost_model)
+    return None
+
+def reduced_code(opcode, operand, codegen_instance):
+    """Code of reduced_chain() with its own temps, or None"""
+    return chain_code(reduced_chain(opcode, operand, codegen_instance.cost_model), codegen_instance)
+
+def chain_code(chain, codegen_instance):
+    """Code of a chain template with a new temp for each of its temps, None for None"""
+    if chain is None:
+        return None
+    temps = {}
+    code = []
+    for instr in chain:
+        if instr.mode == TEMP:
+            if instr.operand not in temps:
+                temps[instr.operand] = codegen_instance.get_temp()
+            instr = Instr(instr.opcode, TEMP, temps[instr.operand])
+        code.append(instr)
+    return code
 
 # ============================================================================
 # EXPRESSION TREE FOR BRUTEFORCE OPTIMIZATION
@@ -250,37 +786,109 @@ class ExprNode:
     """
     A node in the expression tree.
     Used to generate all commutative permutations of an expression.
+    
+    Nodes are immutable and hash-consed: constructing a node that is
+    structurally equal to a live one returns the existing object, so
+    identical subtrees such as the two sides of (a+b)*(a+b) are shared
+    and nodes can be compared and hashed by identity.
     """
-    def __init__(self, node_type, value=None, op=None, children=None, is_commutative=False):
-        self.node_type = node_type  # 'const', 'var', 'reg', 'binop', 'unary', 'peek', 'peekw', 'abs'
-        self.value = value          # For const: numeric value, for var/reg: name
-        self.op = op                # For binop: operation name ('addax', 'mul16', etc.)
-        self.children = children or []  # Child nodes
-        self.is_commutative = is_commutative  # True for +, *, &, |, ^
+    __slots__ = ('node_type', 'value', 'op', 'children', 'is_commutative',
+                 'uses_ax', 'uses_a', 'uses_x', 'uses_y', 'is_pure', '__weakref__')
+    
+    # Live nodes by (node_type, value, op, is_commutative, children)
+    _table = weakref.WeakValueDictionary()
+    _table_lock = threading.Lock()  # Threads creating the same node get the same one
+    
+    def __new__(cls, node_type, value=None, op=None, children=None, is_commutative=False):
+        children = tuple(children) if children else ()
+        key = (node_type, value, op, is_commutative, children)
+        node = cls._table.get(key)
+        if node is not None:
+            return node
+        
+        node = object.__new__(cls)
+        init = object.__setattr__
+        init(node, 'node_type', node_type)    # 'const', 'var', 'reg', 'temp', 'binop', 'unary', 'shift', 'peek', 'peekw', 'abs'
+        init(node, 'value', value)            # For const: numeric value, for var/reg: name, for shift: bits, for temp: number
+        init(node, 'op', op)                  # For binop: operation name ('addax', 'mul16', etc.)
+        init(node, 'children', children)      # Child nodes
+        init(node, 'is_commutative', is_commutative)  # True for +, *, &, |, ^
+        
+        # Register usage tracking, derived from the registers in the subtree
+        if node_type == 'reg':
+            uses = (value == 'ax', value == 'a', value == 'x', value == 'y')
+        else:
+            uses = (False, False, False, False)
+            for child in children:
+                uses = (uses[0] or child.uses_ax, uses[1] or child.uses_a,
+                        uses[2] or child.uses_x, uses[3] or child.uses_y)
+        init(node, 'uses_ax', uses[0])
+        init(node, 'uses_a', uses[1])
+        init(node, 'uses_x', uses[2])
+        init(node, 'uses_y', uses[3])
+        # Pure values only depend on variables and constants, registers and
+        # memory reads may change between two evaluations
+        init(node, 'is_pure', node_type not in ('reg', 'peek', 'peekw') and
+             all(child.is_pure for child in children))
         
-        # Register usage tracking
-        self.uses_ax = False
-        self.uses_a = False
-        self.uses_x = False
-        self.uses_y = False
+        with cls._table_lock:
+            return cls._table.setdefault(key, node)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError(f"ExprNode is immutable, cannot set '{name}'")
+    
+    def __reduce__(self):
+        return (ExprNode, (self.node_type, self.value, self.op, self.children, self.is_commutative))
+    
+    def as_list(self):
+        """Nested list form of the tree for JSON, see from_list"""
+        return [self.node_type, self.value, self.op, self.is_commutative,
+                [child.as_list() for child in self.children]]
+    
+    @classmethod
+    def from_list(cls, data):
+        """Return the tree of an as_list form"""
+        node_type, value, op, is_commutative, children = data
+        return cls(node_type, value, op, [cls.from_list(child) for child in children], is_commutative)
     
     def clone(self):
-        """Deep clone this node"""
-        new_node = ExprNode(
-            self.node_type,
-            value=self.value,
-            op=self.op,
-            children=[c.clone() for c in self.children],
-            is_commutative=self.is_commutative
-        )
-        new_node.uses_ax = self.uses_ax
-        new_node.uses_a = self.uses_a
-        new_node.uses_x = self.uses_x
-        new_node.uses_y = self.uses_y
-        return new_node
+        """Nodes are immutable, so a clone is the node itself"""
+        return self
+    
+    def with_children(self, children):
+        """Return the node with the same operation and the given children"""
+        return ExprNode(self.node_type, value=self.value, op=self.op,
+                        children=children, is_commutative=self.is_commutative)
+    
+    def substitute(self, replacements):
+        """Return the tree with the subtrees in replacements (a dict ExprNode -> ExprNode) replaced"""
+        replacement = replacements.get(self)
+        if replacement is not None:
+            return replacement
+        if not self.children:
+            return self
+        children = [child.substitute(replacements) for child in self.children]
+        if all(new is old for new, old in zip(children, self.children)):
+            return self
+        return self.with_children(children)
+    
+    def subtrees(self):
+        """Yield all nodes of this tree, a shared subtree once for every place it occurs"""
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children)
+    
+    def variables(self):
+        """Names of the variables this tree reads"""
+        return {node.value for node in self.subtrees() if node.node_type == 'var'}
     
     def get_commutative_nodes(self):
-        """Get all nodes in this tree that are commutative binary ops"""
+        """
+        Get all nodes in this tree that are commutative binary ops.
+        A shared subtree is listed once for every place it occurs.
+        """
         result = []
         if self.is_commutative and len(self.children) == 2:
             result.append(self)
@@ -293,26 +901,104 @@ class ExprNode:
         Generate all 2^n orderings where n = number of commutative operations.
         Returns list of ExprNode trees representing each ordering.
         """
-        comm_nodes = self.get_commutative_nodes()
-        n = len(comm_nodes)
-        
-        if n == 0:
-            return [self]
+        variants = [None] * (2 ** len(self.get_commutative_nodes()))
+        for swap_pattern, variant in self.iterate_orderings():
+            variants[swap_pattern] = variant
+        return variants
+    
+    def iterate_orderings(self):
+        """
+        Yield (swap_pattern, tree) for all 2^n orderings, one at a time.
+        Bit i of swap_pattern is set if the i-th commutative node (pre-order)
+        has its children swapped, as in enumerate_all_orderings. The patterns
+        are visited in Gray code order, so each step swaps the children of
+        one node and only rebuilds the path from that node to the root; all
+        other subtrees are shared with the previous variant.
+        """
+        # Occurrences of the nodes in pre-order: node, parent index and
+        # whether its children are currently swapped
+        nodes = []
+        parents = []
+        swapped = []
+        comm_positions = []
+        stack = [(self, -1)]
+        while stack:
+            node, parent = stack.pop()
+            if node.is_commutative and len(node.children) == 2:
+                comm_positions.append(len(nodes))
+            nodes.append(node)
+            parents.append(parent)
+            swapped.append(False)
+            position = len(nodes) - 1
+            for child in reversed(node.children):
+                stack.append((child, position))
         
-        # Generate all 2^n combinations
-        variants = []
-        for swap_pattern in range(2 ** n):
-            variant = self.clone()
-            comm_nodes_in_variant = variant.get_commutative_nodes()
-            
-            for i, node in enumerate(comm_nodes_in_variant):
-                if (swap_pattern >> i) & 1:
-                    # Swap children
-                    node.children[0], node.children[1] = node.children[1], node.children[0]
-            
-            variants.append(variant)
+        # Position of each occurrence among the children of its parent
+        children_of = [[] for _ in nodes]
+        for position in range(1, len(nodes)):
+            children_of[parents[position]].append(position)
         
-        return variants
+        current = list(nodes)
+        pattern = 0
+        yield pattern, self
+        for step in range(1, 2 ** len(comm_positions)):
+            bit = (step & -step).bit_length() - 1
+            position = comm_positions[bit]
+            swapped[position] = not swapped[position]
+            pattern ^= 1 << bit
+            while position >= 0:
+                children = [current[child] for child in children_of[position]]
+                if swapped[position]:
+                    children.reverse()
+                current[position] = nodes[position].with_children(children)
+                position = parents[position]
+            yield pattern, current[0]
+    
+    def operation_score(self, cost_model):
+        """
+        Lower bound for the score of the operations in this tree that every
+        ordering has to execute and that the peephole optimizer never
+        removes, using the cheapest operand form each operation can get.
+        Operand loads and temp traffic are not included.
+        """
+        if self.node_type == 'binop':
+            forms = [Instr(self.op, MEMORY, self.op), Instr(self.op, TEMP, 0)]
+            for child in self.children:
+                if child.node_type == 'const':
+                    forms.append(Instr(self.op, IMMEDIATE, child.value))
+                    if self.op in ('addax', 'subax'):
+                        # Small steps become incax/decax
+                        forms.append(Instr('incax'))
+            total = cost_model.cheapest(forms)
+            # Constant operand of a multiplication or the divisor
+            constants = self.children if self.op == 'mul16' else self.children[1:]
+            for child in constants:
+                chain = reduced_chain(self.op, child.value, cost_model) if child.node_type == 'const' else None
+                if chain is not None:
+                    # Temp stores of the chain are counted per temp
+                    total = min(total, cost_model.score_code(
+                        [instr for instr in chain if not (instr.opcode == 'stax' and instr.mode == TEMP)]))
+        elif self.node_type == 'shift':
+            # The ldx #0 of a byte move is dropped before a tax
+            total = cost_model.score_code([instr for instr in shift_code(self.op, self.value)
+                                           if instr != Instr('ldx', IMMEDIATE, 0)])
+        elif self.node_type in ('peek', 'peekw'):
+            child = self.children[0]
+            if child.node_type == 'const':
+                total = cost_model.score(Instr(self.node_type, IMMEDIATE, child.value))
+            elif child.node_type == 'var':
+                total = cost_model.score(Instr(self.node_type, MEMORY, child.value))
+            else:
+                total = cost_model.score(Instr(self.node_type, ARGS, 'ax'))
+        elif self.node_type == 'abs':
+            total = cost_model.score(Instr('absax'))
+        elif self.node_type == 'unary':
+            total = cost_model.score(Instr(self.op))
+        else:
+            total = 0
+        for child in self.children:
+            total += child.operation_score(cost_model)
+        return total
     
     def generate_code(self, codegen_instance, reg_temps=None):
         """
@@ -325,35 +1011,47 @@ class ExprNode:
         if reg_temps is None:
             reg_temps = {}
         
+        child_results = [child.generate_code(codegen_instance, reg_temps) for child in self.children]
+        return self.combine_code(child_results, codegen_instance, reg_temps)
+    
+    def combine_code(self, child_results, codegen_instance, reg_temps):
+        """
+        Generate the code for this node from the generated code of its children.
+        child_results holds one (code_list, uses_ax, uses_a, uses_x, uses_y)
+        tuple per child, in the order the operands are evaluated.
+        """
         if self.node_type == 'const':
-            return ([f"ldax #{self.value}"], False, False, False, False)
+            return ([Instr('ldax', IMMEDIATE, self.value)], False, False, False, False)
         
         elif self.node_type == 'var':
-            return ([f"ldax {self.value}"], False, False, False, False)
+            return ([Instr('ldax', MEMORY, self.value)], False, False, False, False)
+        
+        elif self.node_type == 'temp':
+            return ([Instr('ldax', TEMP, self.value)], False, False, False, False)
         
         elif self.node_type == 'reg':
             reg = self.value.lower()
             # Check if this register has a temp variable assigned (multi-use case)
             if reg in reg_temps:
                 # Use temp variable instead of restore
-                return ([f"ldax {reg_temps[reg]}"], 
+                return ([Instr('ldax', TEMP, reg_temps[reg])], 
                         reg == 'ax', reg == 'a', reg == 'x', reg == 'y')
             
             # Single-use case: use restore
             if reg == 'ax':
-                return (["restore AX"], True, False, False, False)
+                return ([Instr('restore', ARGS, 'AX')], True, False, False, False)
             elif reg == 'a':
-                return (["restore A", "ldx #0"], False, True, False, False)
+                return ([Instr('restore', ARGS, 'A'), Instr('ldx', IMMEDIATE, 0)], False, True, False, False)
             elif reg == 'x':
                 # Use new restore X,to,A pattern
-                return (["restore X,to,A", "ldx #0"], False, False, True, False)
+                return ([Instr('restore', ARGS, 'X,to,A'), Instr('ldx', IMMEDIATE, 0)], False, False, True, False)
             elif reg == 'y':
                 # Use new restore Y,to,A pattern
-                return (["restore Y,to,A", "ldx #0"], False, False, False, True)
+                return ([Instr('restore', ARGS, 'Y,to,A'), Instr('ldx', IMMEDIATE, 0)], False, False, False, True)
         
         elif self.node_type == 'binop':
-            left_code, l_ax, l_a, l_x, l_y = self.children[0].generate_code(codegen_instance, reg_temps)
-            right_code, r_ax, r_a, r_x, r_y = self.children[1].generate_code(codegen_instance, reg_temps)
+            left_code, l_ax, l_a, l_x, l_y = child_results[0]
+            right_code, r_ax, r_a, r_x, r_y = child_results[1]
             
             uses_ax = l_ax or r_ax
             uses_a = l_a or r_a
@@ -361,94 +1059,73 @@ class ExprNode:
             uses_y = l_y or r_y
             
             # Check if right is immediate (single ldax #N)
-            right_is_immediate = (len(right_code) == 1 and 
-                                  right_code[0].startswith('ldax #'))
+            right_is_immediate = len(right_code) == 1 and right_code[0].is_immediate_load
             
             # Check if right is simple variable (single ldax var)
-            right_is_simple_var = (len(right_code) == 1 and 
-                                   right_code[0].startswith('ldax ') and
-                                   not right_code[0].startswith('ldax #'))
-            
-            # Check if left is simple (for non-commutative ops with complex right)
-            left_is_immediate = (len(left_code) == 1 and 
-                                 left_code[0].startswith('ldax #'))
-            left_is_simple_var = (len(left_code) == 1 and 
-                                  left_code[0].startswith('ldax ') and
-                                  not left_code[0].startswith('ldax #'))
+            right_is_simple_var = len(right_code) == 1 and right_code[0].is_simple_load
             
             # Non-commutative operations need special handling for operand order
             # subax tmp computes AX - tmp, div16 tmp computes AX / tmp, mod16 tmp computes AX % tmp
             # So we need left in AX and right in tmp
             is_non_commutative = self.op in ('subax', 'div16', 'mod16')
             
+            chain = None
             if right_is_immediate:
-                # Extract value - left in AX, right as immediate
-                val = right_code[0].split('#')[1]
-                code = left_code + [f"{self.op} #{val}"]
-            elif right_is_simple_var:
-                # Extract variable name - left in AX, right from variable
-                var = right_code[0].split()[1]
-                code = left_code + [f"{self.op} {var}"]
+                # Shifts and additions instead of the multiplication or division routine
+                chain = reduced_code(self.op, right_code[0].operand, codegen_instance)
+            if chain is not None:
+                code = left_code + chain
+            elif right_is_immediate or right_is_simple_var:
+                # Left in AX, right as immediate or from variable
+                code = left_code + [as_operand(right_code[0], self.op)]
             elif is_non_commutative:
                 # Non-commutative with complex right side
                 # Need: left in AX, right in tmp
                 # So compute right first, store to tmp, then compute left
                 tmp = codegen_instance.get_temp()
-                code = right_code + [f"stax {tmp}"] + left_code + [f"{self.op} {tmp}"]
+                code = right_code + [Instr('stax', TEMP, tmp)] + left_code + [Instr(self.op, TEMP, tmp)]
             else:
                 # Commutative with complex right side
                 # Order doesn't matter, compute left first, store, compute right
                 tmp = codegen_instance.get_temp()
-                code = left_code + [f"stax {tmp}"] + right_code + [f"{self.op} {tmp}"]
+                code = left_code + [Instr('stax', TEMP, tmp)] + right_code + [Instr(self.op, TEMP, tmp)]
             
             return (code, uses_ax, uses_a, uses_x, uses_y)
         
-        elif self.node_type == 'peek':
-            addr_code, uses_ax, uses_a, uses_x, uses_y = self.children[0].generate_code(codegen_instance, reg_temps)
+        elif self.node_type in ('peek', 'peekw'):
+            addr_code, uses_ax, uses_a, uses_x, uses_y = child_results[0]
             
             # Check if address is simple (constant or variable)
-            addr_is_simple = (len(addr_code) == 1 and addr_code[0].startswith('ldax '))
+            addr_is_simple = len(addr_code) == 1 and addr_code[0].opcode == 'ldax'
             
-            # peek only sets A (8-bit), so we need ldx #0 for proper 16-bit result
             if addr_is_simple:
-                if addr_code[0].startswith('ldax #'):
-                    addr = '#' + addr_code[0].split('#')[1]
-                else:
-                    addr = addr_code[0].split()[1]
-                code = [f"peek {addr}", "ldx #0"]
+                code = [as_operand(addr_code[0], self.node_type)]
             else:
-                code = addr_code + ["peek ax", "ldx #0"]
-            
-            return (code, uses_ax, uses_a, uses_x, uses_y)
-        
-        elif self.node_type == 'peekw':
-            addr_code, uses_ax, uses_a, uses_x, uses_y = self.children[0].generate_code(codegen_instance, reg_temps)
+                code = addr_code + [Instr(self.node_type, ARGS, 'ax')]
             
-            addr_is_simple = (len(addr_code) == 1 and addr_code[0].startswith('ldax '))
-            
-            if addr_is_simple:
-                if addr_code[0].startswith('ldax #'):
-                    addr = '#' + addr_code[0].split('#')[1]
-                else:
-                    addr = addr_code[0].split()[1]
-                code = [f"peekw {addr}"]
-            else:
-                code = addr_code + ["peekw ax"]
+            # peek only sets A (8-bit), so we need ldx #0 for proper 16-bit result
+            if self.node_type == 'peek':
+                code.append(Instr('ldx', IMMEDIATE, 0))
             
             return (code, uses_ax, uses_a, uses_x, uses_y)
         
         elif self.node_type == 'abs':
-            child_code, uses_ax, uses_a, uses_x, uses_y = self.children[0].generate_code(codegen_instance, reg_temps)
+            child_code, uses_ax, uses_a, uses_x, uses_y = child_results[0]
             # absax operates on AX register, result in AX
-            code = child_code + ["absax"]
+            code = child_code + [Instr('absax')]
             return (code, uses_ax, uses_a, uses_x, uses_y)
         
         elif self.node_type == 'unary':
-            child_code, uses_ax, uses_a, uses_x, uses_y = self.children[0].generate_code(codegen_instance, reg_temps)
-            code = child_code + [self.op]
+            child_code, uses_ax, uses_a, uses_x, uses_y = child_results[0]
+            code = child_code + [Instr(self.op)]
+            return (code, uses_ax, uses_a, uses_x, uses_y)
+        
+        elif self.node_type == 'shift':
+            child_code, uses_ax, uses_a, uses_x, uses_y = child_results[0]
+            code = child_code + shift_code(self.op, self.value)
             return (code, uses_ax, uses_a, uses_x, uses_y)
         
-        return (["nop"], False, False, False, False)
+        return ([Instr('nop')], False, False, False, False)
     
     def count_register_refs(self):
         """
@@ -476,8 +1153,12 @@ class ExprNode:
             return f"Var({self.value})"
         elif self.node_type == 'reg':
             return f"Reg({self.value})"
+        elif self.node_type == 'temp':
+            return f"Temp({self.value})"
         elif self.node_type == 'binop':
             return f"BinOp({self.op}, {self.children[0]}, {self.children[1]})"
+        elif self.node_type == 'shift':
+            return f"Shift({self.op}, {self.value}, {self.children[0]})"
         elif self.node_type in ['peek', 'peekw', 'abs']:
             return f"{self.node_type.upper()}({self.children[0]})"
         return f"Node({self.node_type})"
@@ -486,65 +1167,131 @@ class ExprNode:
 # BRUTEFORCE OPTIMIZER
 # ============================================================================
 
+# Expressions with more commutative operations than this are not searched
+# exhaustively in 'auto' mode (2^n variants)
+EXHAUSTIVE_SEARCH_LIMIT = 10
+
+def allocate_register_temps(expr_tree, codegen_instance, reg_counts=None):
+    """Allocate temp variables for registers that are used more than once"""
+    if reg_counts is None:
+        reg_counts = expr_tree.count_register_refs()
+    reg_temps = {}
+    for reg in ['ax', 'a', 'x', 'y']:
+        if reg_counts.get(reg, 0) > 1:
+            reg_temps[reg] = codegen_instance.get_temp()
+    return reg_temps
+
 def bruteforce_optimize(expr_tree, codegen_instance):
     """
     Try all 2^n orderings of commutative operations and return the best code.
-    Uses score_code() to evaluate each variant.
+    Uses the cost model of the code generator to evaluate each variant. Variants are generated one
+    at a time, abandoned as soon as they cannot beat the best one so far,
+    and the search stops early when the code generator's budget is used up.
     Returns (best_code, uses_ax, uses_a, uses_x, uses_y, reg_temps)
     
     reg_temps is a dict mapping register names to temp variables for
     registers that are used multiple times in the expression.
+    
+    Large expressions are handed to search_optimize() unless the code
+    generator asks for an exhaustive search.
     """
-    variants = expr_tree.enumerate_all_orderings()
+    search = getattr(codegen_instance, 'search', 'auto')
+    n = len(expr_tree.get_commutative_nodes())
+    if search == 'fast' or (search == 'auto' and n > EXHAUSTIVE_SEARCH_LIMIT):
+        return search_optimize(expr_tree, codegen_instance)
     
     best_code = None
     best_score = float('inf')
+    best_pattern = None
     best_uses = (False, False, False, False)
     best_reg_temps = {}
     
     # Save temp counter
     saved_temp_counter = codegen_instance.temp_counter
     
-    # Count register references to determine which need temp variables
+    # Every temp costs one stax that the optimizer cannot remove (the temp
+    # is only read back by the operation), so operation_score() plus the
+    # score of a stax per temp used so far is a lower bound for a variant's
+    # score. get_temp() enforces it through temp_limit and abandons the variant.
+    cost_model = codegen_instance.cost_model
+    base_score = expr_tree.operation_score(cost_model)
+    temp_score = cost_model.score(Instr('stax', TEMP, 0))
     reg_counts = expr_tree.count_register_refs()
+    budget = getattr(codegen_instance, 'budget', None)
+    profile = getattr(codegen_instance, 'profile', None)
+    start_time = time.perf_counter()
+    explored = 0
+    pruned = 0
+    budget_exhausted = False
     
-    for variant in variants:
-        # Reset temp counter for fair comparison
-        codegen_instance.temp_counter = saved_temp_counter
-        
-        # Allocate temp variables for multi-use registers
-        reg_temps = {}
-        for reg in ['ax', 'a', 'x', 'y']:
-            if reg_counts.get(reg, 0) > 1:
-                reg_temps[reg] = codegen_instance.get_temp()
-        
-        try:
-            code, uses_ax, uses_a, uses_x, uses_y = variant.generate_code(codegen_instance, reg_temps)
+    try:
+        for pattern, variant in expr_tree.iterate_orderings():
+            if budget and explored > 0:
+                kind, limit = budget
+                if kind == 'variants' and explored >= limit:
+                    budget_exhausted = True
+                elif kind == 'ms' and (time.perf_counter() - start_time) * 1000 >= limit:
+                    budget_exhausted = True
+                if budget_exhausted:
+                    break
+            explored += 1
             
-            # Apply optimizer to the generated code
-            optimized_code, _ = optimize_code(code)
+            # Reset temp counter for fair comparison
+            codegen_instance.temp_counter = saved_temp_counter
             
-            score = score_code(optimized_code)
+            # Allocate temp variables for multi-use registers
+            reg_temps = allocate_register_temps(expr_tree, codegen_instance, reg_counts)
             
-            if score < best_score:
-                best_score = score
-                best_code = optimized_code
-                best_uses = (uses_ax, uses_a, uses_x, uses_y)
-                best_reg_temps = reg_temps.copy()
-                best_temp_count = codegen_instance.temp_counter - codegen_instance.temp_start
-        except Exception as e:
-            # Skip variants that fail to generate
-            pass
+            if best_code is not None:
+                # Ties are broken in favour of the lower swap pattern, so a
+                # later pattern has to be strictly better
+                if pattern > best_pattern:
+                    allowed_temps = -((base_score - best_score) // temp_score) - 1
+                else:
+                    allowed_temps = (best_score - base_score) // temp_score
+                codegen_instance.temp_limit = codegen_instance.temp_counter + allowed_temps
+            
+            try:
+                code, uses_ax, uses_a, uses_x, uses_y = variant.generate_code(codegen_instance, reg_temps)
+                
+                # Apply optimizer to the generated code
+                optimized_code, _ = optimize_code(code, profile, cost_model)
+                
+                score = cost_model.score_code(optimized_code)
+                if profile is not None:
+                    profile.add_score(score)
+                
+                if score < best_score or (score == best_score and pattern < best_pattern):
+                    best_score = score
+                    best_pattern = pattern
+                    best_code = optimized_code
+                    best_uses = (uses_ax, uses_a, uses_x, uses_y)
+                    best_reg_temps = reg_temps.copy()
+                    best_temp_count = codegen_instance.temp_counter - codegen_instance.temp_start
+            except SearchPruned:
+                pruned += 1
+            except Exception as e:
+                # Skip variants that fail to generate
+                pass
+            finally:
+                codegen_instance.temp_limit = None
+    finally:
+        codegen_instance.temp_limit = None
+    
+    if profile is not None:
+        profile.variants += explored
+        profile.pruned += pruned
+    
+    if codegen_instance.verbose:
+        note = ", budget exhausted" if budget_exhausted else ""
+        report(f"; Explored {explored} of {2 ** n} ordering(s), pruned {pruned}{note}")
     
     if best_code is None:
         # Fallback to original
         codegen_instance.temp_counter = saved_temp_counter
         
         # Allocate temp variables for multi-use registers
-        reg_temps = {}
-        for reg in ['ax', 'a', 'x', 'y']:
-            if reg_counts.get(reg, 0) > 1:
-                reg_temps[reg] = codegen_instance.get_temp()
+        reg_temps = allocate_register_temps(expr_tree, codegen_instance)
         
         code, uses_ax, uses_a, uses_x, uses_y = expr_tree.generate_code(codegen_instance, reg_temps)
         return (code, uses_ax, uses_a, uses_x, uses_y, reg_temps)
@@ -554,6 +1301,64 @@ def bruteforce_optimize(expr_tree, codegen_instance):
     
     return (best_code, best_uses[0], best_uses[1], best_uses[2], best_uses[3], best_reg_temps)
 
+def search_optimize(expr_tree, codegen_instance):
+    """
+    Find the best operand order for each commutative operation without
+    trying all orderings.
+    
+    The code of a subtree is placed unchanged into the code of its parent,
+    so its score does not depend on the surrounding code. The best order is
+    therefore chosen bottom-up: each commutative node tries both operand
+    orders using the best code of its children. Like the exhaustive search,
+    an order is scored on its code after the peephole optimizer, whose
+    rewrites (e.g. addax #1 -> incax) depend on the operand order. Results
+    are memoized by subtree shape and temp base, so repeated subtrees are
+    searched once. Returns the same tuple as bruteforce_optimize.
+    """
+    reg_temps = allocate_register_temps(expr_tree, codegen_instance)
+    profile = getattr(codegen_instance, 'profile', None)
+    cost_model = codegen_instance.cost_model
+    
+    memo = {}
+    
+    def best(node, temp_base):
+        # Returns (code_result, score, temp counter after this subtree)
+        # Nodes are hash-consed, so equal subtrees are the same key
+        key = (node, temp_base)
+        if key in memo:
+            return memo[key]
+        
+        orders = [node.children]
+        if node.is_commutative and len(node.children) == 2:
+            orders.append(node.children[::-1])
+        
+        best_entry = None
+        for children in orders:
+            temp = temp_base
+            child_results = []
+            for child in children:
+                child_result, _, temp = best(child, temp)
+                child_results.append(child_result)
+            codegen_instance.temp_counter = temp
+            result = node.combine_code(child_results, codegen_instance, reg_temps)
+            score = cost_model.score_code(optimize_code(result[0], profile, cost_model)[0])
+            if profile is not None:
+                profile.variants += 1
+                if node is expr_tree:
+                    profile.add_score(score)
+            # Keep the original order on ties
+            if best_entry is None or score < best_entry[1]:
+                best_entry = (result, score, codegen_instance.temp_counter)
+        
+        memo[key] = best_entry
+        return best_entry
+    
+    (code, uses_ax, uses_a, uses_x, uses_y), _, temp_end = best(expr_tree, codegen_instance.temp_counter)
+    codegen_instance.temp_counter = temp_end
+    optimized_code, _ = optimize_code(code, profile, cost_model)
+    
+    return (optimized_code, uses_ax, uses_a, uses_x, uses_y, reg_temps)
+
 # ============================================================================
 # LEXER
 # ============================================================================
@@ -645,7 +1450,7 @@ def t_newline(t):
     t.lexer.lineno += len(t.value)
 
 def t_error(t):
-    print(f"Illegal character '{t.value[0]}'", file=sys.stderr)
+    report(f"Illegal character '{t.value[0]}'")
     t.lexer.skip(1)
 
 # ============================================================================
@@ -675,161 +1480,202 @@ precedence = (
     ('left', 'TIMES', 'DIVIDE', 'MODULO'),
 )
 
-# Global codegen instance
-codegen = None
+# State of the compilation running in each thread: the code generator and
+# the stream for compiler messages (None for stderr)
+_context = threading.local()
+
+def current_codegen():
+    """Return the code generator of the compilation running in this thread"""
+    return _context.codegen
+
+def report(message, end="\n"):
+    """Print a compiler message to the message stream of this thread, stderr by default"""
+    print(message, end=end, file=getattr(_context, 'messages', None) or sys.stderr)
+
+# Binary operators: (LAMAlib operation, is_commutative)
+BINARY_OPS = {
+    '+': ('addax', True),
+    '-': ('subax', False),
+    '*': ('mul16', True),
+    '/': ('div16', False),
+    '%': ('mod16', False),
+    '&': ('andax', True),
+    '^': ('eorax', True),
+    '|': ('orax', True),
+}
+
+def fold_binary(op, left, right):
+    """Evaluate a binary operation on two constants at compile time"""
+    if op == '+':
+        return (left + right) & 0xFFFF
+    elif op == '-':
+        return (left - right) & 0xFFFF
+    elif op == '*':
+        return (left * right) & 0xFFFF
+    elif op == '/':
+        if right == 0:
+            report(f"Error: Division by zero")
+            return 0
+        return left // right
+    elif op == '%':
+        if right == 0:
+            report(f"Error: Modulo by zero")
+            return 0
+        return left % right
+    elif op == '&':
+        return left & right
+    elif op == '^':
+        return left ^ right
+    else:  # '|'
+        return left | right
+
+def shift_tree(shift_op, tree, amount):
+    """Tree that shifts tree by amount bits, merged with a shift in the same direction below it"""
+    if amount == 0:
+        return tree
+    if tree.node_type == 'shift' and tree.op == shift_op:
+        amount += tree.value
+        tree = tree.children[0]
+    return ExprNode('shift', op=shift_op, value=min(amount, 16), children=[tree])
 
 # ============================================================================
-# GRAMMAR RULES
+# STATEMENT CODE GENERATION
 # ============================================================================
 
-def p_statement_let(p):
-    """statement : LET VARIABLE EQUAL expression"""
-    var_name = p[2]
-    expr = p[4]
-    
+def assign_variable(var_name, expr_tree):
+    """Generate the code for let var = expression"""
+    codegen = current_codegen()
+    if codegen.planning:
+        raise StatementPlanned(var_name, expr_tree)
     codegen.add_variable(var_name)
-    
-    # Use bruteforce optimization if tree is available
-    if expr.tree is not None:
-        code, uses_ax, uses_a, uses_x, uses_y, reg_temps = bruteforce_optimize(expr.tree, codegen)
-        codegen._uses_ax = uses_ax
-        codegen._uses_a = uses_a
-        codegen._uses_x = uses_x
-        codegen._uses_y = uses_y
-        codegen._reg_temps = reg_temps
-        p[0] = code + [f"stax {var_name}"]
-    else:
-        codegen._uses_ax = expr.uses_ax
-        codegen._uses_a = expr.uses_a
-        codegen._uses_x = expr.uses_x
-        codegen._uses_y = expr.uses_y
-        codegen._reg_temps = {}
-        p[0] = expr.code + [f"stax {var_name}"]
-    
-    codegen.reset_temps()
-
-def p_statement_let_register_ax(p):
-    """statement : LET REG_AX EQUAL expression"""
-    expr = p[4]
-    
-    if expr.tree is not None:
-        code, uses_ax, uses_a, uses_x, uses_y, reg_temps = bruteforce_optimize(expr.tree, codegen)
-        codegen._uses_ax = uses_ax
-        codegen._uses_a = uses_a
-        codegen._uses_x = uses_x
-        codegen._uses_y = uses_y
-        codegen._reg_temps = reg_temps
-        p[0] = code
-    else:
-        codegen._uses_ax = expr.uses_ax
-        codegen._uses_a = expr.uses_a
-        codegen._uses_x = expr.uses_x
-        codegen._uses_y = expr.uses_y
-        codegen._reg_temps = {}
-        p[0] = expr.code
-    
+    code = optimize_expression(expr_tree)
     codegen.reset_temps()
+    return code + [Instr('stax', MEMORY, var_name)]
 
-def p_statement_let_register_a(p):
-    """statement : LET REG_A EQUAL expression"""
-    expr = p[4]
-    
-    if expr.tree is not None:
-        code, uses_ax, uses_a, uses_x, uses_y, reg_temps = bruteforce_optimize(expr.tree, codegen)
-        codegen._uses_ax = uses_ax
-        codegen._uses_a = uses_a
-        codegen._uses_x = uses_x
-        codegen._uses_y = uses_y
-        codegen._reg_temps = reg_temps
-        # Strip trailing ldx #0 - not needed when only A matters
-        while code and code[-1].strip() == "ldx #0":
-            code = code[:-1]
-        p[0] = code
-    else:
-        codegen._uses_ax = expr.uses_ax
-        codegen._uses_a = expr.uses_a
-        codegen._uses_x = expr.uses_x
-        codegen._uses_y = expr.uses_y
-        codegen._reg_temps = {}
-        code = expr.code[:]
-        # Strip trailing ldx #0
-        while code and code[-1].strip() == "ldx #0":
+def assign_register(reg, expr_tree):
+    """Generate the code for let ax/a/x/y = expression"""
+    codegen = current_codegen()
+    if codegen.planning:
+        raise StatementPlanned(None, expr_tree)
+    code = optimize_expression(expr_tree)
+    if reg != 'ax':
+        # Strip trailing ldx #0 - not needed when only A matters,
+        # and superfluous before tax/tay
+        while code and code[-1] == Instr('ldx', IMMEDIATE, 0):
             code = code[:-1]
-        p[0] = code
-    
+    if reg == 'x':
+        code = code + [Instr('tax')]
+    elif reg == 'y':
+        code = code + [Instr('tay')]
     codegen.reset_temps()
+    return code
 
-def p_statement_let_register_x(p):
-    """statement : LET REG_X EQUAL expression"""
-    expr = p[4]
-    
-    if expr.tree is not None:
-        code, uses_ax, uses_a, uses_x, uses_y, reg_temps = bruteforce_optimize(expr.tree, codegen)
-        codegen._uses_ax = uses_ax
-        codegen._uses_a = uses_a
-        codegen._uses_x = uses_x
-        codegen._uses_y = uses_y
-        codegen._reg_temps = reg_temps
-        # Strip trailing ldx #0 before tax - ldx #0 is superfluous
-        while code and code[-1].strip() == "ldx #0":
-            code = code[:-1]
-        p[0] = code + ["tax"]
-    else:
-        codegen._uses_ax = expr.uses_ax
-        codegen._uses_a = expr.uses_a
-        codegen._uses_x = expr.uses_x
-        codegen._uses_y = expr.uses_y
-        codegen._reg_temps = {}
-        code = expr.code[:]
-        while code and code[-1].strip() == "ldx #0":
-            code = code[:-1]
-        p[0] = code + ["tax"]
-    
-    codegen.reset_temps()
+def optimize_expression(expr_tree):
+    """
+    Find the best code for an expression tree and record its register
+    usage in the code generator for compile_line.
+    """
+    codegen = current_codegen()
+    profile = codegen.profile
+    if profile is not None:
+        # Search time without the optimizer runs on the variants
+        start = time.perf_counter()
+        optimize_time = profile.phases['optimize']
+    code, uses_ax, uses_a, uses_x, uses_y, reg_temps = optimize_shared(expr_tree, codegen)
+    if profile is not None:
+        profile.phases['search'] += (time.perf_counter() - start -
+                                     (profile.phases['optimize'] - optimize_time))
+    codegen._uses_ax = uses_ax
+    codegen._uses_a = uses_a
+    codegen._uses_x = uses_x
+    codegen._uses_y = uses_y
+    codegen._reg_temps = reg_temps
+    return code
 
-def p_statement_let_register_y(p):
-    """statement : LET REG_Y EQUAL expression"""
-    expr = p[4]
-    
-    if expr.tree is not None:
-        code, uses_ax, uses_a, uses_x, uses_y, reg_temps = bruteforce_optimize(expr.tree, codegen)
-        codegen._uses_ax = uses_ax
-        codegen._uses_a = uses_a
-        codegen._uses_x = uses_x
-        codegen._uses_y = uses_y
-        codegen._reg_temps = reg_temps
-        # Strip trailing ldx #0 before tay - ldx #0 is superfluous
-        while code and code[-1].strip() == "ldx #0":
-            code = code[:-1]
-        p[0] = code + ["tay"]
-    else:
-        codegen._uses_ax = expr.uses_ax
-        codegen._uses_a = expr.uses_a
-        codegen._uses_x = expr.uses_x
-        codegen._uses_y = expr.uses_y
-        codegen._reg_temps = {}
-        code = expr.code[:]
-        while code and code[-1].strip() == "ldx #0":
-            code = code[:-1]
-        p[0] = code + ["tay"]
-    
-    codegen.reset_temps()
+def tree_size(tree):
+    """Number of nodes in a tree"""
+    return sum(1 for _ in tree.subtrees())
 
-def p_statement_compound(p):
-    """statement : LET VARIABLE PLUSEQ expression
-                 | LET VARIABLE MINUSEQ expression
-                 | LET VARIABLE TIMESEQ expression
-                 | LET VARIABLE DIVEQ expression
-                 | LET VARIABLE MODEQ expression
-                 | LET VARIABLE ANDEQ expression
-                 | LET VARIABLE OREQ expression
-                 | LET VARIABLE XOREQ expression
-                 | LET VARIABLE LSHIFTEQ expression
-                 | LET VARIABLE RSHIFTEQ expression"""
-    var_name = p[2]
-    op = p[3]
-    expr = p[4]
-    
+def hoisted_code(tree, hoists, codegen):
+    """
+    Generate the code for tree with the subtrees in hoists computed first.
+    hoists holds (subtree, store) pairs, store is the Instr that keeps the
+    value in a shared temp, or None for a new temp of this statement. The
+    tree loads the values instead of computing the subtrees again.
+    Returns the same tuple as bruteforce_optimize.
+    """
+    loads = {}
+    prefix = []
+    # Inner subtrees are smaller, they come first so the outer ones can use them
+    for node, store in sorted(hoists, key=lambda hoist: tree_size(hoist[0])):
+        prefix += bruteforce_optimize(node.substitute(loads), codegen)[0]
+        if store is None:
+            temp = codegen.get_temp()
+            store = Instr('stax', TEMP, temp)
+            loads[node] = ExprNode('temp', value=temp)
+        else:
+            loads[node] = ExprNode('var', value=store.operand)
+        prefix.append(store)
+    code, uses_ax, uses_a, uses_x, uses_y, reg_temps = bruteforce_optimize(tree.substitute(loads), codegen)
+    return (prefix + code, uses_ax, uses_a, uses_x, uses_y, reg_temps)
+
+def repeated_subtrees(tree, hoisted):
+    """
+    Pure subtrees with an operation that occur more than once in tree,
+    largest first, not counting the places inside the hoisted subtrees
+    (which are computed once)
+    """
+    hoisted = set(hoisted)
+    counts = {}
+    stack = [tree] + [child for node in hoisted for child in node.children]
+    while stack:
+        node = stack.pop()
+        if node in hoisted or not node.children:
+            continue
+        if node.is_pure:
+            counts[node] = counts.get(node, 0) + 1
+        stack.extend(node.children)
+    return sorted((node for node, count in counts.items() if count > 1), key=tree_size, reverse=True)
+
+def optimize_shared(expr_tree, codegen):
+    """
+    bruteforce_optimize() with common subexpressions computed once.
+    Values of earlier statements are loaded from their shared temps
+    (codegen.available), values that later statements use are stored into
+    theirs (codegen.publish), and subtrees that occur more than once are
+    kept in a temp when the code scores better that way.
+    """
+    loads = {node: ExprNode('var', value=name) for node, name in codegen.available.items()}
+    tree = expr_tree.substitute(loads)
+    hoists = [(node.substitute(loads), Instr('stax', MEMORY, name)) for node, name in codegen.publish.items()]
+    temp_counter = codegen.temp_counter
+    best = hoisted_code(tree, hoists, codegen)
+    if not codegen.cse or tree.uses_ax or tree.uses_a or tree.uses_x or tree.uses_y:
+        # Code computed first would overwrite the registers the tree reads
+        return best
+    best_temps = codegen.temp_counter
+    best_score = None
+    cost_model = codegen.cost_model
+    for node in repeated_subtrees(tree, [hoisted for hoisted, _ in hoists]):
+        # Larger subtrees kept in a temp may already cover this one
+        if node not in repeated_subtrees(tree, [hoisted for hoisted, _ in hoists]):
+            continue
+        if best_score is None:
+            best_score = cost_model.score_code(optimize_code(best[0], codegen.profile, cost_model)[0])
+        codegen.temp_counter = temp_counter
+        trial = hoisted_code(tree, hoists + [(node, None)], codegen)
+        score = cost_model.score_code(optimize_code(trial[0], codegen.profile, cost_model)[0])
+        if score < best_score:
+            best, best_score, best_temps = trial, score, codegen.temp_counter
+            hoists = hoists + [(node, None)]
+    codegen.temp_counter = best_temps
+    return best
+
+def compound_assignment(var_name, op, expr_tree):
+    """Generate the code for let var op= expression, e.g. let v += 1"""
+    codegen = current_codegen()
+    if codegen.planning:
+        raise StatementPlanned(var_name, None)
     codegen.add_variable(var_name)
     
     # Map compound operators to their base operations
@@ -845,125 +1691,150 @@ def p_statement_compound(p):
     }
     
     # Start by loading the variable
-    code = [f"ldax {var_name}"]
+    code = [Instr('ldax', MEMORY, var_name)]
+    is_immediate = expr_tree.node_type == 'const'
     
     if op in ['<<=', '>>=']:
         # Shift operations - need immediate value
-        if not expr.is_immediate:
-            print(f"Error: Shift compound assignment only supports immediate values", 
-                  file=sys.stderr)
-            p[0] = []
-            return
+        if not is_immediate:
+            report(f"Error: Shift compound assignment only supports immediate values")
+            return []
         
-        shift_amount = expr.value
+        shift_amount = expr_tree.value
         if shift_amount < 0 or shift_amount > 15:
-            print(f"Error: Shift amount must be between 0 and 15 (got {shift_amount})", 
-                  file=sys.stderr)
-            p[0] = []
-            return
+            report(f"Error: Shift amount must be between 0 and 15 (got {shift_amount})")
+            return []
         
-        # Generate repeated shift instructions
         shift_op = "aslax" if op == '<<=' else "lsrax"
-        for _ in range(shift_amount):
-            code.append(shift_op)
+        code.extend(shift_code(shift_op, shift_amount))
     else:
         # Regular operations
         base_op = op_map[op]
         
         # Check if expression is immediate
-        if expr.is_immediate:
-            code.append(f"{base_op} #{expr.value}")
+        chain = reduced_code(base_op, expr_tree.value, codegen) if is_immediate else None
+        if chain is not None:
+            # Shifts and additions instead of the multiplication or division routine
+            code.extend(chain)
+        elif is_immediate:
+            code.append(Instr(base_op, IMMEDIATE, expr_tree.value))
         else:
+            expr_code = expr_tree.generate_code(codegen)[0]
             # For non-commutative operations (-, /, %), need special handling
             if op in ['-=', '/=', '%=']:
                 # Need to save expression result, then load variable, then operate
-                code = expr.code[:]
+                code = expr_code[:]
                 tmp = codegen.get_temp()
-                code.append(f"stax {tmp}")
-                code.append(f"ldax {var_name}")
-                code.append(f"{base_op} {tmp}")
+                code.append(Instr('stax', TEMP, tmp))
+                code.append(Instr('ldax', MEMORY, var_name))
+                code.append(Instr(base_op, TEMP, tmp))
             else:
                 # Commutative or operations that work correctly
-                is_simple_var = (len(expr.code) == 1 and 
-                                expr.code[0].startswith('ldax ') and 
-                                not expr.code[0].startswith('ldax #'))
+                is_simple_var = len(expr_code) == 1 and expr_code[0].is_simple_load
                 
                 if is_simple_var:
-                    var_ref = expr.code[0].split()[1]
-                    code.append(f"{base_op} {var_ref}")
+                    code.append(as_operand(expr_code[0], base_op))
                 else:
                     # Complex expression - need temp
-                    code.extend(expr.code)
+                    code.extend(expr_code)
                     tmp = codegen.get_temp()
-                    code.append(f"stax {tmp}")
-                    code.append(f"ldax {var_name}")
-                    code.append(f"{base_op} {tmp}")
+                    code.append(Instr('stax', TEMP, tmp))
+                    code.append(Instr('ldax', MEMORY, var_name))
+                    code.append(Instr(base_op, TEMP, tmp))
     
     # Store result back to variable
-    code.append(f"stax {var_name}")
+    code.append(Instr('stax', MEMORY, var_name))
     
-    p[0] = code
     codegen.reset_temps()
+    return code
 
-def p_expression_binop(p):
-    """expression : expression PLUS shift_expr
-                  | expression MINUS shift_expr"""
-    left = p[1]
-    right = p[3]
-    
-    # Constant folding: if both operands are constants, evaluate at compile time
-    if left.is_immediate and right.is_immediate:
-        if p[2] == '+':
-            result = (left.value + right.value) & 0xFFFF
-        else:  # '-'
-            result = (left.value - right.value) & 0xFFFF
-        tree = ExprNode('const', value=result)
-        p[0] = Expression([f"ldax #{result}"], is_immediate=True, value=result, tree=tree)
-        return
-    
-    # Merge register usage flags
-    uses_ax = left.uses_ax or right.uses_ax
-    uses_a = left.uses_a or right.uses_a
-    uses_x = left.uses_x or right.uses_x
-    uses_y = left.uses_y or right.uses_y
-    
-    # Build expression tree
-    op_name = 'addax' if p[2] == '+' else 'subax'
-    is_comm = (p[2] == '+')  # Only addition is commutative
+# ============================================================================
+# GRAMMAR RULES
+# ============================================================================
+
+def p_statement_let(p):
+    """statement : LET VARIABLE EQUAL expression"""
+    p[0] = assign_variable(p[2], p[4].tree)
+
+def p_statement_let_register_ax(p):
+    """statement : LET REG_AX EQUAL expression"""
+    p[0] = assign_register('ax', p[4].tree)
+
+def p_statement_let_register_a(p):
+    """statement : LET REG_A EQUAL expression"""
+    p[0] = assign_register('a', p[4].tree)
+
+def p_statement_let_register_x(p):
+    """statement : LET REG_X EQUAL expression"""
+    p[0] = assign_register('x', p[4].tree)
+
+def p_statement_let_register_y(p):
+    """statement : LET REG_Y EQUAL expression"""
+    p[0] = assign_register('y', p[4].tree)
+
+def p_statement_compound(p):
+    """statement : LET VARIABLE PLUSEQ expression
+                 | LET VARIABLE MINUSEQ expression
+                 | LET VARIABLE TIMESEQ expression
+                 | LET VARIABLE DIVEQ expression
+                 | LET VARIABLE MODEQ expression
+                 | LET VARIABLE ANDEQ expression
+                 | LET VARIABLE OREQ expression
+                 | LET VARIABLE XOREQ expression
+                 | LET VARIABLE LSHIFTEQ expression
+                 | LET VARIABLE RSHIFTEQ expression"""
+    p[0] = compound_assignment(p[2], p[3], p[4].tree)
+
+def p_expression_binop(p):
+    """expression : expression PLUS shift_expr
+                  | expression MINUS shift_expr"""
+    codegen = current_codegen()
+    left = p[1]
+    right = p[3]
+    
+    # Constant folding: if both operands are constants, evaluate at compile time
+    if left.is_immediate and right.is_immediate:
+        result = fold_binary(p[2], left.value, right.value)
+        tree = ExprNode('const', value=result)
+        p[0] = Expression([Instr('ldax', IMMEDIATE, result)], is_immediate=True, value=result, tree=tree)
+        return
+    
+    # Merge register usage flags
+    uses_ax = left.uses_ax or right.uses_ax
+    uses_a = left.uses_a or right.uses_a
+    uses_x = left.uses_x or right.uses_x
+    uses_y = left.uses_y or right.uses_y
+    
+    # Build expression tree
+    op_name = 'addax' if p[2] == '+' else 'subax'
+    is_comm = (p[2] == '+')  # Only addition is commutative
     
     if left.tree and right.tree:
         tree = ExprNode('binop', op=op_name, children=[left.tree, right.tree], is_commutative=is_comm)
-        tree.uses_ax = uses_ax
-        tree.uses_a = uses_a
-        tree.uses_x = uses_x
-        tree.uses_y = uses_y
     else:
         tree = None
     
     # Generate code (will be optimized by bruteforce optimizer later)
     if right.is_immediate:
         op = "addax" if p[2] == '+' else "subax"
-        p[0] = Expression(left.code + [f"{op} #{right.value}"], 
+        p[0] = Expression(left.code + [Instr(op, IMMEDIATE, right.value)], 
                          uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
     else:
-        is_simple_var = (len(right.code) == 1 and 
-                        right.code[0].startswith('ldax ') and 
-                        not right.code[0].startswith('ldax #'))
+        is_simple_var = len(right.code) == 1 and right.code[0].is_simple_load
         
         if is_simple_var:
-            var_name = right.code[0].split()[1]
             op = "addax" if p[2] == '+' else "subax"
-            p[0] = Expression(left.code + [f"{op} {var_name}"], 
+            p[0] = Expression(left.code + [as_operand(right.code[0], op)], 
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
         elif p[2] == '-':
             tmp = codegen.get_temp()
-            p[0] = Expression(right.code + [f"stax {tmp}"] + 
-                             left.code + [f"subax {tmp}"], 
+            p[0] = Expression(right.code + [Instr('stax', TEMP, tmp)] + 
+                             left.code + [Instr('subax', TEMP, tmp)], 
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
         else:
             tmp = codegen.get_temp()
-            p[0] = Expression(left.code + [f"stax {tmp}"] + 
-                             right.code + [f"addax {tmp}"], 
+            p[0] = Expression(left.code + [Instr('stax', TEMP, tmp)] + 
+                             right.code + [Instr('addax', TEMP, tmp)], 
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
 
 def p_expression_shift(p):
@@ -983,15 +1854,13 @@ def p_shift_binop(p):
     uses_y = left.uses_y or right.uses_y
     
     if not right.is_immediate:
-        print(f"Error: Shift operations only support immediate values", 
-              file=sys.stderr)
+        report(f"Error: Shift operations only support immediate values")
         p[0] = left
         return
     
     shift_amount = right.value
     if shift_amount < 0 or shift_amount > 15:
-        print(f"Error: Shift amount must be between 0 and 15 (got {shift_amount})", 
-              file=sys.stderr)
+        report(f"Error: Shift amount must be between 0 and 15 (got {shift_amount})")
         p[0] = left
         return
     
@@ -1002,25 +1871,12 @@ def p_shift_binop(p):
         else:  # '>>'
             result = left.value >> shift_amount
         tree = ExprNode('const', value=result)
-        p[0] = Expression([f"ldax #{result}"], is_immediate=True, value=result, tree=tree)
+        p[0] = Expression([Instr('ldax', IMMEDIATE, result)], is_immediate=True, value=result, tree=tree)
         return
     
     shift_op = "aslax" if p[2] == '<<' else "lsrax"
-    code = left.code[:]
-    for _ in range(shift_amount):
-        code.append(shift_op)
-    
-    # Build tree for shift
-    if left.tree:
-        tree = ExprNode('unary', op=shift_op, children=[left.tree])
-        for _ in range(shift_amount - 1):
-            tree = ExprNode('unary', op=shift_op, children=[tree])
-        tree.uses_ax = uses_ax
-        tree.uses_a = uses_a
-        tree.uses_x = uses_x
-        tree.uses_y = uses_y
-    else:
-        tree = None
+    code = left.code + shift_code(shift_op, shift_amount)
+    tree = shift_tree(shift_op, left.tree, shift_amount) if left.tree else None
     
     p[0] = Expression(code, uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
 
@@ -1030,14 +1886,15 @@ def p_shift_and(p):
 
 def p_and_binop(p):
     """and_expr : and_expr AND xor_expr"""
+    codegen = current_codegen()
     left = p[1]
     right = p[3]
     
     # Constant folding: if both operands are constants, evaluate at compile time
     if left.is_immediate and right.is_immediate:
-        result = left.value & right.value
+        result = fold_binary(p[2], left.value, right.value)
         tree = ExprNode('const', value=result)
-        p[0] = Expression([f"ldax #{result}"], is_immediate=True, value=result, tree=tree)
+        p[0] = Expression([Instr('ldax', IMMEDIATE, result)], is_immediate=True, value=result, tree=tree)
         return
     
     # Merge register usage flags
@@ -1049,28 +1906,21 @@ def p_and_binop(p):
     # Build expression tree (AND is commutative)
     if left.tree and right.tree:
         tree = ExprNode('binop', op='andax', children=[left.tree, right.tree], is_commutative=True)
-        tree.uses_ax = uses_ax
-        tree.uses_a = uses_a
-        tree.uses_x = uses_x
-        tree.uses_y = uses_y
     else:
         tree = None
     
     if right.is_immediate:
-        p[0] = Expression(left.code + [f"andax #{right.value}"],
+        p[0] = Expression(left.code + [Instr('andax', IMMEDIATE, right.value)],
                          uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
     else:
-        is_simple_var = (len(right.code) == 1 and 
-                        right.code[0].startswith('ldax ') and 
-                        not right.code[0].startswith('ldax #'))
+        is_simple_var = len(right.code) == 1 and right.code[0].is_simple_load
         if is_simple_var:
-            var_name = right.code[0].split()[1]
-            p[0] = Expression(left.code + [f"andax {var_name}"],
+            p[0] = Expression(left.code + [as_operand(right.code[0], 'andax')],
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
         else:
             tmp = codegen.get_temp()
-            p[0] = Expression(left.code + [f"stax {tmp}"] + 
-                             right.code + [f"andax {tmp}"],
+            p[0] = Expression(left.code + [Instr('stax', TEMP, tmp)] + 
+                             right.code + [Instr('andax', TEMP, tmp)],
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
 
 def p_and_xor(p):
@@ -1079,14 +1929,15 @@ def p_and_xor(p):
 
 def p_xor_binop(p):
     """xor_expr : xor_expr XOR or_expr"""
+    codegen = current_codegen()
     left = p[1]
     right = p[3]
     
     # Constant folding: if both operands are constants, evaluate at compile time
     if left.is_immediate and right.is_immediate:
-        result = left.value ^ right.value
+        result = fold_binary(p[2], left.value, right.value)
         tree = ExprNode('const', value=result)
-        p[0] = Expression([f"ldax #{result}"], is_immediate=True, value=result, tree=tree)
+        p[0] = Expression([Instr('ldax', IMMEDIATE, result)], is_immediate=True, value=result, tree=tree)
         return
     
     # Merge register usage flags
@@ -1098,28 +1949,21 @@ def p_xor_binop(p):
     # Build expression tree (XOR is commutative)
     if left.tree and right.tree:
         tree = ExprNode('binop', op='eorax', children=[left.tree, right.tree], is_commutative=True)
-        tree.uses_ax = uses_ax
-        tree.uses_a = uses_a
-        tree.uses_x = uses_x
-        tree.uses_y = uses_y
     else:
         tree = None
     
     if right.is_immediate:
-        p[0] = Expression(left.code + [f"eorax #{right.value}"],
+        p[0] = Expression(left.code + [Instr('eorax', IMMEDIATE, right.value)],
                          uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
     else:
-        is_simple_var = (len(right.code) == 1 and 
-                        right.code[0].startswith('ldax ') and 
-                        not right.code[0].startswith('ldax #'))
+        is_simple_var = len(right.code) == 1 and right.code[0].is_simple_load
         if is_simple_var:
-            var_name = right.code[0].split()[1]
-            p[0] = Expression(left.code + [f"eorax {var_name}"],
+            p[0] = Expression(left.code + [as_operand(right.code[0], 'eorax')],
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
         else:
             tmp = codegen.get_temp()
-            p[0] = Expression(left.code + [f"stax {tmp}"] + 
-                             right.code + [f"eorax {tmp}"],
+            p[0] = Expression(left.code + [Instr('stax', TEMP, tmp)] + 
+                             right.code + [Instr('eorax', TEMP, tmp)],
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
 
 def p_xor_or(p):
@@ -1128,14 +1972,15 @@ def p_xor_or(p):
 
 def p_or_binop(p):
     """or_expr : or_expr OR term"""
+    codegen = current_codegen()
     left = p[1]
     right = p[3]
     
     # Constant folding: if both operands are constants, evaluate at compile time
     if left.is_immediate and right.is_immediate:
-        result = left.value | right.value
+        result = fold_binary(p[2], left.value, right.value)
         tree = ExprNode('const', value=result)
-        p[0] = Expression([f"ldax #{result}"], is_immediate=True, value=result, tree=tree)
+        p[0] = Expression([Instr('ldax', IMMEDIATE, result)], is_immediate=True, value=result, tree=tree)
         return
     
     # Merge register usage flags
@@ -1147,28 +1992,21 @@ def p_or_binop(p):
     # Build expression tree (OR is commutative)
     if left.tree and right.tree:
         tree = ExprNode('binop', op='orax', children=[left.tree, right.tree], is_commutative=True)
-        tree.uses_ax = uses_ax
-        tree.uses_a = uses_a
-        tree.uses_x = uses_x
-        tree.uses_y = uses_y
     else:
         tree = None
     
     if right.is_immediate:
-        p[0] = Expression(left.code + [f"orax #{right.value}"],
+        p[0] = Expression(left.code + [Instr('orax', IMMEDIATE, right.value)],
                          uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
     else:
-        is_simple_var = (len(right.code) == 1 and 
-                        right.code[0].startswith('ldax ') and 
-                        not right.code[0].startswith('ldax #'))
+        is_simple_var = len(right.code) == 1 and right.code[0].is_simple_load
         if is_simple_var:
-            var_name = right.code[0].split()[1]
-            p[0] = Expression(left.code + [f"orax {var_name}"],
+            p[0] = Expression(left.code + [as_operand(right.code[0], 'orax')],
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
         else:
             tmp = codegen.get_temp()
-            p[0] = Expression(left.code + [f"stax {tmp}"] + 
-                             right.code + [f"orax {tmp}"],
+            p[0] = Expression(left.code + [Instr('stax', TEMP, tmp)] + 
+                             right.code + [Instr('orax', TEMP, tmp)],
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
 
 def p_or_term(p):
@@ -1179,27 +2017,15 @@ def p_term_binop(p):
     """term : term TIMES factor
             | term DIVIDE factor
             | term MODULO factor"""
+    codegen = current_codegen()
     left = p[1]
     right = p[3]
     
     # Constant folding: if both operands are constants, evaluate at compile time
     if left.is_immediate and right.is_immediate:
-        if p[2] == '*':
-            result = (left.value * right.value) & 0xFFFF
-        elif p[2] == '/':
-            if right.value == 0:
-                print(f"Error: Division by zero", file=sys.stderr)
-                result = 0
-            else:
-                result = left.value // right.value
-        else:  # '%'
-            if right.value == 0:
-                print(f"Error: Modulo by zero", file=sys.stderr)
-                result = 0
-            else:
-                result = left.value % right.value
+        result = fold_binary(p[2], left.value, right.value)
         tree = ExprNode('const', value=result)
-        p[0] = Expression([f"ldax #{result}"], is_immediate=True, value=result, tree=tree)
+        p[0] = Expression([Instr('ldax', IMMEDIATE, result)], is_immediate=True, value=result, tree=tree)
         return
     
     # Merge register usage flags
@@ -1215,34 +2041,27 @@ def p_term_binop(p):
     is_comm = (p[2] == '*')
     if left.tree and right.tree:
         tree = ExprNode('binop', op=op, children=[left.tree, right.tree], is_commutative=is_comm)
-        tree.uses_ax = uses_ax
-        tree.uses_a = uses_a
-        tree.uses_x = uses_x
-        tree.uses_y = uses_y
     else:
         tree = None
     
     if right.is_immediate:
-        p[0] = Expression(left.code + [f"{op} #{right.value}"],
+        p[0] = Expression(left.code + [Instr(op, IMMEDIATE, right.value)],
                          uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
     else:
-        is_simple_var = (len(right.code) == 1 and 
-                        right.code[0].startswith('ldax ') and 
-                        not right.code[0].startswith('ldax #'))
+        is_simple_var = len(right.code) == 1 and right.code[0].is_simple_load
         
         if is_simple_var:
-            var_name = right.code[0].split()[1]
-            p[0] = Expression(left.code + [f"{op} {var_name}"],
+            p[0] = Expression(left.code + [as_operand(right.code[0], op)],
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
         elif p[2] in ['/', '%']:
             tmp = codegen.get_temp()
-            p[0] = Expression(right.code + [f"stax {tmp}"] + 
-                             left.code + [f"{op} {tmp}"],
+            p[0] = Expression(right.code + [Instr('stax', TEMP, tmp)] + 
+                             left.code + [Instr(op, TEMP, tmp)],
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
         else:
             tmp = codegen.get_temp()
-            p[0] = Expression(left.code + [f"stax {tmp}"] + 
-                             right.code + [f"{op} {tmp}"],
+            p[0] = Expression(left.code + [Instr('stax', TEMP, tmp)] + 
+                             right.code + [Instr(op, TEMP, tmp)],
                              uses_ax=uses_ax, uses_a=uses_a, uses_x=uses_x, uses_y=uses_y, tree=tree)
 
 def p_term_factor(p):
@@ -1252,39 +2071,36 @@ def p_term_factor(p):
 def p_factor_number(p):
     """factor : NUMBER"""
     tree = ExprNode('const', value=p[1])
-    p[0] = Expression([f"ldax #{p[1]}"], is_immediate=True, value=p[1], tree=tree)
+    p[0] = Expression([Instr('ldax', IMMEDIATE, p[1])], is_immediate=True, value=p[1], tree=tree)
 
 def p_factor_variable(p):
     """factor : VARIABLE"""
+    codegen = current_codegen()
     codegen.reference_variable(p[1])
     tree = ExprNode('var', value=p[1])
-    p[0] = Expression([f"ldax {p[1]}"], tree=tree)
+    p[0] = Expression([Instr('ldax', MEMORY, p[1])], tree=tree)
 
 def p_factor_register_ax(p):
     """factor : REG_AX"""
     tree = ExprNode('reg', value='ax')
-    tree.uses_ax = True
-    p[0] = Expression(["restore AX"], uses_ax=True, tree=tree)
+    p[0] = Expression([Instr('restore', ARGS, 'AX')], uses_ax=True, tree=tree)
 
 def p_factor_register_a(p):
     """factor : REG_A"""
     tree = ExprNode('reg', value='a')
-    tree.uses_a = True
-    p[0] = Expression(["restore A", "ldx #0"], uses_a=True, tree=tree)
+    p[0] = Expression([Instr('restore', ARGS, 'A'), Instr('ldx', IMMEDIATE, 0)], uses_a=True, tree=tree)
 
 def p_factor_register_x(p):
     """factor : REG_X"""
     tree = ExprNode('reg', value='x')
-    tree.uses_x = True
     # Use new restore X,to,A pattern
-    p[0] = Expression(["restore X,to,A", "ldx #0"], uses_x=True, tree=tree)
+    p[0] = Expression([Instr('restore', ARGS, 'X,to,A'), Instr('ldx', IMMEDIATE, 0)], uses_x=True, tree=tree)
 
 def p_factor_register_y(p):
     """factor : REG_Y"""
     tree = ExprNode('reg', value='y')
-    tree.uses_y = True
     # Use new restore Y,to,A pattern
-    p[0] = Expression(["restore Y,to,A", "ldx #0"], uses_y=True, tree=tree)
+    p[0] = Expression([Instr('restore', ARGS, 'Y,to,A'), Instr('ldx', IMMEDIATE, 0)], uses_y=True, tree=tree)
 
 def p_factor_peek(p):
     """factor : PEEK LPAREN expression RPAREN
@@ -1294,44 +2110,34 @@ def p_factor_peek(p):
     # Build expression tree for peek
     if addr_expr.tree:
         tree = ExprNode('peek', children=[addr_expr.tree])
-        tree.uses_ax = addr_expr.uses_ax
-        tree.uses_a = addr_expr.uses_a
-        tree.uses_x = addr_expr.uses_x
-        tree.uses_y = addr_expr.uses_y
     else:
         tree = None
     
     # Check if it's a simple constant/variable or complex expression
     is_simple = (addr_expr.is_immediate or 
-                 (len(addr_expr.code) == 1 and 
-                  addr_expr.code[0].startswith('ldax ') and 
-                  not addr_expr.code[0].startswith('ldax #')))
+                 (len(addr_expr.code) == 1 and addr_expr.code[0].is_simple_load))
     
     if is_simple:
         # Simple address - use direct peek
-        if addr_expr.is_immediate:
-            addr = f"#{addr_expr.value}"
-        else:
-            # Extract variable name from "ldax variable"
-            addr = addr_expr.code[0].split()[1]
+        addr = addr_expr.code[0]
         
         if len(p) == 5:
             # peek(addr) - result in A, extend to AX
-            code = [f"peek {addr}"]
+            code = [as_operand(addr, 'peek')]
         else:
             # peek(addr, reg) - specified register
             reg = p[5]
-            code = [f"peek {addr},{reg}"]
+            code = [Instr('peek', ARGS, f"{addr.operand_text()},{reg}")]
     else:
         # Complex expression - address in AX
         code = addr_expr.code[:]
         if len(p) == 5:
             # peek(ax) - result in A
-            code.append("peek ax")
+            code.append(Instr('peek', ARGS, 'ax'))
         else:
             # peek(ax, reg)
             reg = p[5]
-            code.append(f"peek ax,{reg}")
+            code.append(Instr('peek', ARGS, f"ax,{reg}"))
     
     # Propagate register usage flags from address expression
     p[0] = Expression(code, 
@@ -1348,33 +2154,21 @@ def p_factor_peekw(p):
     # Build expression tree for peekw
     if addr_expr.tree:
         tree = ExprNode('peekw', children=[addr_expr.tree])
-        tree.uses_ax = addr_expr.uses_ax
-        tree.uses_a = addr_expr.uses_a
-        tree.uses_x = addr_expr.uses_x
-        tree.uses_y = addr_expr.uses_y
     else:
         tree = None
     
     # Check if it's a simple constant/variable or complex expression
     is_simple = (addr_expr.is_immediate or 
-                 (len(addr_expr.code) == 1 and 
-                  addr_expr.code[0].startswith('ldax ') and 
-                  not addr_expr.code[0].startswith('ldax #')))
+                 (len(addr_expr.code) == 1 and addr_expr.code[0].is_simple_load))
     
     if is_simple:
         # Simple address - use direct peekw
-        if addr_expr.is_immediate:
-            addr = f"#{addr_expr.value}"
-        else:
-            # Extract variable name from "ldax variable"
-            addr = addr_expr.code[0].split()[1]
-        
         # peekw returns 16-bit value in AX directly
-        code = [f"peekw {addr}"]
+        code = [as_operand(addr_expr.code[0], 'peekw')]
     else:
         # Complex expression - address in AX
         code = addr_expr.code[:]
-        code.append("peekw ax")
+        code.append(Instr('peekw', ARGS, 'ax'))
     
     # Propagate register usage flags from address expression
     p[0] = Expression(code,
@@ -1391,16 +2185,12 @@ def p_factor_abs(p):
     # Build expression tree for abs
     if expr.tree:
         tree = ExprNode('abs', children=[expr.tree])
-        tree.uses_ax = expr.uses_ax
-        tree.uses_a = expr.uses_a
-        tree.uses_x = expr.uses_x
-        tree.uses_y = expr.uses_y
     else:
         tree = None
     
     # ABS always operates on AX and returns result in AX
     code = expr.code[:]
-    code.append("absax")
+    code.append(Instr('absax'))
     
     # Propagate register usage flags from input expression
     p[0] = Expression(code,
@@ -1416,355 +2206,1300 @@ def p_factor_paren(p):
 
 def p_error(p):
     if p:
-        print(f"Syntax error at '{p.value}'", file=sys.stderr)
+        report(f"Syntax error at '{p.value}'")
     else:
-        print("Syntax error at EOF", file=sys.stderr)
+        report("Syntax error at EOF")
 
 # ============================================================================
-# COMPILATION FUNCTIONS
+# FAST PARSER
 # ============================================================================
 
-def optimize_code(lines):
-    """Post-optimizer to remove redundant store/restore pairs and temp variable pairs"""
-    result = []
-    i = 0
-    removed_count = 0
+# Binding power of the binary operators, loosest first. It follows the layers
+# of the grammar rules (expression, shift_expr, and_expr, xor_expr, or_expr,
+# term), which is what decides the PLY parse; the grammar has no conflicts,
+# so the precedence table is never consulted.
+BINDING_POWER = {
+    'PLUS': 1, 'MINUS': 1,
+    'LSHIFT': 2, 'RSHIFT': 2,
+    'AND': 3,
+    'XOR': 4,
+    'OR': 5,
+    'TIMES': 6, 'DIVIDE': 6, 'MODULO': 6,
+}
+
+# Tokens that may follow a complete factor
+FACTOR_FOLLOW = set(BINDING_POWER) | {'RPAREN', 'COMMA', None}
+
+COMPOUND_OPS = ('PLUSEQ', 'MINUSEQ', 'TIMESEQ', 'DIVEQ', 'MODEQ',
+                'ANDEQ', 'OREQ', 'XOREQ', 'LSHIFTEQ', 'RSHIFTEQ')
+
+REGISTER_TOKENS = {'REG_AX': 'ax', 'REG_A': 'a', 'REG_X': 'x', 'REG_Y': 'y'}
+
+class FastToken:
+    """A token of the fast lexer, with the attributes the t_* rules use"""
+    __slots__ = ('type', 'value', 'lineno', 'lexpos', 'lexer')
+    
+    def __repr__(self):
+        return f"FastToken({self.type},{self.value!r},{self.lineno},{self.lexpos})"
+
+class FastLexer:
+    """
+    Pure Python lexer running the t_* token rules without PLY.
     
-    # Convert strings to list if needed
-    if isinstance(lines, str):
-        lines = lines.split('\n')
+    The rules are tried in PLY's order: function rules in the order they are
+    defined, then string rules by decreasing regex length, and the function
+    rules are called to convert token values and types.
+    """
     
-    # First pass: Remove unnecessary store/restore pairs
-    while i < len(lines):
-        line = lines[i].strip() if isinstance(lines[i], str) else lines[i]
+    def __init__(self):
+        functions = []
+        strings = []
+        for name, rule in globals().items():
+            if not name.startswith('t_') or name in ('t_ignore', 't_error'):
+                continue
+            if callable(rule):
+                functions.append((name, rule.__doc__, rule))
+            else:
+                strings.append((name, rule, None))
+        functions.sort(key=lambda entry: entry[2].__code__.co_firstlineno)
+        strings.sort(key=lambda entry: len(entry[1]), reverse=True)
         
-        # Optimize 8-bit constant loading for single registers
-        # Pattern: ldax #N / tax → ldx #N (for 8-bit constants)
-        if i + 1 < len(lines):
-            next_line = lines[i + 1].strip() if isinstance(lines[i + 1], str) else lines[i + 1]
-            
-            if line.startswith("ldax #") and next_line == "tax":
-                try:
-                    value = int(line.split('#')[1])
-                    if 0 <= value <= 255:
-                        # 8-bit constant - use ldx directly
-                        result.append(f"ldx #{value}\n")
-                        i += 2
-                        removed_count += 1
-                        continue
-                except:
-                    pass
-            
-            # Pattern: ldax #N / tay → ldy #N (for 8-bit constants)
-            if line.startswith("ldax #") and next_line == "tay":
-                try:
-                    value = int(line.split('#')[1])
-                    if 0 <= value <= 255:
-                        # 8-bit constant - use ldy directly
-                        result.append(f"ldy #{value}\n")
-                        i += 2
-                        removed_count += 1
-                        continue
-                except:
-                    pass
-            
-            # Pattern: ldx #0 / tax → tax (ldx #0 is superfluous before tax)
-            if line == "ldx #0" and next_line == "tax":
-                result.append("tax\n")
-                i += 2
-                removed_count += 1
+        rules = functions + strings
+        self.master = re.compile('|'.join(f"(?P<{name}>{regex})" for name, regex, _ in rules),
+                                 re.VERBOSE)
+        self.actions = {name: (name[2:], action) for name, _, action in rules}
+        self.ignore = t_ignore
+        self.lineno = 1
+        self.input("")
+    
+    def input(self, data):
+        """Start tokenizing a new string"""
+        self.lexdata = data
+        self.lexpos = 0
+    
+    def skip(self, n):
+        """Skip n characters, used by t_error"""
+        self.lexpos += n
+    
+    def token(self):
+        """Return the next token, or None at the end of the input"""
+        data = self.lexdata
+        while self.lexpos < len(data):
+            if data[self.lexpos] in self.ignore:
+                self.lexpos += 1
                 continue
             
-            # Pattern: ldx #0 / tay → tay (ldx #0 is superfluous before tay)
-            if line == "ldx #0" and next_line == "tay":
-                result.append("tay\n")
-                i += 2
-                removed_count += 1
+            tok = FastToken()
+            tok.lineno = self.lineno
+            tok.lexpos = self.lexpos
+            tok.lexer = self
+            match = self.master.match(data, self.lexpos)
+            if match is None:
+                tok.type = 'error'
+                tok.value = data[self.lexpos:]
+                t_error(tok)
+                if self.lexpos == tok.lexpos:
+                    raise SyntaxError(f"Illegal character '{data[self.lexpos]}'")
                 continue
-        
-        # Check for store followed by restore with intervening instructions
-        if line in ["store AX", "store A", "store X", "store Y"]:
-            reg = line.split()[1]
-            
-            # Look for matching restore
-            restore_idx = -1
-            restore_line = None
-            for j in range(i + 1, len(lines)):
-                check_line = lines[j].strip() if isinstance(lines[j], str) else lines[j]
-                
-                # Found matching restore (including restore X,to,A patterns)
-                if check_line == f"restore {reg}" or check_line.startswith(f"restore {reg},"):
-                    restore_idx = j
-                    restore_line = check_line
-                    break
-                
-                # Stop if register is used (restored earlier or modified)
-                if check_line.startswith(f"restore {reg}"):
-                    break
-                
-                # Check if intervening instruction modifies or uses the register
-                # If only other stores happen, we can potentially optimize
-                if not check_line.startswith("store ") and check_line:
-                    # Something else happens - can't eliminate
-                    break
             
-            # Check if we can optimize this store/restore pair
-            if restore_idx != -1:
-                # Check if only stores happen between
-                only_stores = True
-                for j in range(i + 1, restore_idx):
-                    check_line = lines[j].strip() if isinstance(lines[j], str) else lines[j]
-                    if check_line and not check_line.startswith("store "):
-                        only_stores = False
-                        break
-                
-                if only_stores:
-                    # Check what kind of restore it is
-                    is_restore_to_a = restore_line.startswith(f"restore {reg},to,")
-                    
-                    # Skip the store
-                    i += 1
-                    
-                    # Keep everything in between (other stores)
-                    while i < restore_idx:
-                        result.append(lines[i])
-                        i += 1
-                    
-                    # Handle the restore
-                    if is_restore_to_a:
-                        # restore X,to,A -> txa; restore Y,to,A -> tya
-                        if reg == "X":
-                            result.append("txa\n")
-                        elif reg == "Y":
-                            result.append("tya\n")
-                        elif reg == "A":
-                            # restore A,to,A is just nothing needed (value already in A)
-                            pass
-                        elif reg == "AX":
-                            # restore AX,to,A doesn't make sense, keep as-is
-                            result.append(restore_line)
-                    # For plain restore (not to,A), we just skip it entirely
-                    
-                    i += 1  # Skip restore
-                    removed_count += 1
+            tok.type, action = self.actions[match.lastgroup]
+            tok.value = match.group()
+            self.lexpos = match.end()
+            if action is not None:
+                tok = action(tok)
+                if tok is None:
                     continue
+            return tok
+        return None
+
+class FastSyntaxError(Exception):
+    """Raised by the fast parser at the first token that does not fit"""
+    
+    def __init__(self, token):
+        super().__init__(token)
+        self.token = token
+
+class FastParser:
+    """
+    Precedence-climbing parser for let statements.
+    
+    It accepts the same language as the grammar rules but builds only the
+    expression tree, without generating code for every reduction, and hands
+    the tree to the same statement code generation as the PLY actions.
+    parse() has the interface of the PLY parser, so it can be used in its
+    place.
+    """
+    
+    def parse(self, text, lexer=None):
+        """Parse and compile one statement, returns its code or None on a syntax error"""
+        self.lexer = lexer if lexer is not None else FastLexer()
+        self.lexer.input(text)
+        self.token = self.lexer.token()
+        self.errorcount = 0
+        while True:
+            try:
+                return self.parse_statement()
+            except FastSyntaxError as e:
+                # Recover like PLY without error rules: drop the offending
+                # token and start over, reporting no further errors until
+                # three tokens have been consumed
+                if self.errorcount == 0:
+                    p_error(e.token)
+                self.errorcount = 3
+                if e.token is None:
+                    return None
+                self.token = self.lexer.token()
+    
+    def next_type(self):
+        return self.token.type if self.token is not None else None
+    
+    def advance(self):
+        if self.errorcount:
+            self.errorcount -= 1
+        token = self.token
+        self.token = self.lexer.token()
+        return token
+    
+    def expect(self, token_type):
+        if self.next_type() != token_type:
+            raise FastSyntaxError(self.token)
+        return self.advance()
+    
+    def parse_statement(self):
+        self.expect('LET')
+        target = self.token
+        if self.next_type() == 'VARIABLE':
+            self.advance()
+            op = self.token
+            if self.next_type() == 'EQUAL':
+                self.advance()
+                tree = self.parse_complete_expression()
+                return assign_variable(target.value, tree)
+            if self.next_type() in COMPOUND_OPS:
+                self.advance()
+                tree = self.parse_complete_expression()
+                return compound_assignment(target.value, op.value, tree)
+            raise FastSyntaxError(self.token)
+        if self.next_type() in REGISTER_TOKENS:
+            self.advance()
+            self.expect('EQUAL')
+            tree = self.parse_complete_expression()
+            return assign_register(REGISTER_TOKENS[target.type], tree)
+        raise FastSyntaxError(self.token)
+    
+    def parse_complete_expression(self):
+        tree = self.parse_expression()
+        if self.token is not None:
+            raise FastSyntaxError(self.token)
+        return tree
+    
+    def parse_expression(self, min_power=1):
+        left = self.parse_factor()
+        while True:
+            power = BINDING_POWER.get(self.next_type())
+            if power is None or power < min_power:
+                return left
+            op = self.advance().value
+            right = self.parse_expression(power + 1)
+            if op in ('<<', '>>'):
+                left = self.combine_shift(op, left, right)
+            elif left.node_type == 'const' and right.node_type == 'const':
+                left = ExprNode('const', value=fold_binary(op, left.value, right.value))
+            else:
+                op_name, is_comm = BINARY_OPS[op]
+                left = ExprNode('binop', op=op_name, children=[left, right], is_commutative=is_comm)
+    
+    def combine_shift(self, op, left, right):
+        if right.node_type != 'const':
+            report(f"Error: Shift operations only support immediate values")
+            return left
         
-        # Check for store Y / restore Y with no mul16/div16/mod16 in between
-        if line == "store Y":
-            restore_idx = -1
-            restore_line = None
-            has_mul_div_mod = False
-            
-            for j in range(i + 1, len(lines)):
-                check_line = lines[j].strip() if isinstance(lines[j], str) else lines[j]
-                
-                if check_line == "restore Y" or check_line.startswith("restore Y,"):
-                    restore_idx = j
-                    restore_line = check_line
-                    break
-                
-                # Check for operations that clobber Y
-                if any(op in check_line for op in ["mul16", "div16", "mod16"]):
-                    has_mul_div_mod = True
-                    break
-            
-            # If no mul/div/mod between store Y and restore Y, eliminate store and optimize restore
-            if restore_idx != -1 and not has_mul_div_mod:
-                is_restore_to_a = restore_line.startswith("restore Y,to,")
-                
-                i += 1  # Skip store Y
-                while i < restore_idx:
-                    result.append(lines[i])
-                    i += 1
-                
-                # Handle the restore
-                if is_restore_to_a:
-                    result.append("tya\n")
-                # For plain restore Y, just skip it
-                
-                i += 1  # Skip restore Y
-                removed_count += 1
-                continue
+        shift_amount = right.value
+        if shift_amount < 0 or shift_amount > 15:
+            report(f"Error: Shift amount must be between 0 and 15 (got {shift_amount})")
+            return left
         
-        # Check for immediate store/restore patterns (no intervening code)
-        if i + 1 < len(lines):
-            next_line = lines[i + 1].strip() if isinstance(lines[i + 1], str) else lines[i + 1]
-            
-            # Pattern: store REG / restore REG or restore REG,to,A (adjacent)
-            matched = False
-            for reg in ["AX", "A", "X", "Y"]:
-                if line == f"store {reg}":
-                    if next_line == f"restore {reg}":
-                        # Plain restore - just skip both
-                        i += 2
-                        removed_count += 1
-                        matched = True
-                        break
-                    elif next_line.startswith(f"restore {reg},to,"):
-                        # restore to A - replace with transfer
-                        if reg == "X":
-                            result.append("txa\n")
-                        elif reg == "Y":
-                            result.append("tya\n")
-                        # For A and AX, the value is already where we need it
-                        i += 2
-                        removed_count += 1
-                        matched = True
-                        break
-            
-            if matched:
-                continue
-            
-            # Pattern: stax tempN / ldax tempN (check if temp not used elsewhere)
-            if line.startswith("stax tmp") and next_line.startswith("ldax tmp"):
-                stax_tmp = line.split()[1]
-                ldax_tmp = next_line.split()[1]
-                if stax_tmp == ldax_tmp:
-                    # Check if this temp is used anywhere else in remaining code
-                    temp_used_elsewhere = False
-                    for j in range(i + 2, len(lines)):
-                        line_to_check = lines[j] if isinstance(lines[j], str) else lines[j]
-                        if stax_tmp in line_to_check:
-                            temp_used_elsewhere = True
-                            break
-                    
-                    if not temp_used_elsewhere:
-                        # Skip both lines - the value is already in AX
-                        i += 2
-                        removed_count += 1
-                        continue
+        if left.node_type == 'const':
+            if op == '<<':
+                return ExprNode('const', value=(left.value << shift_amount) & 0xFFFF)
+            return ExprNode('const', value=left.value >> shift_amount)
         
-        # Keep this line
-        result.append(lines[i])
-        i += 1
+        shift_op = "aslax" if op == '<<' else "lsrax"
+        return shift_tree(shift_op, left, shift_amount)
+    
+    def parse_factor(self):
+        codegen = current_codegen()
+        token = self.token
+        kind = self.next_type()
+        if kind == 'NUMBER':
+            self.advance()
+            tree = ExprNode('const', value=token.value)
+        elif kind == 'VARIABLE':
+            self.advance()
+            self.check_follow()
+            codegen.reference_variable(token.value)
+            return ExprNode('var', value=token.value)
+        elif kind in REGISTER_TOKENS:
+            self.advance()
+            tree = ExprNode('reg', value=REGISTER_TOKENS[kind])
+        elif kind in ('PEEK', 'PEEKW', 'ABS'):
+            self.advance()
+            self.expect('LPAREN')
+            operand = self.parse_expression()
+            if kind == 'PEEK' and self.next_type() == 'COMMA':
+                self.advance()
+                self.expect('VARIABLE')
+            self.expect('RPAREN')
+            tree = ExprNode(kind.lower(), children=[operand])
+        elif kind == 'LPAREN':
+            self.advance()
+            tree = self.parse_expression()
+            self.expect('RPAREN')
+        else:
+            raise FastSyntaxError(token)
+        self.check_follow()
+        return tree
+    
+    def check_follow(self):
+        # PLY reduces a factor only when it sees a token that may follow it,
+        # so variables are referenced and constants folded at the same points
+        if self.next_type() not in FACTOR_FOLLOW:
+            raise FastSyntaxError(self.token)
+
+# ============================================================================
+# PARSER ENGINE
+# ============================================================================
+
+# Lexer and parser per parser kind, shared by all files and includes
+# compiled in this process
+_parser_engines = {}
+
+def get_cache_dir():
+    """
+    Return the directory for persistent exprass caches.
     
-    # If we made changes, run again to catch any newly exposed optimizations
-    if removed_count > 0:
-        result, additional_removed = optimize_code(result)
-        removed_count += additional_removed
+    EXPRASS_CACHE_DIR overrides the default, which is the per-user cache
+    directory (LOCALAPPDATA on Windows, XDG_CACHE_HOME or ~/.cache elsewhere).
+    """
+    override = os.environ.get('EXPRASS_CACHE_DIR')
+    if override:
+        return Path(override)
+    base = os.environ.get('LOCALAPPDATA') or os.environ.get('XDG_CACHE_HOME')
+    if base:
+        return Path(base) / 'exprass'
+    return Path.home() / '.cache' / 'exprass'
+
+def build_parser():
+    """
+    Build the LALR parser, reusing the parse tables cached on disk.
     
-    return result, removed_count
+    The table file is keyed by the exprass version, PLY additionally checks
+    the grammar signature and regenerates stale tables. If the cache
+    directory is not writable, the tables are built in memory.
+    """
+    import ply.yacc as yacc
+    try:
+        cache_dir = get_cache_dir()
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        table_file = cache_dir / f"parsetab-{__version__}.pickle"
+        if table_file.exists():
+            return yacc.yacc(debug=False, picklefile=str(table_file))
+        # Let PLY write to a private file first so that concurrent runs
+        # never read a partially written table
+        tmp_file = cache_dir / f"parsetab-{__version__}.{os.getpid()}.tmp"
+        parser = yacc.yacc(debug=False, picklefile=str(tmp_file))
+        os.replace(tmp_file, table_file)
+        return parser
+    except Exception:
+        return yacc.yacc(debug=False, write_tables=False)
 
-def renumber_temp_variables(lines, temp_start=10, reuse_temps=True):
+def ply_available():
+    """True if the ply package needed by --parser ply is installed"""
+    import importlib.util
+    return importlib.util.find_spec('ply') is not None
+
+def new_parser_engine(kind='fast'):
     """
-    Renumber temp variables in generated code.
+    Build a new (lexer, parser) pair for 'fast' or 'ply'. PLY is only
+    imported for the 'ply' engine.
+    """
+    if kind == 'ply':
+        import ply.lex as lex
+        return (lex.lex(), build_parser())
+    return (FastLexer(), FastParser())
+
+def get_parser_engine(kind='fast'):
+    """Return the process-wide (lexer, parser) pair for 'fast' or 'ply', building it on first use"""
+    if kind not in _parser_engines:
+        _parser_engines[kind] = new_parser_engine(kind)
+    return _parser_engines[kind]
+
+# ============================================================================
+# STATEMENT CACHE
+# ============================================================================
+
+# Size limit of the statement cache database contents in bytes
+STATEMENT_CACHE_LIMIT = 32 * 1024 * 1024
+
+# Number of new or used entries that are kept in memory before they are written
+STATEMENT_CACHE_BATCH = 1000
+
+# Cache shared by all files compiled in this process, False if it cannot be opened
+_statement_cache = None
+
+class StatementCache:
+    """
+    Persistent LRU cache of compiled let statements.
+    
+    Entries are stored in an SQLite database in the cache directory. The key
+    is the statement text with normalized whitespace plus everything else
+    the generated code depends on: the exprass version and source file, the
+    temp start, the search options, the optimization objective, whether
+    common subexpressions are shared, the number of zero page temps and
+    the values the statement loads from or stores to shared temps. The
+    value holds the optimized code block, the variables the statement
+    assigns and references, the optimizer count and the messages printed
+    while compiling it. The shared values planned for a run of let
+    statements are kept too, under a key with the texts of the run.
+    
+    New entries and use times are written in batches and when the cache is
+    closed, which also evicts the least recently used entries beyond the
+    size limit.
+    """
+    
+    def __init__(self, path, limit=STATEMENT_CACHE_LIMIT):
+        import sqlite3
+        # Compilers in several threads share the cache, serialized by the lock
+        self.db = sqlite3.connect(str(path), timeout=10, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("CREATE TABLE IF NOT EXISTS statements ("
+                        "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                        "size INTEGER NOT NULL, used REAL NOT NULL)")
+        self.limit = limit
+        self.pending = {}  # New entries, written on close
+        self.used = set()  # Keys of entries read from the database
+        # Size and time stamp of this file, so that edits to the compiler
+        # without a version change don't return stale code
+        source = os.stat(__file__)
+        self.stamp = f"{__version__}:{source.st_size}:{source.st_mtime_ns}"
+    
+    def make_key(self, line, codegen_instance):
+        """Cache key of a statement compiled by codegen_instance"""
+        import json
+        shared = [sorted((name, repr(node)) for node, name in names.items())
+                  for names in (codegen_instance.available, codegen_instance.publish)]
+        return json.dumps([self.stamp, codegen_instance.temp_start, codegen_instance.search,
+                           codegen_instance.budget, codegen_instance.optimize, codegen_instance.cse,
+                           codegen_instance.zp_temps, shared, ' '.join(line.split())])
+    
+    def make_plan_key(self, run, codegen_instance):
+        """Cache key of the shared values planned for a run, see plan_run"""
+        import json
+        texts = [[is_let, ' '.join(text.split()) if is_let else text] for is_let, text in run]
+        return json.dumps([self.stamp, 'plan', codegen_instance.temp_start, codegen_instance.optimize,
+                           codegen_instance.zp_temps, texts])
+    
+    def get(self, key):
+        """Return the cached entry for key, or None"""
+        import json
+        with self.lock:
+            value = self.pending.get(key)
+            if value is None:
+                row = self.db.execute("SELECT value FROM statements WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                value = row[0]
+                self.used.add(key)
+        if len(self.used) >= STATEMENT_CACHE_BATCH:
+            self.flush()
+        return json.loads(value)
+    
+    def put(self, key, entry):
+        """Add an entry, it is written to the database with the next batch"""
+        import json
+        value = json.dumps(entry, separators=(',', ':'))
+        with self.lock:
+            self.pending[key] = value
+        if len(self.pending) >= STATEMENT_CACHE_BATCH:
+            self.flush()
+    
+    def flush(self, evict=False):
+        """Write new entries and use times, optionally evicting old entries"""
+        now = time.time()
+        try:
+            with self.lock, self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO statements (key, value, size, used) VALUES (?, ?, ?, ?)",
+                    [(key, value, len(key) + len(value), now) for key, value in self.pending.items()])
+                self.db.executemany("UPDATE statements SET used = ? WHERE key = ?",
+                                    [(now, key) for key in self.used])
+                self.pending = {}
+                self.used = set()
+                if not evict:
+                    return
+                total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM statements").fetchone()[0]
+                if total > self.limit:
+                    # Evict down to 90% of the limit, so that not every run has to evict
+                    evicted = []
+                    for key, size in self.db.execute("SELECT key, size FROM statements ORDER BY used"):
+                        if total <= self.limit * 0.9:
+                            break
+                        evicted.append((key,))
+                        total -= size
+                    self.db.executemany("DELETE FROM statements WHERE key = ?", evicted)
+        except Exception:
+            # The cache is only an accelerator, losing entries is harmless
+            pass
+    
+    def close(self):
+        """Write new entries and use times, evict old entries and close the database"""
+        self.flush(evict=True)
+        with self.lock:
+            self.db.close()
+
+def get_statement_cache():
+    """Return the process-wide statement cache, opening it on first use, or None"""
+    global _statement_cache
+    if _statement_cache is None:
+        try:
+            cache_dir = get_cache_dir()
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            _statement_cache = StatementCache(cache_dir / "statements.sqlite")
+            import atexit
+            atexit.register(_statement_cache.close)
+        except Exception:
+            _statement_cache = False
+    return _statement_cache or None
+
+# ============================================================================
+# STATISTICS
+# ============================================================================
+
+# Compilation phases timed by --stats, each phase excludes the ones nested in it
+STAT_PHASES = ('lex', 'parse', 'search', 'optimize', 'renumber', 'emit')
+
+# Per-file records of this process for --stats
+file_stats = []
+
+class StatementProfile:
+    """
+    Timings and optimizer counts of one let statement, collected for --stats.
+
+    The code generator of the statement holds it as codegen.profile while
+    the statement is compiled. Phase times are in seconds. variants counts
+    the orderings the exhaustive search generated, or the operand orders
+    the fast search compared, and best and worst score are the extremes of
+    score_code among them. rules counts the peephole rules that fired,
+    including the runs on variants that were not chosen.
+    """
+
+    def __init__(self, line_num, text):
+        self.line_num = line_num
+        self.text = text
+        self.phases = dict.fromkeys(STAT_PHASES, 0.0)
+        self.variants = 0
+        self.pruned = 0
+        self.best_score = None
+        self.worst_score = None
+        self.rules = {}
+        self.temps = 0
+        self.lines_out = 0
+        self.cached = False
+        self.error = False
+
+    def add_score(self, score):
+        if self.best_score is None or score < self.best_score:
+            self.best_score = score
+        if self.worst_score is None or score > self.worst_score:
+            self.worst_score = score
+
+    def inner_time(self):
+        """Time of the phases that run inside the parser"""
+        return self.phases['lex'] + self.phases['search'] + self.phases['optimize']
+
+    def as_dict(self):
+        return {
+            'line': self.line_num,
+            'statement': self.text,
+            'wall_ms': round(sum(self.phases.values()) * 1000, 3),
+            'phases_ms': {phase: round(seconds * 1000, 3) for phase, seconds in self.phases.items()},
+            'variants': self.variants,
+            'pruned': self.pruned,
+            'best_score': self.best_score,
+            'worst_score': self.worst_score,
+            'rules': dict(sorted(self.rules.items())),
+            'temps': self.temps,
+            'lines_in': 1,
+            'lines_out': self.lines_out,
+            'cached': self.cached,
+            'error': self.error,
+        }
+
+class TimedLexer:
+    """Lexer wrapper that adds the time spent tokenizing to the statement profile"""
+
+    def __init__(self, lexer):
+        self.lexer = lexer
+
+    def input(self, data):
+        self.lexer.input(data)
+
+    def token(self):
+        start = time.perf_counter()
+        tok = self.lexer.token()
+        current_codegen().profile.phases['lex'] += time.perf_counter() - start
+        return tok
+
+def file_stats_record(input_file, output_file, stats, wall_time, is_include):
+    """The --stats record of a compiled file, from the stats of iter_compile_source"""
+    statements = [profile.as_dict() for profile in stats['statements']]
+    phases = dict.fromkeys(STAT_PHASES, 0.0)
+    for statement in statements:
+        for phase, ms in statement['phases_ms'].items():
+            phases[phase] += ms
+    return {
+        'file': input_file,
+        'output': output_file,
+        'include': is_include,
+        'wall_ms': round(wall_time * 1000, 3),
+        'phases_ms': {phase: round(ms, 3) for phase, ms in phases.items()},
+        'lines_in': stats['lines_in'],
+        'lines_out': stats['lines_out'],
+        'statements': len(statements),
+        'cached_statements': sum(statement['cached'] for statement in statements),
+        'errors': stats['errors'],
+        'temps': len(stats['temps']),
+        'variants': sum(statement['variants'] for statement in statements),
+        'statement_stats': statements,
+    }
+
+def write_stats(stats_file, records):
+    """Write the --stats JSON document for records to stats_file, '-' for stderr"""
+    import json
+    document = {'exprass': __version__, 'files': records}
+    text = json.dumps(document, indent=1) + "\n"
+    if stats_file == '-':
+        sys.stderr.write(text)
+    else:
+        Path(stats_file).write_text(text)
+
+# ============================================================================
+# COMMON SUBEXPRESSIONS
+# ============================================================================
+
+# Most let statements of one run that share values, the following start a
+# new run, so that the compiled blocks are not held back for long
+CSE_RUN_LIMIT = 32
+
+def plan_statement(line, lexer, parser):
+    """
+    Parse a let statement without generating code. Returns the
+    StatementPlanned with its target and expression tree, or None if the
+    statement has errors (they are reported when it is compiled).
+    """
+    import io
+    codegen = current_codegen()
+    outer_messages = getattr(_context, 'messages', None)
+    _context.messages = io.StringIO()
+    codegen.planning = True
+    try:
+        parser.parse(line, lexer=lexer)
+    except StatementPlanned as plan:
+        return plan
+    except Exception:
+        return None
+    finally:
+        codegen.planning = False
+        _context.messages = outer_messages
+    return None
+
+class CommonSubexpressions:
+    """
+    Decides which values a run of let statements shares through shared
+    temps (cseN). A value is shared when a later statement of the run
+    computes the same pure subtree while none of its variables was
+    assigned in between, and loading it scores better than computing it
+    again. The statement that computes it first stores it.
+    
+    Feed the lines of the run in order to statement() and assembly(), then
+    get the shared values of each statement from plans: (available,
+    publish) dicts of ExprNode -> shared temp name, as used by the
+    CodeGenerator.
+    """
+    
+    def __init__(self, lexer, parser, next_number):
+        codegen = current_codegen()
+        self.lexer = lexer
+        self.parser = parser
+        self.next_number = next_number  # Returns the number of the next shared temp
+        # Computes the values alone, for their score
+        self.scratch = CodeGenerator(temp_start=codegen.temp_start, search='fast',
+                                     optimize=codegen.optimize, cse=False, zp_temps=codegen.zp_temps)
+        self.scores = {}  # ExprNode -> score of computing it
+        self.live = {}  # Values computed so far: ExprNode -> index of the statement
+        self.names = {}  # Shared values: ExprNode -> shared temp name
+        self.plans = []
+    
+    def score(self, node):
+        """Score of the code that computes node on its own"""
+        score = self.scores.get(node)
+        if score is None:
+            scratch = self.scratch
+            scratch.temp_counter = scratch.temp_start
+            code = search_optimize(node, scratch)[0]
+            code = optimize_code(code, None, scratch.cost_model)[0]
+            score = self.scores[node] = scratch.cost_model.score_code(code)
+        return score
+    
+    def worth_sharing(self, node):
+        """Loading the value scores better than computing it again"""
+        cost_model = self.scratch.cost_model
+        load = cost_model.score(Instr('ldax', MEMORY, 'cse'))
+        if node not in self.names:
+            # The first statement stores it and loads it back
+            load += load + cost_model.score(Instr('stax', MEMORY, 'cse'))
+        return self.score(node) > load
+    
+    def statement(self, line):
+        """Plan the let statement line"""
+        index = len(self.plans)
+        available, publish = {}, {}
+        self.plans.append((available, publish))
+        plan = plan_statement(line, self.lexer, self.parser)
+        if plan is None:
+            return
+        if plan.tree is not None:
+            computed = []
+            stack = [plan.tree]
+            while stack:
+                node = stack.pop()
+                if not node.children or not node.is_pure:
+                    stack.extend(node.children)
+                    continue
+                publisher = self.live.get(node)
+                if publisher is not None and self.worth_sharing(node):
+                    name = self.names.get(node)
+                    if name is None:
+                        name = self.names[node] = shared_temp_name(self.next_number())
+                        self.plans[publisher][1][node] = name
+                    available[node] = name
+                    continue
+                computed.append(node)
+                stack.extend(node.children)
+            tree = plan.tree
+            if not (tree.uses_ax or tree.uses_a or tree.uses_x or tree.uses_y):
+                # Storing a value first would overwrite the registers the tree reads
+                for node in computed:
+                    self.live.setdefault(node, index)
+        if plan.target is not None:
+            self.kill(plan.target)
+    
+    def assembly(self, line):
+        """Account for a line of raw assembly code that is not a barrier"""
+        for var in detect_assembly_assignments(line):
+            self.kill(var)
+    
+    def kill(self, var):
+        """Forget the values that depend on var, which was assigned"""
+        for node in [node for node in self.live if var in node.variables()]:
+            del self.live[node]
+            self.names.pop(node, None)
+
+def plan_run(run, lexer, parser, next_number):
+    """
+    Plan the shared values of a run: a list of (is_let, text) with the let
+    statements and the raw assembly code between them, without comments.
+    Returns the (available, publish) of each let statement, see
+    CommonSubexpressions, with the shared temps numbered by next_number.
+    
+    The plan is kept in the statement cache, so an unchanged run is not
+    parsed again and its statements can be taken from the cache too.
+    """
+    import itertools
+    codegen = current_codegen()
+    cache = get_statement_cache() if codegen.use_cache else None
+    entry = None
+    if cache is not None:
+        key = cache.make_plan_key(run, codegen)
+        try:
+            entry = cache.get(key)
+        except Exception:
+            entry = None
+    if entry is None:
+        # The shared temps of the run are numbered from 1 here and renumbered below
+        numbers = itertools.count(1)
+        planner = CommonSubexpressions(lexer, parser, numbers.__next__)
+        for is_let, text in run:
+            if is_let:
+                planner.statement(text)
+            else:
+                planner.assembly(text)
+        entry = {
+            'count': next(numbers) - 1,
+            'plans': [[[[node.as_list(), int(SHARED_TEMP_PATTERN.match(name).group(1))]
+                        for node, name in names.items()] for names in plan]
+                      for plan in planner.plans],
+        }
+        if cache is not None:
+            cache.put(key, entry)
+    names = [shared_temp_name(next_number()) for _ in range(entry['count'])]
+    return [tuple({ExprNode.from_list(node): names[number - 1] for node, number in values}
+                  for values in plan)
+            for plan in entry['plans']]
+
+# ============================================================================
+# COMPILATION FUNCTIONS
+# ============================================================================
+
+# Temp variable references like tmp10, tmp11, etc.
+TEMP_PATTERN = re.compile(r'\btmp(\d+)\b')
+
+# Largest N for which addax #N / subax #N may become N incax / decax
+SMALL_STEP_LIMIT = 3
+
+# Returned by peephole rules that changed the code without removing an operation
+REWRITTEN = 'rewritten'
+
+class PeepholeOptimizer:
+    """
+    Worklist-driven peephole optimizer for one block of generated code.
+    
+    The instructions are kept in a doubly linked list and the rules are
+    indexed by the opcode of the instruction they start at. After a rewrite
+    only the neighbourhood of the change is revisited, plus the earlier
+    instructions whose rules scan forward across it (store ... restore,
+    stax tmpN with its later uses), so a block is no longer rescanned from
+    the start.
+    
+    Temp uses are answered from a def-use index that maps each temp number
+    to the instructions using it and is kept up to date as rules rewrite
+    the block. If fired is a dict, it counts how often each rule fired.
+    Rules that trade one form for another ask the cost model first.
+    """
+    
+    def __init__(self, code, fired=None, cost_model=None):
+        self.code = list(code)
+        self.fired = fired
+        self.cost_model = cost_model or COST_MODELS['balanced']
+        count = len(self.code)
+        self.next = list(range(1, count + 1))
+        self.prev = list(range(-1, count - 1))
+        if count:
+            self.next[-1] = None
+            self.prev[0] = None
+        self.alive = [True] * count
+        self.removed_count = 0
+        # store instructions look ahead for their restore
+        self.scanners = [i for i, instr in enumerate(code) if instr.opcode == 'store']
+        # Def-use index: temp number -> indices of the instructions using it, ascending
+        self.temp_refs = {}
+        for i, instr in enumerate(code):
+            if instr.mode in (TEMP, TEMP_HIGH):
+                self.temp_refs.setdefault(instr.operand, []).append(i)
+        # Only instructions that start a rule need a visit
+        self.worklist = [i for i, instr in enumerate(code) if instr.opcode in self.RULES]
+        self.queued = set(self.worklist)
+        self.inserted = False  # Instructions were linked in out of index order
+    
+    def replace(self, i, instr):
+        self.drop_temp_ref(i)
+        self.code[i] = instr
+        if instr.mode in (TEMP, TEMP_HIGH):
+            refs = self.temp_refs.setdefault(instr.operand, [])
+            refs.append(i)
+            refs.sort()
+    
+    def delete(self, i):
+        prev_i, next_i = self.prev[i], self.next[i]
+        if prev_i is not None:
+            self.next[prev_i] = next_i
+        if next_i is not None:
+            self.prev[next_i] = prev_i
+        self.alive[i] = False
+        self.drop_temp_ref(i)
+        return prev_i
+    
+    def insert_after(self, i, instr):
+        """Link a new instruction (without temp operand) in after instruction i"""
+        j = len(self.code)
+        self.inserted = True
+        self.code.append(instr)
+        self.alive.append(True)
+        self.prev.append(i)
+        self.next.append(self.next[i])
+        if self.next[i] is not None:
+            self.prev[self.next[i]] = j
+        self.next[i] = j
+        return j
+    
+    def drop_temp_ref(self, i):
+        """Remove instruction i from the def-use index and revisit the stores it kept alive"""
+        instr = self.code[i]
+        if instr.mode not in (TEMP, TEMP_HIGH):
+            return
+        refs = self.temp_refs[instr.operand]
+        refs.remove(i)
+        for ref in refs:
+            if ref < i and self.code[ref].opcode == 'stax':
+                self.enqueue(ref)
+    
+    def temp_used_after(self, temp, i):
+        """True if temp is used by any instruction after instruction i"""
+        refs = self.temp_refs.get(temp)
+        return bool(refs) and refs[-1] > i
+    
+    def enqueue(self, i):
+        if i is not None and self.alive[i] and i not in self.queued:
+            self.queued.add(i)
+            heapq.heappush(self.worklist, i)
+    
+    def touch(self, i):
+        """Revisit everything a change at instruction i may have enabled"""
+        self.enqueue(i)
+        if i is not None:
+            self.enqueue(self.prev[i])
+            for scanner in self.scanners:
+                if scanner < i:
+                    self.enqueue(scanner)
+    
+    def run(self):
+        if not self.worklist:
+            return self.code
+        while self.worklist:
+            i = heapq.heappop(self.worklist)
+            self.queued.discard(i)
+            if not self.alive[i]:
+                continue
+            for rule in self.RULES.get(self.code[i].opcode, ()):
+                result = rule(self, i)
+                if result:
+                    if result is not REWRITTEN:
+                        self.removed_count += 1
+                    if self.fired is not None:
+                        name = rule.__name__[5:]
+                        self.fired[name] = self.fired.get(name, 0) + 1
+                    break
+        if self.inserted:
+            # Follow the links from the first remaining instruction
+            i = next((i for i, alive in enumerate(self.alive) if alive and self.prev[i] is None), None)
+            result = []
+            while i is not None:
+                result.append(self.code[i])
+                i = self.next[i]
+            return result
+        return [instr for instr, alive in zip(self.code, self.alive) if alive]
+    
+    # ------------------------------------------------------------------------
+    # Rules: each gets the index of its first instruction, returns True if it
+    # fired and removed an operation, REWRITTEN if it only changed the form
+    # ------------------------------------------------------------------------
+    
+    def rule_load_transfer(self, i):
+        """ldax #N / tax -> ldx #N and ldax #N / tay -> ldy #N (8-bit N)"""
+        j = self.next[i]
+        if j is None or self.code[j].opcode not in ('tax', 'tay'):
+            return False
+        instr = self.code[i]
+        if instr.mode != IMMEDIATE or not isinstance(instr.operand, int) or not 0 <= instr.operand <= 255:
+            return False
+        register = 'x' if self.code[j].opcode == 'tax' else 'y'
+        self.replace(i, Instr(f"ld{register}", IMMEDIATE, instr.operand))
+        self.delete(j)
+        self.touch(i)
+        return True
+    
+    def rule_clear_x_transfer(self, i):
+        """ldx #0 / tax -> tax and ldx #0 / tay -> tay"""
+        j = self.next[i]
+        if self.code[i] != Instr('ldx', IMMEDIATE, 0) or j is None or self.code[j].opcode not in ('tax', 'tay'):
+            return False
+        self.touch(self.delete(i))
+        return True
+    
+    def finish_restore(self, i, restore, reg):
+        """Drop the store at i and turn the matching restore into a transfer"""
+        self.touch(self.delete(i))
+        if self.code[restore].operand.startswith(f"{reg},to,"):
+            # restore X,to,A -> txa; restore Y,to,A -> tya
+            if reg == 'X':
+                self.replace(restore, Instr('txa'))
+            elif reg == 'Y':
+                self.replace(restore, Instr('tya'))
+            elif reg == 'A':
+                # Value is already in A
+                self.delete(restore)
+            # restore AX,to,A doesn't make sense, keep as-is
+        else:
+            # Plain restore: the register still holds the value
+            self.delete(restore)
+        self.touch(restore if self.alive[restore] else self.prev[restore])
+    
+    def rule_store_restore(self, i):
+        """store REG followed by restore REG with only stores in between"""
+        reg = self.code[i].operand
+        if reg not in ('AX', 'A', 'X', 'Y'):
+            return False
+        j = self.next[i]
+        while j is not None:
+            check = self.code[j]
+            if check.opcode == 'restore':
+                if check.operand == reg or check.operand.startswith(f"{reg},"):
+                    self.finish_restore(i, j, reg)
+                    return True
+                # Register restored in another form
+                if check.operand.startswith(reg):
+                    return False
+            # Something else happens
+            if check.opcode != 'store':
+                return False
+            j = self.next[j]
+        return False
+    
+    def rule_store_y(self, i):
+        """store Y / restore Y with no mul16/div16/mod16 (which clobber Y) in between"""
+        if self.code[i].operand != 'Y':
+            return False
+        j = self.next[i]
+        while j is not None:
+            check = self.code[j]
+            if check.opcode == 'restore' and (check.operand == 'Y' or check.operand.startswith('Y,')):
+                self.finish_restore(i, j, 'Y')
+                return True
+            if check.opcode in ('mul16', 'div16', 'mod16'):
+                return False
+            j = self.next[j]
+        return False
+    
+    def rule_temp_roundtrip(self, i):
+        """stax tmpN / ldax tmpN where tmpN is not used afterwards"""
+        j = self.next[i]
+        instr = self.code[i]
+        if j is None or instr.mode != TEMP or self.code[j] != Instr('ldax', TEMP, instr.operand):
+            return False
+        if self.temp_used_after(instr.operand, j):
+            return False
+        self.delete(j)
+        self.touch(self.delete(i))
+        return True
+    
+    def rule_store_reload(self, i):
+        """stax tmpN / ldax tmpN -> stax tmpN, the same for shared temps (cseN)"""
+        j = self.next[i]
+        instr = self.code[i]
+        if j is None or self.code[j] != Instr('ldax', instr.mode, instr.operand):
+            return False
+        if instr.mode != TEMP and not (instr.mode == MEMORY and isinstance(instr.operand, str) and
+                                       SHARED_TEMP_PATTERN.fullmatch(instr.operand)):
+            return False
+        self.touch(self.delete(j))
+        return True
+    
+    def rule_small_step(self, i):
+        """addax #N / subax #N -> N times incax / decax, if the cost model prefers it"""
+        instr = self.code[i]
+        if instr.mode != IMMEDIATE or not isinstance(instr.operand, int):
+            return False
+        steps = instr.operand & 0xFFFF
+        if not 0 < steps <= SMALL_STEP_LIMIT:
+            return False
+        step = 'incax' if instr.opcode == 'addax' else 'decax'
+        if self.cost_model.score(Instr(step)) * steps >= self.cost_model.score(instr):
+            return False
+        self.replace(i, Instr(step))
+        for _ in range(steps - 1):
+            self.insert_after(i, Instr(step))
+        return REWRITTEN
+    
+    def rule_dead_temp_store(self, i):
+        """stax tmpN where tmpN is never read afterwards (temps are local to a block)"""
+        instr = self.code[i]
+        if instr.mode != TEMP or self.temp_used_after(instr.operand, i):
+            return False
+        self.touch(self.delete(i))
+        return True
+    
+    RULES = {
+        'ldax': (rule_load_transfer,),
+        'ldx': (rule_clear_x_transfer,),
+        'store': (rule_store_restore, rule_store_y),
+        'stax': (rule_temp_roundtrip, rule_store_reload, rule_dead_temp_store),
+        'addax': (rule_small_step,),
+        'subax': (rule_small_step,),
+    }
+
+def optimize_code(code, profile=None, cost_model=None):
+    """
+    Post-optimizer to remove redundant store/restore pairs and temp variable pairs.
+    Takes a list of Instr (or lines of assembly text) and returns
+    (optimized_code, removed_count). cost_model decides between alternative
+    forms (balanced by default). The time and the rules that fired are
+    added to profile, a StatementProfile, if given.
+    """
+    if profile is not None:
+        start = time.perf_counter()
+        result = optimize_code_block(code, profile.rules, cost_model)
+        profile.phases['optimize'] += time.perf_counter() - start
+        return result
+    return optimize_code_block(code, None, cost_model)
+
+def optimize_code_block(code, fired=None, cost_model=None):
+    """Run the peephole optimizer on code, see optimize_code"""
+    # Convert text to instructions if needed
+    if isinstance(code, str):
+        code = code.split('\n')
+    code = [Instr.parse(line.strip()) if isinstance(line, str) else line
+            for line in code if not isinstance(line, str) or line.strip()]
+    
+    optimizer = PeepholeOptimizer(code, fired, cost_model)
+    result = optimizer.run()
+    return result, optimizer.removed_count
+
+class TempRenumberer:
+    """
+    Renumbers temp variables in generated code, one part of a file after
+    the other. The numbering state carries over from one call of renumber
+    to the next, and used_temps collects the temp names used so far.
     
     Args:
-        lines: List of code lines
         temp_start: Starting number for temp variables (default: 10)
         reuse_temps: If True, reset numbering at each expression (default behavior)
                      If False, keep incrementing across all expressions (--no-temp-reuse)
-    
-    Returns:
-        (renumbered_lines, used_temp_set): Tuple of renumbered code and set of temp vars used
     """
-    import re
     
-    result = []
-    temp_mapping = {}  # Maps old temp names to new temp names
-    next_temp = temp_start  # Next temp number to assign
-    used_temps = set()
-    
-    # Pattern to match temp variable references like tmp10, tmp11, etc.
-    temp_pattern = re.compile(r'\btmp(\d+)\b')
+    def __init__(self, temp_start=10, reuse_temps=True):
+        self.temp_start = temp_start
+        self.reuse_temps = reuse_temps
+        self.temp_mapping = {}  # Maps old temp numbers to new temp numbers
+        self.next_temp = temp_start  # Next temp number to assign
+        self.used_temps = set()
     
-    for line in lines:
-        line_str = line if isinstance(line, str) else str(line)
-        
-        # Check for expression boundary (start of new let statement)
-        if '; +++ let' in line_str:
-            # Reset temp mapping for new expression
-            temp_mapping = {}
-            if reuse_temps:
-                # Reset counter for reuse mode
-                next_temp = temp_start
-        
-        # Find all temp references in this line
-        def replace_temp(match):
-            nonlocal next_temp
-            old_temp = f"tmp{match.group(1)}"
-            
-            if old_temp not in temp_mapping:
-                # Assign a new temp number
-                new_temp = f"tmp{next_temp}"
-                next_temp += 1
-                temp_mapping[old_temp] = new_temp
+    def renumber(self, lines):
+        """Return lines (Instr and text) with the temps of the Instr renumbered"""
+        result = []
+        for line in lines:
+            if isinstance(line, str):
+                # Check for expression boundary (start of new let statement)
+                if '; +++ let' in line:
+                    # Reset temp mapping for new expression
+                    self.temp_mapping = {}
+                    if self.reuse_temps:
+                        # Reset counter for reuse mode
+                        self.next_temp = self.temp_start
+                result.append(line)
+                continue
             
-            used_temps.add(temp_mapping[old_temp])
-            return temp_mapping[old_temp]
-        
-        # Replace all temp references
-        new_line = temp_pattern.sub(replace_temp, line_str)
-        result.append(new_line)
+            if line.mode in (TEMP, TEMP_HIGH):
+                new_temp = self.temp_mapping.get(line.operand)
+                if new_temp is None:
+                    # Assign a new temp number
+                    new_temp = self.next_temp
+                    self.next_temp += 1
+                    self.temp_mapping[line.operand] = new_temp
+                self.used_temps.add(temp_name(new_temp))
+                line = Instr(line.opcode, line.mode, new_temp)
+            result.append(line)
+        return result
+
+def renumber_temp_variables(lines, temp_start=10, reuse_temps=True):
+    """
+    Renumber temp variables in generated code, see TempRenumberer.
     
-    return result, used_temps
+    Returns:
+        (renumbered_lines, used_temp_set): Tuple of renumbered code and set of temp vars used
+    """
+    renumberer = TempRenumberer(temp_start, reuse_temps)
+    return renumberer.renumber(lines), renumberer.used_temps
 
 def compile_line(line, lexer, parser, add_comments=True):
     """Compile a single let statement"""
     try:
-        # Parse to get the expression
-        parsed_result = parser.parse(line, lexer=lexer)
-        
-        if parsed_result:
-            # Get reg_temps for multi-use registers (initialized by parser)
-            reg_temps = getattr(codegen, '_reg_temps', {})
-            
-            # Save registers AT THE START if they're used in the expression
-            saves = []
-            
-            # For multi-use registers, save to temp variable instead of store
-            # Order matters: save AX/A first, then X, then Y
-            if 'ax' in reg_temps:
-                saves.append(f"stax {reg_temps['ax']}")
-            elif hasattr(codegen, '_uses_ax') and codegen._uses_ax:
-                saves.append("store AX")
-            
-            if 'a' in reg_temps:
-                # Save A to 16-bit temp variable
-                saves.append(f"sta {reg_temps['a']}")
-                saves.append("lda #0")
-                saves.append(f"sta {reg_temps['a']}+1")
-            elif hasattr(codegen, '_uses_a') and codegen._uses_a:
-                saves.append("store A")
-            
-            if 'x' in reg_temps:
-                # Save X to 16-bit temp variable
-                saves.append("txa")
-                saves.append(f"sta {reg_temps['x']}")
-                saves.append("lda #0")
-                saves.append(f"sta {reg_temps['x']}+1")
-            elif hasattr(codegen, '_uses_x') and codegen._uses_x:
-                saves.append("store X")
-            
-            if 'y' in reg_temps:
-                # Save Y to 16-bit temp variable
-                saves.append("tya")
-                saves.append(f"sta {reg_temps['y']}")
-                saves.append("lda #0")
-                saves.append(f"sta {reg_temps['y']}+1")
-            elif hasattr(codegen, '_uses_y') and codegen._uses_y:
-                saves.append("store Y")
-            
-            # Clear flags for next compilation
-            codegen._uses_ax = False
-            codegen._uses_a = False
-            codegen._uses_x = False
-            codegen._uses_y = False
-            codegen._reg_temps = {}
-            
-            result = []
-            if add_comments:
-                result.append(f"; +++ {line}")
-            result.extend(saves)
-            result.extend(parsed_result)
-            if add_comments:
-                result.append(f"; --- {line}")
-            result.append("")
-            return result
-        return []
+        block = compile_statement(line, lexer, parser)
     except Exception as e:
-        print(f"Error compiling '{line}': {e}", file=sys.stderr)
+        report(f"Error compiling '{line}': {e}")
         return []
+    if block is None:
+        return []
+    
+    result = []
+    if add_comments:
+        result.append(f"; +++ {line}")
+    result.extend(block)
+    if add_comments:
+        result.append(f"; --- {line}")
+    result.append("")
+    return result
+
+def compile_statement(line, lexer, parser):
+    """
+    Return the optimized code block of a let statement, taking it from the
+    statement cache if possible, or None if the statement has errors. The
+    block is empty if the statement has no effect, e.g. let a = a.
+    """
+    codegen = current_codegen()
+    cache = get_statement_cache() if codegen.use_cache else None
+    if cache is None:
+        return generate_statement(line, lexer, parser)
+    
+    key = cache.make_key(line, codegen)
+    try:
+        entry = cache.get(key)
+    except Exception:
+        entry = None
+    if entry is not None:
+        # Replay the effects of compiling the statement
+        codegen.cache_hits += 1
+        if codegen.profile is not None:
+            codegen.profile.cached = True
+        for name in entry['assigned']:
+            codegen.add_variable(name)
+        for name in entry['referenced']:
+            codegen.reference_variable(name)
+        codegen.optimizer_removed += entry['removed']
+        report(entry['messages'], end="")
+        if entry['code'] is None:
+            return None
+        block = [Instr(*fields) for fields in entry['code']]
+        for instr in block:
+            if instr.mode in (TEMP, TEMP_HIGH):
+                codegen.temp_vars.add(temp_name(instr.operand))
+        return block
+    
+    codegen.cache_misses += 1
+    import io
+    messages = io.StringIO()
+    removed = codegen.optimizer_removed
+    codegen.var_log = []
+    outer_messages = getattr(_context, 'messages', None)
+    _context.messages = messages
+    try:
+        block = generate_statement(line, lexer, parser)
+        var_log = codegen.var_log
+    finally:
+        codegen.var_log = None
+        _context.messages = outer_messages
+        report(messages.getvalue(), end="")
+    
+    cache.put(key, {
+        'code': None if block is None else [list(instr) for instr in block],
+        'assigned': sorted({name for assigned, name in var_log if assigned}),
+        'referenced': sorted({name for assigned, name in var_log if not assigned}),
+        'removed': codegen.optimizer_removed - removed,
+        'messages': messages.getvalue(),
+    })
+    return block
+
+def generate_statement(line, lexer, parser):
+    """Parse and optimize a let statement, returns its code block (None on errors)"""
+    codegen = current_codegen()
+    profile = codegen.profile
+    if profile is not None:
+        start = time.perf_counter()
+        inner_time = profile.inner_time()
+    # Parse to get the expression
+    parsed_result = parser.parse(line, lexer=lexer)
+    if profile is not None:
+        # Parsing includes lexing and the search, count only the parser itself
+        profile.phases['parse'] += time.perf_counter() - start - (profile.inner_time() - inner_time)
+    if not parsed_result:
+        return None
+    
+    # Get reg_temps for multi-use registers (initialized by parser)
+    reg_temps = getattr(codegen, '_reg_temps', {})
+    
+    # Save registers AT THE START if they're used in the expression
+    saves = []
+    
+    # For multi-use registers, save to temp variable instead of store
+    # Order matters: save AX/A first, then X, then Y
+    if 'ax' in reg_temps:
+        saves.append(Instr('stax', TEMP, reg_temps['ax']))
+    elif hasattr(codegen, '_uses_ax') and codegen._uses_ax:
+        saves.append(Instr('store', ARGS, 'AX'))
+    
+    if 'a' in reg_temps:
+        # Save A to 16-bit temp variable
+        saves.append(Instr('sta', TEMP, reg_temps['a']))
+        saves.append(Instr('lda', IMMEDIATE, 0))
+        saves.append(Instr('sta', TEMP_HIGH, reg_temps['a']))
+    elif hasattr(codegen, '_uses_a') and codegen._uses_a:
+        saves.append(Instr('store', ARGS, 'A'))
+    
+    if 'x' in reg_temps:
+        # Save X to 16-bit temp variable
+        saves.append(Instr('txa'))
+        saves.append(Instr('sta', TEMP, reg_temps['x']))
+        saves.append(Instr('lda', IMMEDIATE, 0))
+        saves.append(Instr('sta', TEMP_HIGH, reg_temps['x']))
+    elif hasattr(codegen, '_uses_x') and codegen._uses_x:
+        saves.append(Instr('store', ARGS, 'X'))
+    
+    if 'y' in reg_temps:
+        # Save Y to 16-bit temp variable
+        saves.append(Instr('tya'))
+        saves.append(Instr('sta', TEMP, reg_temps['y']))
+        saves.append(Instr('lda', IMMEDIATE, 0))
+        saves.append(Instr('sta', TEMP_HIGH, reg_temps['y']))
+    elif hasattr(codegen, '_uses_y') and codegen._uses_y:
+        saves.append(Instr('store', ARGS, 'Y'))
+    
+    # Clear flags for next compilation
+    codegen._uses_ax = False
+    codegen._uses_a = False
+    codegen._uses_x = False
+    codegen._uses_y = False
+    codegen._reg_temps = {}
+    
+    # Optimize the block: removes redundant store/restore pairs and temp variable pairs
+    block, removed = optimize_code(saves + parsed_result, profile, codegen.cost_model)
+    codegen.optimizer_removed += removed
+    return block
+
+# Fingerprint at the end of a block end marker: "; --- let ... ; #1a2b3c4d"
+FINGERPRINT_PATTERN = re.compile(r'\s*;\s*#([0-9a-f]{8})$')
+
+_compiler_digest = None
+
+def compiler_digest():
+    """Hash of the exprass source, so that any change to the compiler changes all fingerprints"""
+    global _compiler_digest
+    if _compiler_digest is None:
+        import hashlib
+        try:
+            with open(__file__, 'rb') as f:
+                _compiler_digest = hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            _compiler_digest = __version__
+    return _compiler_digest
+
+def block_fingerprint(let_statement, code_lines):
+    """
+    Short fingerprint of a compiled block over the let statement, its code,
+    the options that affect code generation, the values it shares with the
+    statements around it and the compiler version.
+    """
+    codegen = current_codegen()
+    import hashlib
+    shared = [sorted((name, repr(node)) for node, name in names.items())
+              for names in (codegen.available, codegen.publish)]
+    data = repr((compiler_digest(), codegen.temp_start, codegen.search, codegen.budget, codegen.optimize,
+                 codegen.cse, codegen.zp_temps, shared, let_statement, [line.rstrip() for line in code_lines]))
+    return hashlib.sha1(data.encode()).hexdigest()[:8]
+
+def add_block_fingerprints(lines):
+    """Append the block fingerprint to the end marker of each compiled block"""
+    result = lines[:]
+    for block in find_compiled_blocks(lines):
+        if block['type'] == 'expression':
+            fingerprint = block_fingerprint(block['let_statement'], block['code'])
+            end_marker = FINGERPRINT_PATTERN.sub('', lines[block['end']].rstrip())
+            result[block['end']] = f"{end_marker} ; #{fingerprint}\n"
+    return result
+
+# Start and end markers of the declaration blocks
+DECLARATION_MARKERS = {
+    '; +++ Variable declarations from exprass': '; --- End of variable declarations from exprass',
+    '; +++ Zero page temporary variables from exprass': '; --- End of zero page temporary variables from exprass',
+}
 
 def find_compiled_blocks(lines):
     """Find all compiled blocks marked with +++ and --- comments"""
@@ -1773,15 +3508,16 @@ def find_compiled_blocks(lines):
     while i < len(lines):
         line = lines[i].rstrip()
         
-        # Check for variable declarations block first (more specific)
-        if line.startswith('; +++ Variable declarations from exprass'):
+        # Check for declaration blocks first (more specific)
+        start_marker = next((marker for marker in DECLARATION_MARKERS if line.startswith(marker)), None)
+        if start_marker is not None:
             start_line = i
             i += 1
             
             # Collect until end marker
             while i < len(lines):
                 line = lines[i].rstrip()
-                if line.startswith('; --- End of variable declarations from exprass'):
+                if line.startswith(DECLARATION_MARKERS[start_marker]):
                     end_line = i
                     blocks.append({
                         'start': start_line,
@@ -1802,11 +3538,13 @@ def find_compiled_blocks(lines):
                 line = lines[i].rstrip()
                 if line.startswith('; ---'):
                     end_line = i
+                    fingerprint = FINGERPRINT_PATTERN.search(line)
                     blocks.append({
                         'start': start_line,
                         'end': end_line,
                         'let_statement': original_let,
                         'code': code_lines,
+                        'fingerprint': fingerprint.group(1) if fingerprint else None,
                         'type': 'expression'
                     })
                     break
@@ -1854,178 +3592,479 @@ def has_uncommented_let_statements(filepath):
         return False
     return False
 
+def plan_compiled_blocks(lines, blocks, lexer, parser):
+    """
+    Plan the shared values of the compiled blocks in runs, like the
+    compilation of their source does. Returns a dict: start line of a
+    block -> (available, publish), see CommonSubexpressions.
+    """
+    import itertools
+    plans = {}
+    run = []  # (block, None) for a let statement, (None, line) for raw assembly code
+    
+    def flush_run():
+        statements = [block for block, _ in run if block is not None]
+        if len(statements) > 1:
+            texts = [(True, block['let_statement']) if block is not None
+                     else (False, line.split(';')[0].strip()) for block, line in run]
+            run_plans = plan_run(texts, lexer, parser, itertools.count(1).__next__)
+            for block, plan in zip(statements, run_plans):
+                plans[block['start']] = plan
+        run.clear()
+    
+    position = 0
+    for block in blocks:
+        if block['type'] != 'expression':
+            continue
+        for line in lines[position:block['start']]:
+            if is_assembly_barrier(line):
+                flush_run()
+            elif run:
+                run.append((None, line))
+        run.append((block, None))
+        if sum(block is not None for block, _ in run) >= CSE_RUN_LIMIT:
+            flush_run()
+        position = block['end'] + 1
+    flush_run()
+    return plans
+
 def redo_compilation(lines, lexer, parser, add_comments=True):
-    """Recompile existing blocks"""
+    """
+    Recompile existing blocks. Blocks whose fingerprint still matches their
+    statement, code, options and compiler version are kept as they are.
+    Returns (lines, recompiled count, unchanged count, warnings).
+    """
+    codegen = current_codegen()
     blocks = find_compiled_blocks(lines)
     if not blocks:
-        return lines, 0, []
+        return lines, 0, 0, []
     
     result = lines[:]
     recompiled_count = 0
+    unchanged_count = 0
     warnings = []
+    used_temps = set()  # Temps of the recompiled blocks
+    plans = plan_compiled_blocks(lines, blocks, lexer, parser) if codegen.cse else {}
     
     # Process blocks in reverse order to maintain line numbers
     for block in reversed(blocks):
         if block['type'] == 'expression':
+            codegen.available, codegen.publish = plans.get(block['start'], ({}, {}))
             # Check if end marker has different let statement
-            end_line_text = lines[block['end']].rstrip()
-            if end_line_text.startswith('; ---'):
-                end_let = end_line_text[5:].strip()
-                if end_let != block['let_statement']:
-                    warnings.append(f"Line {block['start']+1}: End marker has different let statement, will be corrected")
+            end_line_text = FINGERPRINT_PATTERN.sub('', lines[block['end']].rstrip())
+            end_let = end_line_text[5:].strip()
+            if end_let != block['let_statement']:
+                warnings.append(f"Line {block['start']+1}: End marker has different let statement, will be corrected")
+            elif block['fingerprint'] == block_fingerprint(block['let_statement'], block['code']):
+                unchanged_count += 1
+                continue
             
             # Recompile
             compiled = compile_line(block['let_statement'], lexer, parser, add_comments)
             if compiled:
-                # Add newlines to compiled lines
-                compiled_with_newlines = [line + '\n' for line in compiled]
+                # The blank line after the block is already there
+                if compiled[-1] == "":
+                    compiled.pop()
+                # Number the temps from the start like a normal compilation does,
+                # so the block only uses temps that are already declared
+                compiled, temps = renumber_temp_variables(compiled, codegen.temp_start)
+                used_temps |= temps
+                for names in (codegen.available, codegen.publish):
+                    used_temps.update(names.values())
+                # Render and add newlines to compiled lines
+                compiled_with_newlines = [line + '\n' for line in render_code(compiled)]
+                if add_comments:
+                    compiled_with_newlines = add_block_fingerprints(compiled_with_newlines)
                 # Replace entire block with recompiled version
                 result[block['start']:block['end']+1] = compiled_with_newlines
                 recompiled_count += 1
-        # Skip variable blocks - they will be regenerated
+        # Skip variable blocks, missing declarations are added below
+    codegen.available, codegen.publish = {}, {}
     
-    return result, recompiled_count, warnings
+    result = add_missing_declarations(result, codegen.variables, used_temps)
+    return result, recompiled_count, unchanged_count, warnings
 
-def process_includes(input_file, lines, output_file, args):
-    """Process .include directives and compile included files"""
-    modified_lines = []
-    compiled_includes = []
-    
+# Labels declared with .res, as in the declaration blocks
+DECLARED_PATTERN = re.compile(r'^\s*([A-Za-z_]\w*):\s*\.res\b')
+
+def add_missing_declarations(lines, variables, temps):
+    """
+    Add the variables and temps that recompiled blocks use, but the
+    declaration blocks of an earlier compilation lack, e.g. temps of code
+    that a newer exprass generates differently. Zero page temps go to the
+    zero page block if there is one.
+    """
+    codegen = current_codegen()
+    declared = {match.group(1) for match in map(DECLARED_PATTERN.match, lines) if match}
+    zp_pool = {temp_name(codegen.temp_start + i) for i in range(codegen.zp_temps)}
+    missing = {
+        '; --- End of variable declarations from exprass': sorted(variables - declared) +
+                                                           sorted(temps - zp_pool - declared),
+        '; --- End of zero page temporary variables from exprass': sorted(temps & zp_pool - declared),
+    }
+    if not any(missing.values()):
+        return lines
+    if not any(line.startswith('; --- End of zero page temporary variables') for line in lines):
+        # Without a zero page block they are declared in RAM
+        missing['; --- End of variable declarations from exprass'] += missing.pop(
+            '; --- End of zero page temporary variables from exprass')
+    result = []
     for line in lines:
-        stripped = line.strip()
-        
-        # Check for .include "file" or .include 'file'
-        match = re.match(r'\.include\s+["\']([^"\']+)["\']', stripped, re.IGNORECASE)
-        if match:
-            include_file = match.group(1)
-            
-            # Check if it's a local file (has one of our target extensions)
-            local_extensions = ['.s', '.asm', '.i', '.inc']
-            include_ext = Path(include_file).suffix.lower()
-            
-            if include_ext in local_extensions:
-                # Try to find the include file
-                include_path = None
-                base_dir = Path(input_file).parent
-                
-                # Try relative to input file
-                candidate = base_dir / include_file
-                if candidate.exists():
-                    include_path = candidate
-                else:
-                    # Try current directory
-                    candidate = Path(include_file)
-                    if candidate.exists():
-                        include_path = candidate
-                
-                if include_path:
-                    # Check if the file contains uncommented let statements
-                    if has_uncommented_let_statements(str(include_path)):
-                        # Compile the included file
-                        output_include = include_path.with_suffix('.asm')
-                        try:
-                            compile_file(str(include_path), str(output_include), args, is_include=True)
-                            
-                            # Preserve the directory structure from the original include path
-                            include_file_path = Path(include_file)
-                            new_include_path = include_file_path.parent / (include_file_path.stem + '.asm')
-                            
-                            # Change .include to point to .asm file
-                            modified_lines.append(f'.include "{new_include_path}"\n')
-                            compiled_includes.append(str(include_path))
-                        except Exception as e:
-                            print(f"Warning: Could not compile include '{include_file}': {e}", file=sys.stderr)
-                            modified_lines.append(line)
-                    else:
-                        # No let statements found, keep original include
-                        modified_lines.append(line)
-                else:
-                    # Include file not found, leave as is
-                    modified_lines.append(line)
-            else:
-                # Not a local file extension, leave as is
-                modified_lines.append(line)
-        else:
-            modified_lines.append(line)
-    
-    return modified_lines, compiled_includes
+        for end_marker, names in missing.items():
+            if line.startswith(end_marker):
+                for name in names:
+                    result += [f".ifndef {name}\n", f"{name}:\t.res 2\n", ".endif\n"]
+        result.append(line)
+    return result
 
-def compile_file(input_file, output_file=None, args=None, is_include=False):
-    """Main compilation function"""
-    global codegen
-    
-    # Initialize code generator
-    temp_start = getattr(args, 'temp_start', 10) if args else 10
-    verbose = getattr(args, 'verbose', False) if args else False
-    quiet = getattr(args, 'quiet', False) if args else False
-    
-    codegen = CodeGenerator(temp_start=temp_start, verbose=verbose)
+# Include directives: .include "file" or .include 'file'
+INCLUDE_PATTERN = re.compile(r'\.include\s+["\']([^"\']+)["\']', re.IGNORECASE)
+
+# Extensions of includes that may be sources for exprass
+LOCAL_INCLUDE_EXTENSIONS = ['.s', '.asm', '.i', '.inc']
+
+def find_include(input_file, include_file):
+    """Locate an included file: relative to the including file, then in the current directory"""
+    candidate = Path(input_file).parent / include_file
+    if candidate.exists():
+        return candidate
+    candidate = Path(include_file)
+    if candidate.exists():
+        return candidate
+    return None
+
+class IncludeGraph:
+    """
+    Include dependencies of the files compiled in one exprass run with -c.
     
-    # Build lexer and parser
-    lexer = lex.lex()
-    parser = yacc.yacc(debug=False, write_tables=False)
+    There is an edge from a source file to each local include that contains
+    let statements, and is therefore compiled to an .asm file that replaces
+    it in the .include directive. Each include is compiled once per run, or
+    not at all if its .asm file is newer than both the include and exprass
+    itself. Include cycles are reported as errors.
+    """
     
-    # Read input file
-    with open(input_file, 'r') as f:
-        lines = f.readlines()
+    def __init__(self, sources=()):
+        self.edges = {}   # Resolved source path -> {include name: include path}
+        self.status = {}  # Include path -> 'compiled', 'up to date' or 'failed'
+        self.outputs = {} # Include path -> output path where it is also an input
+        for source in sources:
+            self.add_source(source)
+    
+    def add_source(self, source):
+        """Add a source file and, recursively, the includes it compiles"""
+        pending = [Path(source).resolve()]
+        while pending:
+            path = pending.pop()
+            if path in self.edges:
+                continue
+            includes = {}
+            try:
+                with open(path, 'r') as f:
+                    lines = f.readlines()
+            except OSError:
+                lines = []
+            for line in lines:
+                match = INCLUDE_PATTERN.match(line.strip())
+                if not match:
+                    continue
+                include_file = match.group(1)
+                if Path(include_file).suffix.lower() not in LOCAL_INCLUDE_EXTENSIONS:
+                    continue
+                include_path = find_include(path, include_file)
+                if include_path and has_uncommented_let_statements(str(include_path)):
+                    includes[include_file] = include_path.resolve()
+            self.edges[path] = includes
+            pending.extend(includes.values())
+    
+    def includes(self):
+        """All included files that are compiled, in a stable order"""
+        return sorted({include for includes in self.edges.values() for include in includes.values()})
+    
+    def find_cycles(self):
+        """Return the include cycles as lists of paths, the first path repeated at the end"""
+        cycles = []
+        state = {}  # Path -> 'active' while on the DFS stack, 'done' afterwards
+        for root in self.edges:
+            if root in state:
+                continue
+            stack = [(root, iter(self.edges[root].values()))]
+            state[root] = 'active'
+            while stack:
+                path, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    state[path] = 'done'
+                    stack.pop()
+                elif state.get(child) == 'active':
+                    on_stack = [entry[0] for entry in stack]
+                    cycles.append(on_stack[on_stack.index(child):] + [child])
+                elif child not in state:
+                    state[child] = 'active'
+                    stack.append((child, iter(self.edges.get(child, {}).values())))
+        return cycles
+    
+    def report_cycles(self):
+        """Print an error for each include cycle, returns the files that reach one"""
+        cycles = self.find_cycles()
+        for cycle in cycles:
+            print(f"Error: Include cycle: {' -> '.join(path.name for path in cycle)}", file=sys.stderr)
+        in_cycle = {path for cycle in cycles for path in cycle}
+        return {source for source in self.edges if in_cycle & self.reachable(source)}
+    
+    def reachable(self, source):
+        """The file itself and all files it includes, directly or indirectly"""
+        seen = {Path(source).resolve()}
+        pending = list(seen)
+        while pending:
+            for include_path in self.edges.get(pending.pop(), {}).values():
+                if include_path not in seen:
+                    seen.add(include_path)
+                    pending.append(include_path)
+        return seen
+    
+    def is_up_to_date(self, include_path):
+        """True if the .asm file of an include is newer than the include and exprass"""
+        output = include_path.with_suffix('.asm')
+        try:
+            output_time = output.stat().st_mtime
+            return (output_time >= include_path.stat().st_mtime and
+                    output_time >= os.stat(__file__).st_mtime)
+        except OSError:
+            return False
+    
+    def pending_includes(self):
+        """Includes that still have to be compiled in this run, nested includes first"""
+        pending = []
+        for include_path in self.post_order():
+            if include_path in self.status:
+                continue
+            output = self.outputs.get(include_path)
+            if output is not None and Path(output).resolve() == include_path.with_suffix('.asm'):
+                # Compiled to the same file as an input of this run
+                self.status[include_path] = 'compiled'
+            elif self.is_up_to_date(include_path):
+                self.status[include_path] = 'up to date'
+            else:
+                pending.append(include_path)
+        return pending
+    
+    def post_order(self):
+        """All included files, each one after the files it includes"""
+        order = []
+        visited = set()
+        def visit(path):
+            visited.add(path)
+            for include_path in self.edges.get(path, {}).values():
+                if include_path not in visited:
+                    visit(include_path)
+            order.append(path)
+        for include_path in self.includes():
+            if include_path not in visited:
+                visit(include_path)
+        return order
+    
+    def compile_includes(self, args):
+        """Compile all pending includes in this process, returns the compiled ones"""
+        compiled = []
+        for include_path in self.pending_includes():
+            # Compiling an include can compile other pending includes
+            if include_path in self.status:
+                continue
+            # Marked first, so that a cycle leads back to it only once
+            self.status[include_path] = 'compiling'
+            self.status[include_path] = compile_include(include_path, args, self)
+            compiled.append(include_path)
+        return compiled
+
+def compile_include(include_path, args, include_graph):
+    """Compile an included file to its .asm file, returns the graph status"""
+    try:
+        compile_file(str(include_path), str(include_path.with_suffix('.asm')), args,
+                     is_include=True, include_graph=include_graph)
+        return 'compiled'
+    except Exception as e:
+        print(f"Warning: Could not compile include '{include_path}': {e}", file=sys.stderr)
+        return 'failed'
+
+def process_includes(input_file, lines, output_file, args, include_graph=None):
+    """
+    Point .include directives of compiled includes to their .asm files.
+    Includes not compiled yet in this run are compiled right away, the
+    lines are only modified while they are iterated.
+    Returns (modified lines, compiled includes, up to date includes).
+    """
+    if include_graph is None:
+        include_graph = IncludeGraph([input_file])
+        include_graph.report_cycles()
+    include_graph.add_source(input_file)
+    include_graph.compile_includes(args)
     
-    # Handle different modes
-    if args and args.undo:
-        # Undo mode: remove compiled code
-        result_lines, count = undo_compilation(lines)
-        if not quiet and not is_include:
-            print(f"Removed {count} compiled block(s)")
-        
-        if output_file and not args.dry_run:
-            with open(output_file, 'w') as f:
-                f.writelines(result_lines)
-        elif args.dry_run and not quiet:
-            print("".join(result_lines))
-        
-        return True
+    rewrites = {}  # Include name -> .asm name
+    compiled_includes = []
+    up_to_date_includes = []
+    for include_file, include_path in include_graph.edges[Path(input_file).resolve()].items():
+        status = include_graph.status.get(include_path)
+        if status in ('compiled', 'compiling', 'up to date'):
+            # Preserve the directory structure from the original include path
+            include_file_path = Path(include_file)
+            rewrites[include_file] = include_file_path.parent / (include_file_path.stem + '.asm')
+            if status != 'up to date':
+                compiled_includes.append(str(include_path))
+            else:
+                up_to_date_includes.append(str(include_path))
+    
+    def modified_lines():
+        for line in lines:
+            match = INCLUDE_PATTERN.match(line.strip()) if rewrites else None
+            if match and match.group(1) in rewrites:
+                # Change .include to point to .asm file
+                yield f'.include "{rewrites[match.group(1)]}"\n'
+            else:
+                # Not compiled by exprass, keep original include
+                yield line
     
-    if args and args.redo:
-        # Redo mode: recompile existing blocks
-        result_lines, count, warnings = redo_compilation(lines, lexer, parser, not args.no_comments if args else True)
-        if warnings and not quiet:
-            for warning in warnings:
-                print(f"Warning: {warning}", file=sys.stderr)
-        if not quiet and not is_include:
-            print(f"Recompiled {count} block(s)")
-        
-        if output_file and not args.dry_run:
-            with open(output_file, 'w') as f:
-                f.writelines(result_lines)
-        elif args.dry_run and not quiet:
-            print("".join(result_lines))
-        
+    return modified_lines(), compiled_includes, up_to_date_includes
+
+# Output files of this process that were not rewritten because they did not change
+unchanged_outputs = []
+
+def write_output(output_file, lines, backup_file=None):
+    """
+    Write lines to output_file atomically: readers, such as another exprass
+    process compiling the same include, see the old or the new file, never
+    a partially written one. The lines are streamed to a temporary file,
+    which only replaces an output that changed, so that the modification
+    time of an unchanged output does not trigger rebuilds. A backup of the
+    replaced file is saved as backup_file if given. '-' writes to stdout.
+    Returns True if the file was written.
+    """
+    if output_file == '-':
+        sys.stdout.writelines(lines)
         return True
+    tmp_file = f"{output_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, 'w') as f:
+            f.writelines(lines)
+        import filecmp
+        if os.path.exists(output_file) and filecmp.cmp(tmp_file, output_file, shallow=False):
+            os.remove(tmp_file)
+            unchanged_outputs.append(output_file)
+            return False
+        if backup_file:
+            import shutil
+            shutil.copy2(output_file, backup_file)
+        os.replace(tmp_file, output_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return True
+
+def read_lines(input_file):
+    """Yield the lines of a source file, or of stdin for '-'"""
+    if input_file == '-':
+        yield from sys.stdin
+        return
+    with open(input_file, 'r') as f:
+        yield from f
+
+def check_module_zeropage(lines, zp_temp_count):
+    """
+    Warn about the LAMAlib modules included by the lines that also take bytes
+    of the ZEROPAGE segment, as the bytes given by --zp-temps may not leave
+    room for them. ld65 stops with a ZP overflow if they don't fit.
+    """
+    settings = {}
+    for line in lines:
+        stripped = line.split(';')[0].strip()
+        setting = SETTING_PATTERN.match(stripped)
+        if setting:
+            value = setting.group(2)
+            settings[setting.group(1)] = int(value[1:], 16) if value.startswith('$') else int(value)
+        include = INCLUDE_PATTERN.match(stripped)
+        if include:
+            module_bytes = module_zeropage_bytes(include.group(1), settings)
+            if module_bytes:
+                needed = LAMALIB_ZEROPAGE_BYTES + module_bytes + 2 * zp_temp_count
+                sizes = ", ".join(f"{target}: {size}" for target, size in ZEROPAGE_SEGMENT_SIZES.items())
+                report(f"Warning, {include.group(1)} takes {module_bytes} zero page bytes: with LAMAlib "
+                       f"and {zp_temp_count} zero page temp(s), the ZEROPAGE segment needs "
+                       f"{needed} bytes ({sizes}). If the target has fewer, give --zp-temps the "
+                       f"bytes the module leaves free.")
+
+def iter_compile_source(lines, lexer, parser, source_name, add_comments=True, temp_reuse=True,
+                        verbose=False, stats=None, profile=False):
+    """
+    Compile the lines of a source file with the code generator of this thread,
+    yielding the output lines as they are ready. Only one compiled block is
+    held in memory at a time, except with zero page temps: their declaration
+    comes after the includes before the first statement and lists the used
+    ones, so the code is yielded when it is complete. When the output is complete, stats (a dict) holds
+    the used temp names as 'temps', the number of statements with errors as
+    'errors' and the number of input lines as 'lines_in'. With profile,
+    stats['statements'] collects a StatementProfile per statement.
+    """
+    codegen = current_codegen()
+    renumberer = TempRenumberer(codegen.temp_start, reuse_temps=temp_reuse)
+    if profile:
+        lexer = TimedLexer(lexer)
+        stats['statements'] = []
     
-    # Normal compilation mode
     # Generate assembly header
-    result = []
-    result.append("; Generated by exprass - Expression to Assembly Translator\n")
-    result.append(f"; Source: {Path(input_file).name}\n")
-    result.append("\n")
+    yield "; Generated by exprass - Expression to Assembly Translator\n"
+    yield f"; Source: {source_name}\n"
+    yield "\n"
+    
+    zp_temps = {temp_name(codegen.temp_start + i) for i in range(codegen.zp_temps)}
     
     # Process each line
     line_num = 0
     error_count = 0
-    add_comments = not (args and hasattr(args, 'no_comments') and args.no_comments)
-    
-    for line in lines:
-        line_num += 1
+    statement_count = 0  # Let statements so far, compiled or not
+    shared_count = 0  # Shared temps numbered so far
+    
+    def next_shared_number():
+        nonlocal shared_count
+        shared_count += 1
+        return shared_count
+    
+    def render_block(renumbered, shared):
+        """Output lines of a compiled block with renumbered temps"""
+        for names in shared:
+            renumberer.used_temps.update(names.values())
+        block = [(line if isinstance(line, str) else line.render()) + "\n"
+                 for line in renumbered]
+        if add_comments:
+            block = add_block_fingerprints(block)
+        return block
+    
+    def profiled_block(compiled, shared):
+        """render_block with the renumber and emit times added to the statement profile"""
+        statement = codegen.profile
+        start = time.perf_counter()
+        renumbered = renumberer.renumber(compiled)
+        statement.phases['renumber'] += time.perf_counter() - start
+        statement.temps = len({line.operand for line in renumbered
+                               if not isinstance(line, str) and line.mode in (TEMP, TEMP_HIGH)})
+        start = time.perf_counter()
+        block = render_block(renumbered, shared)
+        statement.phases['emit'] += time.perf_counter() - start
+        statement.lines_out = len(block)
+        return block
+    
+    def process(line_num, line, shared=None):
+        """Compile or pass through one line, with the shared values of a let statement"""
+        nonlocal error_count, statement_count
+        shared = shared or ({}, {})
         stripped = line.strip()
         
-        # Skip empty lines
-        if not stripped:
-            result.append(line)
-            continue
-        
-        # Pass through assembly comments unchanged
-        if stripped.startswith(';'):
-            result.append(line)
-            continue
+        # Skip empty lines and pass through assembly comments unchanged
+        if not stripped or stripped.startswith(';'):
+            if '; +++ let' in line:
+                renumberer.renumber([line])
+            yield line
+            return
         
         # Strip trailing comments from the line
         comment_pos = stripped.find(';')
@@ -2039,116 +4078,587 @@ def compile_file(input_file, output_file=None, args=None, is_include=False):
         
         if not is_expression:
             # Pass through raw assembly code unchanged
-            result.append(line)
+            if '; +++ let' in line:
+                renumberer.renumber([line])
+            yield line
             
             # Detect variables assigned in assembly code
             assigned_vars = detect_assembly_assignments(stripped_no_comment)
             for var in assigned_vars:
                 codegen.add_variable(var)
             
-            if verbose and not quiet:
-                print(f"; Line {line_num}: Pass-through", file=sys.stderr)
-            continue
+            if verbose:
+                report(f"; Line {line_num}: Pass-through")
+            return
         
         # This is a high-level expression - compile it
-        if verbose and not quiet:
-            print(f"; Processing line {line_num}: {stripped_no_comment}", file=sys.stderr)
+        statement_count += 1
+        if verbose:
+            report(f"; Processing line {line_num}: {stripped_no_comment}")
         
+        if profile:
+            codegen.profile = StatementProfile(line_num, stripped_no_comment)
+            stats['statements'].append(codegen.profile)
+        codegen.available, codegen.publish = shared
         compiled = compile_line(stripped_no_comment, lexer, parser, add_comments)
         if compiled:
-            for code_line in compiled:
-                result.append(code_line + "\n")
-            if verbose and not quiet:
-                print(f"; Generated {len(compiled)} lines", file=sys.stderr)
+            # Renumber the temps and render the block, timed only for --stats
+            if profile:
+                block = profiled_block(compiled, shared)
+            else:
+                block = render_block(renumberer.renumber(compiled), shared)
+            yield from block
+            if verbose:
+                report(f"; Generated {len(compiled)} lines")
         else:
             error_count += 1
-    
-    # Add variable declarations (without temps - we'll add them after renumbering)
-    # First add just the regular variables
-    var_decl_lines = []
-    var_decl_lines.append("")
-    var_decl_lines.append("; +++ Variable declarations from exprass, all 16-bit")
+            if profile:
+                codegen.profile.error = True
+        codegen.available, codegen.publish = {}, {}
+        codegen.profile = None
+    
+    # Lines of the current run of let statements that may share values:
+    # (line number, line, is a let statement)
+    run = []
+    
+    def flush_run():
+        """Plan the shared values of the run and compile its lines"""
+        nonlocal shared_count
+        if temp_reuse:
+            # Shared temps are only used within their run
+            shared_count = 0
+        plans = iter(())
+        if sum(is_let for _, _, is_let in run) > 1:
+            plans = iter(plan_run([(is_let, line.split(';')[0].strip()) for _, line, is_let in run],
+                                  lexer, parser, next_shared_number))
+        failed = set()  # Shared temps of statements with errors, they are never stored
+        for line_num, line, is_let in run:
+            if is_let:
+                available, publish = next(plans, ({}, {}))
+                available = {node: name for node, name in available.items() if name not in failed}
+                errors = error_count
+                yield from process(line_num, line, (available, publish))
+                if error_count > errors:
+                    failed.update(publish.values())
+            else:
+                yield from process(line_num, line)
+        run.clear()
+    
+    def compiled_lines():
+        """Output lines of the source, without the declarations"""
+        nonlocal line_num
+        for line in lines:
+            line_num += 1
+            if not codegen.cse:
+                yield from process(line_num, line)
+                continue
+            
+            # Runs of let statements end at raw assembly code that is a barrier
+            stripped = line.strip()
+            is_let = not stripped.startswith(';') and stripped.split(';')[0].strip().startswith('let ')
+            if is_let:
+                run.append((line_num, line, True))
+                if sum(is_let for _, _, is_let in run) >= CSE_RUN_LIMIT:
+                    yield from flush_run()
+            elif run and not is_assembly_barrier(line):
+                run.append((line_num, line, False))
+            else:
+                yield from flush_run()
+                yield from process(line_num, line)
+        yield from flush_run()
+    
+    if zp_temps:
+        # The zero page temps are declared before the statements, so that ca65
+        # uses zero page addressing for them, but after the includes before
+        # them, so that LAMAlib.inc comes first. Only the used ones are
+        # declared, so the code is held back until it is complete.
+        code = []
+        declare_at = 0  # After the includes before the first statement, e.g. of LAMAlib.inc
+        for output_line in compiled_lines():
+            code.append(output_line)
+            if not statement_count and INCLUDE_PATTERN.match(output_line.strip()):
+                declare_at = len(code)
+        used_zp_temps = sorted(renumberer.used_temps & zp_temps)
+        if used_zp_temps:
+            declaration = ["; +++ Zero page temporary variables from exprass\n",
+                           ".pushseg\n",
+                           ".zeropage\n"]
+            for tmp in used_zp_temps:
+                if temp_reuse:
+                    declaration += [f".ifndef {tmp}\n", f"{tmp}:\t.res 2\n", ".endif\n"]
+                else:
+                    declaration.append(f"{tmp}:\t.res 2\n")
+            declaration += [".popseg\n",
+                            "; --- End of zero page temporary variables from exprass\n",
+                            "\n"]
+            code[declare_at:declare_at] = declaration
+            check_module_zeropage(code, len(used_zp_temps))
+        yield from code
+    else:
+        yield from compiled_lines()
+    
+    # The optimizer already ran on each compiled block, pass-through code is left alone
+    removed = codegen.optimizer_removed
+    if removed > 0 and verbose:
+        report(f"Optimizer removed {removed} redundant operation(s)")
+    if codegen.use_cache and verbose:
+        report(f"Statement cache: {codegen.cache_hits} hit(s), {codegen.cache_misses} miss(es)")
+    
+    # Add variable declarations, now that all variables and temps are known
+    yield "\n"
+    yield "; +++ Variable declarations from exprass, all 16-bit\n"
     for var in sorted(codegen.variables):
-        var_decl_lines.append(f".ifndef {var}")
-        var_decl_lines.append(f"{var}:\t.res 2")
-        var_decl_lines.append(".endif")
-    # Placeholder for temp vars - will be filled after renumbering
-    var_decl_lines.append("")
-    var_decl_lines.append("; Temporary variables")
-    var_decl_lines.append("; TEMP_PLACEHOLDER")
-    var_decl_lines.append("; --- End of variable declarations from exprass")
-    result.extend([line + "\n" for line in var_decl_lines])
-    
-    # Optimize: remove redundant store/restore pairs and temp variable pairs
-    result, removed = optimize_code(result)
-    if removed > 0 and verbose and not quiet:
-        print(f"Optimizer removed {removed} redundant operation(s)", file=sys.stderr)
-    
-    # Renumber temp variables
-    no_temp_reuse = getattr(args, 'no_temp_reuse', False) if args else False
-    result, used_temps = renumber_temp_variables(result, temp_start, reuse_temps=not no_temp_reuse)
-    
-    # Replace the temp placeholder with actual temp declarations
-    wrap_temps = not no_temp_reuse  # Wrap in .ifndef/.endif when reusing temps
-    temp_decl_lines = []
-    for tmp in sorted(used_temps):
+        yield f".ifndef {var}\n"
+        yield f"{var}:\t.res 2\n"
+        yield ".endif\n"
+    yield "\n"
+    yield "; Temporary variables\n"
+    wrap_temps = temp_reuse  # Wrap in .ifndef/.endif when reusing temps
+    for tmp in sorted(renumberer.used_temps - zp_temps):
         if wrap_temps:
-            temp_decl_lines.append(f".ifndef {tmp}\n")
-            temp_decl_lines.append(f"{tmp}:\t.res 2\n")
-            temp_decl_lines.append(".endif\n")
+            yield f".ifndef {tmp}\n"
+            yield f"{tmp}:\t.res 2\n"
+            yield ".endif\n"
         else:
-            temp_decl_lines.append(f"{tmp}:\t.res 2\n")
+            yield f"{tmp}:\t.res 2\n"
+    yield "; --- End of variable declarations from exprass\n"
     
-    # Find and replace the placeholder
-    new_result = []
-    for line in result:
-        if '; TEMP_PLACEHOLDER' in line:
-            new_result.extend(temp_decl_lines)
-        else:
-            new_result.append(line)
-    result = new_result
+    if stats is not None:
+        stats['temps'] = renumberer.used_temps
+        stats['errors'] = error_count
+        stats['lines_in'] = line_num
+
+def compile_source(lines, lexer, parser, source_name, add_comments=True, temp_reuse=True, verbose=False):
+    """
+    Compile the lines of a source file with the code generator of this thread.
+    Returns (output lines, used temp names, number of statements with errors).
+    """
+    stats = {}
+    result = list(iter_compile_source(lines, lexer, parser, source_name, add_comments,
+                                      temp_reuse, verbose, stats))
+    return result, stats['temps'], stats['errors']
+
+def profiled_lines(lines, stats, input_file, output_file, start_time, is_include):
+    """
+    Pass the compiled lines through, counting them, and add the --stats
+    record of the file to file_stats when they are complete.
+    """
+    stats['lines_out'] = 0
+    for line in lines:
+        stats['lines_out'] += 1
+        yield line
+    file_stats.append(file_stats_record(input_file, output_file, stats,
+                                        time.perf_counter() - start_time, is_include))
+
+def compile_file(input_file, output_file=None, args=None, is_include=False, include_graph=None):
+    """
+    Main compilation function. The input is compiled while it is read and
+    the output is streamed to output_file; '-' stands for stdin and stdout.
+    """
+    start_time = time.perf_counter()  # For --stats
+    
+    # Initialize code generator
+    temp_start = getattr(args, 'temp_start', 10) if args else 10
+    verbose = getattr(args, 'verbose', False) if args else False
+    quiet = getattr(args, 'quiet', False) if args else False
+    
+    search = getattr(args, 'opt_search', 'auto') if args else 'auto'
+    budget = getattr(args, 'opt_budget', None) if args else None
+    optimize = getattr(args, 'optimize', 'balanced') if args else 'balanced'
+    
+    use_cache = not getattr(args, 'no_cache', False) if args else True
+    cse = getattr(args, 'cse', False) if args else False
+    zp_temps = getattr(args, 'zp_temps', 0) if args else 0
+    
+    codegen = CodeGenerator(temp_start=temp_start, verbose=verbose and not quiet,
+                            search=search, budget=budget, use_cache=use_cache, optimize=optimize,
+                            cse=cse, zp_temps=zp_temps)
+    _context.codegen = codegen
+    
+    # Lexer and parser are built once and shared with included files
+    lexer, parser = get_parser_engine(getattr(args, 'parser', 'fast') if args else 'fast')
+    
+    # Status messages go to stdout, unless the output itself does
+    show_status = not quiet and not is_include and output_file != '-'
+    
+    # Handle different modes
+    if args and args.undo:
+        # Undo mode: remove compiled code
+        result_lines, count = undo_compilation(list(read_lines(input_file)))
+        if show_status:
+            print(f"Removed {count} compiled block(s)")
+        
+        if output_file and not args.dry_run:
+            write_output(output_file, result_lines)
+        elif args.dry_run and not quiet:
+            print("".join(result_lines))
+        
+        return True
+    
+    if args and args.redo:
+        # Redo mode: recompile existing blocks
+        result_lines, count, unchanged, warnings = redo_compilation(
+            list(read_lines(input_file)), lexer, parser, not args.no_comments if args else True)
+        if warnings and not quiet:
+            for warning in warnings:
+                print(f"Warning: {warning}", file=sys.stderr)
+        if show_status:
+            print(f"Recompiled {count} block(s), {unchanged} unchanged")
+        
+        if output_file and not args.dry_run:
+            write_output(output_file, result_lines)
+        elif args.dry_run and not quiet:
+            print("".join(result_lines))
+        
+        return True
+    
+    # Normal compilation mode: read, compile and write line by line
+    add_comments = not (args and hasattr(args, 'no_comments') and args.no_comments)
+    temp_reuse = not (getattr(args, 'no_temp_reuse', False) if args else False)
+    source_name = 'stdin' if input_file == '-' else Path(input_file).name
+    profile = bool(getattr(args, 'stats', None)) if args else False
+    stats = {}
+    result = iter_compile_source(read_lines(input_file), lexer, parser, source_name,
+                                 add_comments, temp_reuse, verbose and not quiet, stats, profile)
     
     # Handle includes if requested
     if args and args.compile_includes:
-        result, compiled_includes = process_includes(input_file, result, output_file, args)
-        if compiled_includes and not quiet:
-            print(f"Compiled {len(compiled_includes)} include file(s)")
+        result, compiled_includes, up_to_date_includes = process_includes(
+            input_file, result, output_file, args, include_graph)
+        # Compiling the includes used their own code generators
+        _context.codegen = codegen
+        if (compiled_includes or up_to_date_includes) and show_status:
+            message = f"Compiled {len(compiled_includes)} include file(s)"
+            if up_to_date_includes:
+                message += f", {len(up_to_date_includes)} up to date"
+            print(message)
+    
+    if profile:
+        result = profiled_lines(result, stats, input_file, output_file, start_time, is_include)
     
     # Output results
     if args and args.dry_run:
-        if not quiet:
-            print("".join(result))
+        if quiet:
+            # Compile anyway for the error messages
+            for _ in result:
+                pass
+        else:
+            sys.stdout.writelines(result)
+            print()
         return True
     
     if output_file:
-        # Create backup if in-place mode
+        # Create backup if in-place mode, unless the file stays the same
+        backup_file = None
         if args and args.in_place and not args.no_backup:
             backup_file = input_file + '~'
-            shutil.copy2(input_file, backup_file)
-            if not quiet and not is_include:
-                print(f"Backup saved: {backup_file}")
         
-        with open(output_file, 'w') as f:
-            f.writelines(result)
+        written = write_output(output_file, result, backup_file)
         
-        if not quiet and not is_include:
-            print(f"Successfully compiled {input_file} -> {output_file}")
+        if backup_file and written and show_status:
+            print(f"Backup saved: {backup_file}")
+        if show_status:
+            unchanged = "" if written else " (unchanged)"
+            print(f"Successfully compiled {input_file} -> {output_file}{unchanged}")
             print(f"  Variables: {len(codegen.variables)}")
-            print(f"  Temporaries: {len(used_temps)}")
-            
-            # Output warnings about referenced but never assigned variables
-            warnings = codegen.get_warnings()
-            if warnings:
-                for warning in warnings:
-                    print(warning, file=sys.stderr)
+            print(f"  Temporaries: {len(stats['temps'])}")
+        
+        # Output warnings about referenced but never assigned variables
+        if not quiet and not is_include:
+            for warning in codegen.get_warnings():
+                print(warning, file=sys.stderr)
+    else:
+        # Nothing to write, still report the errors
+        for _ in result:
+            pass
+    
+    return stats['errors'] == 0
+
+# ============================================================================
+# COMPILER API
+# ============================================================================
+
+# Result of Compiler.compile_lines: the output lines, sorted variable and temp
+# names, the messages and warnings, and the number of statements with errors
+CompileResult = namedtuple('CompileResult', ['code', 'variables', 'temps', 'warnings', 'errors'])
+
+class Compiler:
+    """
+    Reentrant compiler for using exprass from other programs, e.g. a build server.
+    
+    Each instance has its own lexer, parser and options, and each compilation
+    gets a new code generator, so different instances can compile in several
+    threads at the same time. Calls to the same instance from several threads
+    are serialized.
     
-    return error_count == 0
+        compiler = Compiler(temp_start=100)
+        result = compiler.compile_string("  let score = score + 10\n")
+        print("".join(result.code))
+    """
+    
+    def __init__(self, temp_start=10, search='auto', budget=None, parser='fast',
+                 comments=True, temp_reuse=True, use_cache=True, optimize='balanced', cse=False,
+                 zp_temps=0):
+        self.temp_start = temp_start
+        self.search = search
+        self.budget = budget
+        self.optimize = optimize
+        self.cse = cse
+        self.zp_temps = zp_temps
+        self.comments = comments
+        self.temp_reuse = temp_reuse
+        self.use_cache = use_cache
+        self.lexer, self.parser = new_parser_engine(parser)
+        self.lock = threading.Lock()
+    
+    def compile_lines(self, lines, source_name='<string>'):
+        """Compile the lines of a source, returns a CompileResult"""
+        import io
+        codegen = CodeGenerator(temp_start=self.temp_start, search=self.search,
+                                budget=self.budget, use_cache=self.use_cache, optimize=self.optimize,
+                                cse=self.cse, zp_temps=self.zp_temps)
+        messages = io.StringIO()
+        with self.lock:
+            outer = (getattr(_context, 'codegen', None), getattr(_context, 'messages', None))
+            _context.codegen, _context.messages = codegen, messages
+            try:
+                code, used_temps, errors = compile_source(lines, self.lexer, self.parser, source_name,
+                                                          self.comments, self.temp_reuse)
+            finally:
+                _context.codegen, _context.messages = outer
+        warnings = messages.getvalue().splitlines() + codegen.get_warnings()
+        return CompileResult(code, sorted(codegen.variables), sorted(used_temps), warnings, errors)
+    
+    def compile_string(self, text, source_name='<string>'):
+        """Compile source text, returns a CompileResult"""
+        return self.compile_lines(text.splitlines(keepends=True), source_name)
 
 # ============================================================================
 # MAIN
 # ============================================================================
 
-def main():
+def parse_opt_budget(text):
+    """Parse an --opt-budget value: a variant count or milliseconds ('200ms')"""
+    value = text.strip().lower()
+    kind = 'variants'
+    if value.endswith('ms'):
+        kind = 'ms'
+        value = value[:-2]
+    try:
+        amount = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid budget '{text}', use a variant count or e.g. 200ms")
+    if amount < 1:
+        raise argparse.ArgumentTypeError("budget must be at least 1")
+    return (kind, amount)
+
+def parse_zp_temps(text):
+    """
+    Parse a --zp-temps value, the zero page bytes for temps: a target (c64,
+    c128, vic20) for the bytes of its ZEROPAGE segment that LAMAlib leaves
+    free, or a byte count. Returns the number of temps.
+    """
+    value = text.strip().lower()
+    if value in ZEROPAGE_SEGMENT_SIZES:
+        return (ZEROPAGE_SEGMENT_SIZES[value] - LAMALIB_ZEROPAGE_BYTES) // 2
+    try:
+        size = int(value, 0)
+    except ValueError:
+        targets = ", ".join(ZEROPAGE_SEGMENT_SIZES)
+        raise argparse.ArgumentTypeError(f"invalid zero page size '{text}', use {targets} or a byte count")
+    if not 0 <= size <= 256:
+        raise argparse.ArgumentTypeError("zero page size must be between 0 and 256 bytes")
+    return size // 2
+
+def output_file_for(input_file, args):
+    """The output file of an input file given on the command line"""
+    if input_file == '-' and not args.output:
+        # Filter mode: stdin to stdout
+        return '-'
+    elif args.in_place:
+        return input_file
+    elif args.output:
+        return args.output
+    elif args.undo or args.redo:
+        # For undo/redo, default to modifying the input file itself
+        return input_file
+    else:
+        return str(Path(input_file).with_suffix('.asm'))
+
+def process_input(idx, total_files, input_file, args, include_graph=None):
+    """Compile one input file given on the command line, returns True on success"""
+    # Show progress for multiple files (unless quiet)
+    if total_files > 1 and not args.quiet:
+        print(f"\n[{idx+1}/{total_files}] Processing {input_file}...", file=sys.stderr)
+    
+    output_file = output_file_for(input_file, args)
+    
+    # Compile
+    try:
+        return compile_file(input_file, output_file, args, include_graph=include_graph)
+    except Exception as e:
+        print(f"Error processing {input_file}: {e}", file=sys.stderr)
+        if args.verbose:
+            import traceback
+            traceback.print_exc()
+        return False
+
+class RecordedStream:
+    """A text stream that records what is written to it, tagged with a stream name"""
+    
+    def __init__(self, name, records):
+        self.name = name
+        self.records = records
+    
+    def write(self, text):
+        self.records.append((self.name, text))
+        return len(text)
+    
+    def flush(self):
+        pass
+
+def process_input_captured(idx, total_files, input_file, args, include_graph=None):
+    """
+    Run process_input in a worker process. Returns its result, the
+    recorded (stream name, text) writes to stdout and stderr, which the
+    main process replays so that the output of each file stays together
+    and in input order, the output files left unchanged and the --stats
+    records.
+    """
+    import contextlib
+    records = []
+    with contextlib.redirect_stdout(RecordedStream('stdout', records)), \
+         contextlib.redirect_stderr(RecordedStream('stderr', records)):
+        success = process_input(idx, total_files, input_file, args, include_graph)
+    # Worker processes don't run atexit handlers
+    if _statement_cache:
+        _statement_cache.flush()
+    unchanged = list(unchanged_outputs)
+    unchanged_outputs.clear()
+    records_stats = list(file_stats)
+    file_stats.clear()
+    return success, records, unchanged, records_stats
+
+def watched_files(args, include_graph):
+    """Modification times of the inputs and their includes, None for missing files"""
+    paths = {Path(input_file).resolve() for input_file in args.input}
+    if include_graph:
+        paths.update(include_graph.edges)
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            mtimes[path] = None
+    return mtimes
+
+def rebuild_changed(args, include_graph, changed):
+    """
+    Recompile after the files in changed were modified. Returns the updated
+    include graph and the number of recompiled files.
+    """
+    inputs = [input_file for input_file in args.input if Path(input_file).resolve() in changed]
+    compiled_includes = []
+    if include_graph:
+        # The include structure may have changed, compiled includes stay compiled
+        new_graph = IncludeGraph(args.input)
+        new_graph.outputs = include_graph.outputs
+        new_graph.status = {path: status for path, status in include_graph.status.items()
+                            if path not in changed and status != 'failed'}
+        new_graph.report_cycles()
+        # Inputs whose includes changed get new .include directives
+        inputs = [input_file for input_file in args.input
+                  if input_file in inputs or
+                  new_graph.edges.get(Path(input_file).resolve()) !=
+                  include_graph.edges.get(Path(input_file).resolve())]
+        compiled_includes = new_graph.compile_includes(args)
+        include_graph = new_graph
+    for idx, input_file in enumerate(inputs):
+        process_input(idx, len(inputs), input_file, args, include_graph)
+    return include_graph, len(inputs) + len(compiled_includes)
+
+def watch_inputs(args, include_graph):
+    """
+    Poll the inputs and their includes and recompile what changed, until
+    interrupted. Parser, statement cache and include graph stay in memory
+    between cycles, so a cycle only costs the compilation of the changed files.
+    """
+    mtimes = watched_files(args, include_graph)
+    if not args.quiet:
+        print(f"Watching {len(mtimes)} file(s) for changes, press Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(args.watch_interval)
+            current = watched_files(args, include_graph)
+            changed = {path for path, mtime in current.items() if mtime != mtimes.get(path)}
+            if not changed:
+                continue
+            start = time.perf_counter()
+            include_graph, count = rebuild_changed(args, include_graph, changed)
+            elapsed = (time.perf_counter() - start) * 1000
+            # Writing the file may have taken a while, measure from the last save
+            saved = max(current[path] or 0 for path in changed) / 1e9
+            since_save = (time.time() - saved) * 1000
+            if _statement_cache:
+                _statement_cache.flush()
+            if not args.quiet:
+                print(f"[{time.strftime('%H:%M:%S')}] Recompiled {count} file(s) in {elapsed:.0f} ms "
+                      f"({since_save:.0f} ms after save)")
+            mtimes = watched_files(args, include_graph)
+    except KeyboardInterrupt:
+        if not args.quiet:
+            print("\nStopped watching")
+
+def compile_inputs(args):
+    """
+    Compile the input files of parsed exprass arguments, see build_arg_parser.
+    Returns the list of failed input files and the include graph (None without -c).
+    """
+    total_files = len(args.input)
+    failed_files = []
+    
+    # With -c, compile each include of the whole run once, before the inputs
+    include_graph = None
+    cyclic_inputs = set()
+    if args.compile_includes and not (args.undo or args.redo):
+        include_graph = IncludeGraph(args.input)
+        cyclic_sources = include_graph.report_cycles()
+        cyclic_inputs = {input_file for input_file in args.input
+                         if Path(input_file).resolve() in cyclic_sources}
+        if not args.dry_run:
+            for input_file in args.input:
+                output_file = Path(output_file_for(input_file, args)).resolve()
+                include_graph.outputs[Path(input_file).resolve()] = output_file
+        include_graph.compile_includes(args)
+    
+    if args.jobs == 1 or total_files == 1:
+        for idx, input_file in enumerate(args.input):
+            if not process_input(idx, total_files, input_file, args, include_graph):
+                failed_files.append(input_file)
+    else:
+        # Compile in worker processes, replaying each file's output in input order
+        from concurrent.futures import ProcessPoolExecutor
+        jobs = args.jobs or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=min(jobs, total_files)) as pool:
+            futures = [pool.submit(process_input_captured, idx, total_files, input_file, args, include_graph)
+                       for idx, input_file in enumerate(args.input)]
+            for input_file, future in zip(args.input, futures):
+                success, output, unchanged, stats = future.result()
+                for stream, text in output:
+                    getattr(sys, stream).write(text)
+                unchanged_outputs.extend(unchanged)
+                file_stats.extend(stats)
+                if not success:
+                    failed_files.append(input_file)
+    
+    # Files that reach an include cycle were compiled, but count as failed
+    failed_files.extend(input_file for input_file in args.input
+                        if input_file in cyclic_inputs and input_file not in failed_files)
+    
+    return failed_files, include_graph
+
+def build_arg_parser():
+    """Return the command line parser of exprass, also used by drivers that run it in-process"""
     parser = argparse.ArgumentParser(
         prog='exprass',
         description='Expression to Assembly Translator - Compile high-level expressions to 6502 assembly',
@@ -2159,22 +4669,33 @@ Examples:
   %(prog)s file1.s file2.s file3.s   # Compile multiple files
   %(prog)s *.s                       # Compile all .s files in directory
   %(prog)s game.s -o output.asm      # Specify output file (single input only)
+  %(prog)s - < game.s > game.asm     # Filter: compile stdin to stdout
   %(prog)s game.s -i                 # In-place, backup as game.s~
   %(prog)s game.s -u                 # Undo: remove compiled code
   %(prog)s game.s -r                 # Redo: recompile existing blocks
   %(prog)s game.s -c                 # Compile included .s files too
   %(prog)s file1.s file2.s -c        # Compile multiple files + their includes
+  %(prog)s *.s -j 8                  # Compile up to 8 files in parallel
+  %(prog)s game.s -c --watch         # Recompile game.s and its includes on every save
   %(prog)s game.s -n                 # Dry-run: preview output
   %(prog)s game.s -t 100             # Start temp variables at tmp100
   %(prog)s game.s --no-temp-reuse    # Unique temp names across expressions
+  %(prog)s game.s --opt-search fast  # Linear-time operand order search
+  %(prog)s game.s --opt-budget 50ms  # Bound the search time per statement
+  %(prog)s game.s --optimize speed   # Fewest cycles, e.g. for raster-time critical code
+  %(prog)s game.s --cse              # Compute repeated subexpressions once, not for I/O registers
+  %(prog)s game.s --zp-temps c64     # First temps in the zero page left free on the C64
+  %(prog)s game.s --parser ply       # Parse with the PLY grammar
+  %(prog)s game.s --no-cache         # Recompile every statement from scratch
+  %(prog)s game.s --stats s.json     # Phase times and optimizer statistics as JSON
 
 Author: Wil Elmenreich
 Version: %(version)s
         """ % {'prog': 'exprass', 'version': __version__}
     )
     
-    parser.add_argument('input', nargs='+', help='Input source file(s) (.s)')
-    parser.add_argument('-o', '--output', help='Output file (only valid with single input)')
+    parser.add_argument('input', nargs='+', help='Input source file(s) (.s), - for stdin')
+    parser.add_argument('-o', '--output', help='Output file (only valid with single input), - for stdout')
     parser.add_argument('-i', '--in-place', action='store_true',
                         help='Replace source file, backup as .s~')
     parser.add_argument('-u', '--undo', action='store_true',
@@ -2182,7 +4703,13 @@ Version: %(version)s
     parser.add_argument('-r', '--redo', action='store_true',
                         help='Recompile existing blocks')
     parser.add_argument('-c', '--compile-includes', action='store_true',
-                        help='Compile included .s files and update includes')
+                        help='Compile included .s files once per run (skipping up to date ones) and update includes')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='Compile up to N input files in parallel, 0 for one per CPU (default: 1)')
+    parser.add_argument('-w', '--watch', action='store_true',
+                        help='Keep running and recompile the input files and their includes when they change')
+    parser.add_argument('--watch-interval', type=float, default=0.1, metavar='SECONDS',
+                        help='Time between checks for changes in --watch mode (default: 0.1)')
     parser.add_argument('-n', '--dry-run', action='store_true',
                         help='Preview output without writing files')
     parser.add_argument('-v', '--verbose', action='store_true',
@@ -2197,16 +4724,47 @@ Version: %(version)s
                         help='Starting temp variable number (default: 10)')
     parser.add_argument('--no-temp-reuse', action='store_true',
                         help='Don\'t reuse temp variable names across expressions')
+    parser.add_argument('--opt-search', choices=['auto', 'exhaustive', 'fast'], default='auto',
+                        help='Operand order search: exhaustive tries all 2^n orders, '
+                             'fast is linear, auto uses exhaustive for small expressions (default: auto)')
+    parser.add_argument('--opt-budget', type=parse_opt_budget, metavar='N|Nms',
+                        help='Limit the exhaustive search per statement to N variants or N milliseconds')
+    parser.add_argument('--optimize', choices=['speed', 'size', 'balanced'], default='balanced',
+                        help='Optimization objective: fewest 6502 cycles, fewest bytes, '
+                             'or the sum of both (default: balanced)')
+    parser.add_argument('--cse', action='store_true',
+                        help='Keep common subexpressions of a statement and of consecutive statements '
+                             'in temps and compute them once. Only for sources whose variables and '
+                             'peek addresses don\'t change between statements: a value that an '
+                             'interrupt or the hardware changes (e.g. a raster or I/O register) is '
+                             'read once instead of at each use')
+    parser.add_argument('--zp-temps', type=parse_zp_temps, default=0, metavar='TARGET|BYTES',
+                        help='Declare the first temps in the ZEROPAGE segment: the bytes LAMAlib leaves '
+                             'free there for a target (c64, c128, vic20), or a byte count. '
+                             'Further temps stay in RAM. The target sizes don\'t count modules that '
+                             'use the zero page (m_sprmultiplexer, m_displayPETSCII), exprass warns '
+                             'when the source includes one, give the free byte count with these')
+    parser.add_argument('--parser', choices=['fast', 'ply'], default='fast',
+                        help='Statement parser: fast (precedence climbing) or ply '
+                             '(LALR grammar, needs the ply package) (default: fast)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Don\'t use the persistent cache of compiled statements')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='Write phase times and optimizer statistics per file and statement '
+                             'as JSON to FILE, - for stderr')
     parser.add_argument('--version', action='version', 
                         version=f'%(prog)s {__version__}')
-    
-    args = parser.parse_args()
+    return parser
+
+def main():
+    args = build_arg_parser().parse_args()
     
     # Expand wildcards (needed for Windows where shell doesn't expand)
     expanded_inputs = []
     for pattern in args.input:
         # Check if pattern contains wildcards
         if '*' in pattern or '?' in pattern or '[' in pattern:
+            import glob
             matches = glob.glob(pattern)
             if matches:
                 expanded_inputs.extend(matches)
@@ -2220,7 +4778,7 @@ Version: %(version)s
     
     # Validate inputs
     for input_file in args.input:
-        if not Path(input_file).exists():
+        if input_file != '-' and not Path(input_file).exists():
             print(f"Error: Input file '{input_file}' not found", file=sys.stderr)
             sys.exit(1)
     
@@ -2233,47 +4791,44 @@ Version: %(version)s
         print("Error: Cannot use -q/--quiet and -v/--verbose together", file=sys.stderr)
         sys.exit(1)
     
+    if args.parser == 'ply' and not ply_available():
+        print("Error: --parser ply needs the ply package (pip install ply), or use --parser fast", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.jobs < 0:
+        print("Error: -j/--jobs must be 0 or more", file=sys.stderr)
+        sys.exit(1)
+    
+    if '-' in args.input and (args.in_place or args.compile_includes or args.watch):
+        print("Error: Cannot use -i/--in-place, -c/--compile-includes or -w/--watch when reading stdin", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.watch and (args.in_place or args.undo or args.redo):
+        print("Error: Cannot use -w/--watch with -i/--in-place, -u/--undo or -r/--redo", file=sys.stderr)
+        sys.exit(1)
+    
+    if args.watch_interval <= 0:
+        print("Error: --watch-interval must be greater than 0", file=sys.stderr)
+        sys.exit(1)
+    
     # Check if -o is used with multiple inputs
     if args.output and len(args.input) > 1:
         print("Error: Cannot use -o/--output with multiple input files", file=sys.stderr)
         sys.exit(1)
     
     # Process each input file
+    failed_files, include_graph = compile_inputs(args)
     total_files = len(args.input)
-    failed_files = []
     
-    for idx, input_file in enumerate(args.input):
-        # Show progress for multiple files (unless quiet)
-        if total_files > 1 and not args.quiet:
-            print(f"\n[{idx+1}/{total_files}] Processing {input_file}...", file=sys.stderr)
-        
-        # Determine output file
-        if args.in_place:
-            output_file = input_file
-        elif args.output:
-            output_file = args.output
-        elif args.undo or args.redo:
-            # For undo/redo, default to modifying the input file itself
-            output_file = input_file
-        else:
-            output_file = str(Path(input_file).with_suffix('.asm'))
-        
-        # Compile
-        try:
-            success = compile_file(input_file, output_file, args)
-            if not success:
-                failed_files.append(input_file)
-        except Exception as e:
-            print(f"Error processing {input_file}: {e}", file=sys.stderr)
-            if args.verbose:
-                import traceback
-                traceback.print_exc()
-            failed_files.append(input_file)
+    if args.stats:
+        write_stats(args.stats, file_stats)
     
     # Summary for multiple files
     if total_files > 1 and not args.quiet:
         print(f"\n{'='*60}", file=sys.stderr)
         print(f"Summary: Processed {total_files} file(s)", file=sys.stderr)
+        if unchanged_outputs:
+            print(f"Unchanged: {len(unchanged_outputs)} output file(s) not rewritten", file=sys.stderr)
         if failed_files:
             print(f"Failed: {len(failed_files)} file(s)", file=sys.stderr)
             for f in failed_files:
@@ -2282,6 +4837,10 @@ Version: %(version)s
             print(f"All files compiled successfully!", file=sys.stderr)
         print(f"{'='*60}", file=sys.stderr)
     
+    if args.watch:
+        watch_inputs(args, include_graph)
+        sys.exit(0)
+    
     # Exit with appropriate code
     sys.exit(1 if failed_files else 0)
 
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+exprass_bench - cold start benchmark for exprass
+
+ass.sh starts a new exprass process for every source file containing let
+statements, so the time to start up matters as much as the compiler itself.
+This benchmark compiles a one-statement file in a fresh process, the way
+the installed launcher runs it (exprass.py imported as a module with cached
+bytecode), and compares the median time with a bare Python start.
+
+Usage: exprass_bench.py [-n RUNS] [--target MS] [--script]
+
+Exits with 1 if the startup overhead exceeds the target.
+
+Author: Wil Elmenreich
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Startup overhead in milliseconds over a bare interpreter start
+DEFAULT_TARGET_MS = 30
+
+SAMPLE_SOURCE = """\
+; exprass startup benchmark
+    let score = score + 10
+    rts
+"""
+
+def median_ms(command, runs, cwd):
+    """Median wall time of running command in a new process, in milliseconds"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        times.append((time.perf_counter() - start) * 1000)
+        if result.returncode != 0:
+            sys.exit(f"Error: {' '.join(command)} failed:\n{result.stderr.decode()}")
+    return statistics.median(times)
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='exprass_bench',
+        description='Measure the cold start time of exprass')
+    parser.add_argument('-n', '--runs', type=int, default=20,
+                        help='Number of runs per measurement (default: 20)')
+    parser.add_argument('--target', type=float, default=DEFAULT_TARGET_MS,
+                        help=f'Allowed startup overhead in ms (default: {DEFAULT_TARGET_MS})')
+    parser.add_argument('--script', action='store_true',
+                        help='Run exprass.py as a script instead of through the module launcher')
+    args = parser.parse_args()
+
+    tool_dir = os.path.dirname(os.path.abspath(__file__))
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        with open(os.path.join(work_dir, 'bench.s'), 'w') as f:
+            f.write(SAMPLE_SOURCE)
+
+        if args.script:
+            exprass = [sys.executable, os.path.join(tool_dir, 'exprass.py')]
+        else:
+            # Same as the installed launcher; the first run caches the bytecode
+            exprass = [sys.executable, '-c',
+                       f"import sys; sys.path.insert(0, {tool_dir!r}); import exprass; exprass.main()"]
+            subprocess.run(exprass + ['-q', 'bench.s'], cwd=work_dir)
+
+        baseline = median_ms([sys.executable, '-c', 'pass'], args.runs, work_dir)
+        total = median_ms(exprass + ['-q', 'bench.s'], args.runs, work_dir)
+
+    overhead = total - baseline
+    verdict = "ok" if overhead <= args.target else "TOO SLOW"
+    print(f"Python start:     {baseline:6.1f} ms")
+    print(f"exprass run:      {total:6.1f} ms")
+    print(f"Startup overhead: {overhead:6.1f} ms (target {args.target:g} ms) {verdict}")
+    sys.exit(0 if overhead <= args.target else 1)
+
+if __name__ == '__main__':
+    main()
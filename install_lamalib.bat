@@ -95,14 +95,29 @@ if errorlevel 1 set /a errors+=1
 if errorlevel 1 set /a errors+=1
 @copy *friendly-asm.cfg "%CC65PATH%\cfg"
 if errorlevel 1 set /a errors+=1
-@copy ass.bat "%CC65PATH%\bin"
-if errorlevel 1 set /a errors+=1
 @copy asdent.py "%CC65PATH%\bin"
 if errorlevel 1 set /a errors+=1
 @echo @python "%%~dp0asdent.py" %%* > "%CC65PATH%\bin\asdent.bat"
-@copy exprass.py "%CC65PATH%\bin"
+:: exprass.py and ass.py go to a library directory, only their launchers go to bin
+set "PYTHONDIR=%CC65PATH%\lib\lamalib"
+if not exist "%PYTHONDIR%" mkdir "%PYTHONDIR%"
+@copy exprass.py "%PYTHONDIR%"
+if errorlevel 1 set /a errors+=1
+:: run exprass.py as an imported module, so that its compiled bytecode is cached
+@python -m compileall -q "%PYTHONDIR%\exprass.py"
+@echo @python -c "import sys; sys.path.insert(0, r'%%~dp0..\lib\lamalib'); import exprass; exprass.main()" %%* > "%CC65PATH%\bin\exprass.bat"
+:: ass runs exprass in-process, so it is installed next to exprass.py the same way
+@copy ass.py "%PYTHONDIR%"
+if errorlevel 1 set /a errors+=1
+@python -m compileall -q "%PYTHONDIR%\ass.py"
+@echo @python -c "import sys; sys.path.insert(0, r'%%~dp0..\lib\lamalib'); import ass; ass.main()" %%* > "%CC65PATH%\bin\ass.bat"
+:: The ass command is now the Python driver, the batch file stays available as ass-bat
+@copy ass.bat "%CC65PATH%\bin\ass-bat.bat"
 if errorlevel 1 set /a errors+=1
-@echo @python "%%~dp0exprass.py" %%* > "%CC65PATH%\bin\exprass.bat"
+echo %yellow%Note: ass now runs the Python driver ass.py, the former batch file is installed as ass-bat%nocolor%
+:: Modules of earlier versions that were installed into bin
+del /q "%CC65PATH%\bin\exprass.py" "%CC65PATH%\bin\ass.py" "%CC65PATH%\bin\__pycache__\exprass.*.pyc" "%CC65PATH%\bin\__pycache__\ass.*.pyc" 2>nul
+rmdir "%CC65PATH%\bin\__pycache__" 2>nul
 
 if %errors% NEQ 0 (
   echo %red%
@@ -76,12 +76,34 @@ install -m 644 LAMAlib20.lib "$installdir/lib/"
 errors=$((errors + $?))
 install -m 644 *friendly-asm.cfg "$installdir/cfg/"
 errors=$((errors + $?))
-install -m 755 ass.sh "$installbindir/ass"
-errors=$((errors + $?))
 install -m 755 asdent.py "$installbindir/asdent"
 errors=$((errors + $?))
-install -m 755 exprass.py "$installbindir/exprass"
+# exprass is run once per source file, so it is installed as a module with
+# a small launcher: imported modules keep their compiled bytecode, scripts don't.
+# The modules go to a library directory, only the launchers go to bin
+pythondir="$installdir/lib/lamalib"
+mkdir -p "$pythondir"
+errors=$((errors + $?))
+install -m 644 exprass.py "$pythondir/exprass.py"
+errors=$((errors + $?))
+python3 -m compileall -q "$pythondir/exprass.py"
+errors=$((errors + $?))
+printf '#!/usr/bin/env python3\nimport sys\nsys.path.insert(0, "%s")\nfrom exprass import main\nmain()\n' "$pythondir" > "$installbindir/exprass" && chmod 755 "$installbindir/exprass"
+errors=$((errors + $?))
+# ass runs exprass in-process, so it goes next to exprass.py the same way
+install -m 644 ass.py "$pythondir/ass.py"
+errors=$((errors + $?))
+python3 -m compileall -q "$pythondir/ass.py"
+errors=$((errors + $?))
+printf '#!/usr/bin/env python3\nimport sys\nsys.path.insert(0, "%s")\nfrom ass import main\nmain()\n' "$pythondir" > "$installbindir/ass" && chmod 755 "$installbindir/ass"
+errors=$((errors + $?))
+# The ass command is now the Python driver, the shell script stays available as ass-sh
+install -m 755 ass.sh "$installbindir/ass-sh"
 errors=$((errors + $?))
+echo -e ${yellow}"Note: 'ass' now runs the Python driver ass.py, the former shell script is installed as 'ass-sh'"${nocolor}
+# Modules of earlier versions that were installed into bin
+rm -f "$installbindir/exprass.py" "$installbindir/ass.py" "$installbindir"/__pycache__/exprass.*.pyc "$installbindir"/__pycache__/ass.*.pyc
+rmdir "$installbindir/__pycache__" 2>/dev/null
 
 if [ $errors -ne 0 ]; then
   echo -e $red
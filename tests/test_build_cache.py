@@ -0,0 +1,137 @@
+"""
+Build cache of ass: unchanged builds are restored without running cl65,
+changed sources or includes run cl65 again. A stub cl65 on PATH records
+its calls, so the tests don't need cc65.
+
+Run with: python -m pytest tests
+"""
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import ass
+
+pytestmark = pytest.mark.skipif(os.name == 'nt', reason="the stub cl65 is a shell script")
+
+# Writes the assembled files as program and labels, and counts its runs
+STUB_CL65 = """\
+#!{python}
+import sys
+args = sys.argv[1:]
+output = args[args.index('-o') + 1]
+labels = args[args.index('-Ln') + 1]
+sources = [arg for arg in args if arg.endswith(('.s', '.asm'))]
+with open(output, 'w') as f:
+    f.write("".join(open(source).read() for source in sources))
+with open(labels, 'w') as f:
+    f.write("al 000801 .start\\n")
+with open({calls!r}, 'a') as f:
+    f.write(" ".join(sources) + "\\n")
+"""
+
+
+@pytest.fixture
+def project(tmp_path):
+    """Directory with a source including another file, a stub cl65 and its own build cache"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    calls = tmp_path / 'calls.txt'
+    stub = bin_dir / 'cl65'
+    stub.write_text(STUB_CL65.format(python=sys.executable, calls=str(calls)))
+    stub.chmod(0o755)
+    work = tmp_path / 'work'
+    work.mkdir()
+    (work / 'main.s').write_text('  .include "data.inc"\n  lda #1\n  rts\n')
+    (work / 'data.inc').write_text('  .byte 1, 2, 3\n')
+    env = dict(os.environ, PATH=f"{bin_dir}{os.pathsep}{os.environ['PATH']}",
+               ASS_CACHE_DIR=str(tmp_path / 'cache'))
+    return work, env, calls
+
+
+def run_ass(project, *args):
+    work, env, calls = project
+    result = subprocess.run([sys.executable, str(ROOT / 'ass.py'), *args], cwd=work, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    assert result.returncode == 0, result.stdout
+    return result.stdout
+
+
+def cl65_runs(project):
+    calls = project[2]
+    return len(calls.read_text().splitlines()) if calls.exists() else 0
+
+
+def cache_stats(project):
+    return json.loads((Path(project[1]['ASS_CACHE_DIR']) / 'stats.json').read_text())
+
+
+def test_second_build_is_a_hit(project):
+    work = project[0]
+    run_ass(project, 'main.s')
+    program = (work / 'main.prg').read_text()
+    (work / 'main.prg').unlink()
+    (work / 'main_labels.txt').unlink()
+    output = run_ass(project, '-v', 'main.s')
+    assert cl65_runs(project) == 1
+    assert "(cached)" in output
+    assert (work / 'main.prg').read_text() == program
+    assert (work / 'main_labels.txt').exists()
+    assert cache_stats(project) == {'hits': 1, 'misses': 1}
+
+
+def test_linked_build_is_a_hit(project):
+    work = project[0]
+    (work / 'util.s').write_text('  nop\n')
+    run_ass(project, '-l', 'main.s', 'util.s')
+    run_ass(project, '-l', 'main.s', 'util.s')
+    assert cl65_runs(project) == 1
+    assert cache_stats(project) == {'hits': 1, 'misses': 1}
+
+
+@pytest.mark.parametrize('changed', ['main.s', 'data.inc'])
+def test_changed_input_is_a_miss(project, changed):
+    work = project[0]
+    run_ass(project, 'main.s')
+    with open(work / changed, 'a') as f:
+        f.write('  nop\n')
+    run_ass(project, 'main.s')
+    assert cl65_runs(project) == 2
+    assert cache_stats(project) == {'hits': 0, 'misses': 2}
+
+
+def test_changed_define_is_a_miss(project):
+    run_ass(project, 'main.s')
+    run_ass(project, '-d', 'DEBUG', 'main.s')
+    assert cl65_runs(project) == 2
+
+
+def test_no_cache(project):
+    run_ass(project, 'main.s')
+    run_ass(project, '--no-cache', 'main.s')
+    assert cl65_runs(project) == 2
+    assert cache_stats(project) == {'hits': 0, 'misses': 1}
+
+
+def test_eviction_keeps_recently_used_entries(tmp_path):
+    cache = ass.BuildCache(tmp_path / 'cache', limit=3000)
+    program = tmp_path / 'program.prg'
+    labels = tmp_path / 'labels.txt'
+    for number in range(4):
+        program.write_bytes(bytes(1000))
+        labels.write_text("")
+        cache.store(f"key{number}", str(program), str(labels))
+        os.utime(cache.path / f"key{number}", (1000 + number, 1000 + number))
+    # Using the oldest entry makes the second oldest the least recently used one
+    assert cache.restore('key0', str(program), str(labels))
+    cache.close()
+    # Eviction goes down to 90% of the limit
+    assert sorted(entry.name for _, _, entry in cache.entries()) == ['key0', 'key3']
+    assert sum(size for _, size, _ in cache.entries()) <= cache.limit * 0.9
+    assert ass.read_cache_stats(cache.path) == {'hits': 1, 'misses': 0}
@@ -0,0 +1,173 @@
+"""
+Compiled blocks in the output of exprass: every let statement keeps its
+markers, so that undo (-u) and redo (-r) find it again, also in the output
+of earlier versions without block fingerprints.
+
+Run with: python -m pytest tests
+"""
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import exprass
+
+# Source and output of the exprass version before block fingerprints, whose
+# end markers have no "; #xxxxxxxx" and whose multiplication used mul16
+OLD_SOURCE = """\
+  .include "LAMAlib.inc"
+  let score = score + 10
+  let va = (vb + 3) * 40
+  lda #1
+"""
+OLD_OUTPUT = """\
+; Generated by exprass - Expression to Assembly Translator
+; Source: old.s
+
+  .include "LAMAlib.inc"
+; +++ let score = score + 10
+ldax score
+addax #10
+stax score
+; --- let score = score + 10
+
+; +++ let va = (vb + 3) * 40
+ldax vb
+addax #3
+mul16 #40
+stax va
+; --- let va = (vb + 3) * 40
+
+  lda #1
+
+; +++ Variable declarations from exprass, all 16-bit
+.ifndef score
+score:\t.res 2
+.endif
+.ifndef va
+va:\t.res 2
+.endif
+.ifndef vb
+vb:\t.res 2
+.endif
+
+; Temporary variables
+; --- End of variable declarations from exprass
+"""
+
+# Statements that compile to an empty block
+NO_OP_STATEMENTS = ["let A = A", "let AX = AX", "let A = AX"]
+
+
+@pytest.fixture
+def env(tmp_path):
+    return dict(os.environ, EXPRASS_CACHE_DIR=str(tmp_path / 'cache'))
+
+
+def run_exprass(env, *args):
+    return subprocess.run([sys.executable, str(ROOT / 'exprass.py'), *args], env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+
+@pytest.mark.parametrize('use_cache', [False, True], ids=['uncached', 'cached'])
+def test_no_op_statements_round_trip(tmp_path, env, use_cache):
+    source = tmp_path / 'noop.s'
+    source.write_text("".join(f"  {statement}\n" for statement in NO_OP_STATEMENTS) + "  lda #1\n")
+    options = [] if use_cache else ['--no-cache']
+    for _ in range(2 if use_cache else 1):
+        # The second run takes the statements from the cache
+        result = run_exprass(env, str(source), '-o', str(tmp_path / 'noop.asm'), *options)
+        assert result.returncode == 0, result.stdout
+    output = (tmp_path / 'noop.asm').read_text()
+    for statement in NO_OP_STATEMENTS:
+        assert f"; +++ {statement}\n" in output
+        assert f"; --- {statement}" in output
+
+    result = run_exprass(env, '-u', str(tmp_path / 'noop.asm'), '-o', str(tmp_path / 'undone.s'))
+    assert result.returncode == 0, result.stdout
+    lines = [line.strip() for line in (tmp_path / 'undone.s').read_text().splitlines()]
+    assert [line for line in lines if line.startswith('let ')] == NO_OP_STATEMENTS
+    assert 'lda #1' in lines
+
+
+def expression_blocks(text):
+    return [(block['let_statement'], block['code'], block['fingerprint'])
+            for block in exprass.find_compiled_blocks(text.splitlines(keepends=True))
+            if block['type'] == 'expression']
+
+
+def test_undo_of_output_without_fingerprints(tmp_path, env):
+    (tmp_path / 'old.asm').write_text(OLD_OUTPUT)
+    result = run_exprass(env, '-u', str(tmp_path / 'old.asm'), '-o', str(tmp_path / 'old.s'))
+    assert result.returncode == 0, result.stdout
+    assert "Removed 2 compiled block(s)" in result.stdout
+    undone = (tmp_path / 'old.s').read_text()
+    assert "; +++" not in undone and "; ---" not in undone
+    lines = [line.strip() for line in undone.splitlines()]
+    assert [line for line in lines if line.startswith('let ')] == [
+        line.strip() for line in OLD_SOURCE.splitlines() if line.strip().startswith('let ')]
+
+
+def test_redo_of_output_without_fingerprints(tmp_path, env):
+    (tmp_path / 'old.asm').write_text(OLD_OUTPUT)
+    result = run_exprass(env, '-r', str(tmp_path / 'old.asm'), '-o', str(tmp_path / 'redone.asm'))
+    assert result.returncode == 0, result.stdout
+    assert "Recompiled 2 block(s), 0 unchanged" in result.stdout
+    redone = (tmp_path / 'redone.asm').read_text()
+
+    # The blocks are the same as those of a new compilation, with fingerprints
+    (tmp_path / 'old.s').write_text(OLD_SOURCE)
+    result = run_exprass(env, str(tmp_path / 'old.s'), '-o', str(tmp_path / 'new.asm'))
+    assert result.returncode == 0, result.stdout
+    blocks = expression_blocks(redone)
+    assert blocks == expression_blocks((tmp_path / 'new.asm').read_text())
+    assert all(fingerprint for _, _, fingerprint in blocks)
+
+    # Temps of the new code are declared
+    declared = set(re.findall(r'^(\w+):\t\.res 2$', redone, re.MULTILINE))
+    used = {temp for _, code, _ in blocks for line in code for temp in re.findall(r'\btmp\d+\b', line)}
+    assert used and used <= declared
+
+    # Now the fingerprints match and the blocks are kept
+    result = run_exprass(env, '-r', str(tmp_path / 'redone.asm'), '-o', str(tmp_path / 'again.asm'))
+    assert result.returncode == 0, result.stdout
+    assert "Recompiled 0 block(s), 2 unchanged" in result.stdout
+    assert (tmp_path / 'again.asm').read_text() == redone
+
+
+ZP_SOURCE = """\
+  .include "LAMAlib.inc"
+MAXSPRITES = 8
+  .include "modules/m_sprmultiplexer.s"
+  let va = (vb + vc) * (vd + ve)
+  .include "data.inc"
+"""
+
+
+def test_zero_page_temps_after_includes(tmp_path, env):
+    (tmp_path / 'zp.s').write_text(ZP_SOURCE)
+    result = run_exprass(env, str(tmp_path / 'zp.s'), '-o', str(tmp_path / 'zp.asm'), '--zp-temps', 'c64')
+    assert result.returncode == 0, result.stdout
+    assert "m_sprmultiplexer.s takes 8 zero page bytes" in result.stdout
+    lines = (tmp_path / 'zp.asm').read_text().splitlines()
+    start = lines.index("; +++ Zero page temporary variables from exprass")
+    assert lines[start - 1] == '  .include "modules/m_sprmultiplexer.s"'
+    assert start < lines.index("; +++ let va = (vb + vc) * (vd + ve)")
+
+    result = run_exprass(env, '-u', str(tmp_path / 'zp.asm'), '-o', str(tmp_path / 'undone.s'))
+    assert result.returncode == 0, result.stdout
+    undone = (tmp_path / 'undone.s').read_text()
+    assert "Zero page" not in undone and ".zeropage" not in undone
+
+
+def test_no_module_warning_without_zero_page_use(tmp_path, env):
+    (tmp_path / 'zp.s').write_text(ZP_SOURCE.replace("MAXSPRITES = 8", "SPRMUX_NO_ZP = 1"))
+    result = run_exprass(env, str(tmp_path / 'zp.s'), '-o', str(tmp_path / 'zp.asm'), '--zp-temps', 'c64')
+    assert result.returncode == 0, result.stdout
+    assert "zero page bytes" not in result.stdout
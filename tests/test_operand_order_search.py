@@ -0,0 +1,58 @@
+"""
+Operand order search: the fast search (--opt-search fast) must find code
+that scores the same as or better than trying all orderings, for each
+optimization objective.
+
+Run with: python -m pytest tests
+"""
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import exprass
+
+LEAVES = ['va', 'vb', 'b', 'c', '1', '2', '3', '40', '256', '1000', '$d020']
+OPERATORS = ['+', '+', '-', '*', '&', '|', '^']
+
+
+def random_expression(rng, depth):
+    """A random expression with commutative operations and small constants"""
+    if depth == 0 or rng.random() < 0.25:
+        return rng.choice(LEAVES)
+    if rng.random() < 0.1:
+        return f"peek({random_expression(rng, depth - 1)})"
+    return f"({random_expression(rng, depth - 1)} {rng.choice(OPERATORS)} {random_expression(rng, depth - 1)})"
+
+
+def score(result, cost_model):
+    """Score of the compiled code of a result"""
+    code = [exprass.Instr.parse(line.strip()) for line in result.code
+            if line.strip() and not line.strip().startswith(';')]
+    return cost_model.score_code(code)
+
+
+@pytest.mark.parametrize('optimize', ['balanced', 'speed', 'size'])
+def test_fast_search_matches_exhaustive(optimize):
+    rng = random.Random(5)
+    cost_model = exprass.get_cost_model(optimize)
+    fast = exprass.Compiler(search='fast', optimize=optimize, use_cache=False, comments=False)
+    exhaustive = exprass.Compiler(search='exhaustive', optimize=optimize, use_cache=False, comments=False)
+    for _ in range(300):
+        line = f"  let r = {random_expression(rng, rng.randint(1, 4))}\n"
+        fast_result = fast.compile_string(line)
+        exhaustive_result = exhaustive.compile_string(line)
+        assert fast_result.errors == exhaustive_result.errors
+        assert score(fast_result, cost_model) <= score(exhaustive_result, cost_model), line
+
+
+@pytest.mark.parametrize('statement', ["let r = 1+b", "let r = ((1+256)-1000)&c"])
+def test_fast_search_uses_peephole_rewrites(statement):
+    cost_model = exprass.get_cost_model('balanced')
+    results = [exprass.Compiler(search=search, use_cache=False, comments=False).compile_string(statement)
+               for search in ('fast', 'exhaustive')]
+    assert score(results[0], cost_model) == score(results[1], cost_model)
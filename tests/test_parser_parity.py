@@ -0,0 +1,105 @@
+"""
+Parity of the exprass parsers: --parser fast must compile every source to
+the same output and messages as the PLY grammar, byte for byte.
+
+Run with: python -m pytest tests
+"""
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import exprass
+
+pytest.importorskip('ply')
+
+# Sources of the repo: the assembler tests and the examples
+CORPUS = sorted(ROOT.glob('tests/*.s')) + sorted(ROOT.glob('examples/**/*.s'))
+
+OPERATORS = ['+', '-', '*', '/', '%', '&', '|', '^']
+COMPOUND_OPERATORS = ['+=', '-=', '*=', '/=', '%=', '&=', '|=', '^=', '<<=', '>>=']
+LEAVES = ['va', 'vb', 'score', 'x', 'y', 'a', 'ax', '3', '40', '$d020', '0x1f', '%101', '255', '256']
+
+
+def random_expression(rng, depth):
+    """A random expression of the let syntax"""
+    if depth == 0 or rng.random() < 0.2:
+        return rng.choice(LEAVES)
+    choice = rng.random()
+    if choice < 0.08:
+        return f"peek({random_expression(rng, depth - 1)})"
+    if choice < 0.14:
+        return f"peekw({random_expression(rng, depth - 1)})"
+    if choice < 0.2:
+        return f"abs({random_expression(rng, depth - 1)})"
+    if choice < 0.28:
+        return f"({random_expression(rng, depth - 1)}) {rng.choice(['<<', '>>'])} {rng.randint(0, 16)}"
+    left = random_expression(rng, depth - 1)
+    right = random_expression(rng, depth - 1)
+    if rng.random() < 0.5:
+        return f"({left} {rng.choice(OPERATORS)} {right})"
+    return f"{left} {rng.choice(OPERATORS)} {right}"
+
+
+def random_statement(rng):
+    """A random let statement, some of them malformed"""
+    target = rng.choice(['va', 'vb', 'score', 'ax', 'a', 'x', 'y'])
+    expression = random_expression(rng, rng.randint(1, 4))
+    kind = rng.random()
+    if kind < 0.15:
+        return f"let {target} {rng.choice(COMPOUND_OPERATORS)} {expression}"
+    if kind < 0.25:
+        # Drop or duplicate a character to get syntax errors
+        position = rng.randrange(len(expression))
+        if rng.random() < 0.5:
+            expression = expression[:position] + expression[position + 1:]
+        else:
+            expression = expression[:position] + expression[position] + expression[position:]
+    return f"let {target} = {expression}"
+
+
+def generated_source(seed, count=60):
+    """Lines of a source with random let statements and some raw assembly code"""
+    rng = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        if rng.random() < 0.15:
+            lines.append(rng.choice(["  lda #1", "  sta va", "loop:", "; comment", "  jsr $ffd2"]))
+        else:
+            lines.append("  " + random_statement(rng))
+    return [line + "\n" for line in lines]
+
+
+def compile_with(parser, lines, **options):
+    compiler = exprass.Compiler(parser=parser, use_cache=False, **options)
+    return compiler.compile_lines(lines, 'parity.s')
+
+
+def assert_same_output(lines, **options):
+    fast = compile_with('fast', lines, **options)
+    ply = compile_with('ply', lines, **options)
+    assert "".join(fast.code) == "".join(ply.code)
+    assert fast.warnings == ply.warnings
+    assert fast.errors == ply.errors
+
+
+@pytest.mark.parametrize('path', CORPUS, ids=lambda path: str(path.relative_to(ROOT)))
+def test_corpus(path):
+    with open(path, errors='replace') as f:
+        assert_same_output(f.readlines())
+
+
+@pytest.mark.parametrize('seed', range(8))
+def test_generated_statements(seed):
+    assert_same_output(generated_source(seed))
+
+
+@pytest.mark.parametrize('options', [{'temp_reuse': False}, {'search': 'fast'}, {'optimize': 'speed'},
+                                     {'cse': True}],
+                         ids=['no-temp-reuse', 'opt-search-fast', 'optimize-speed', 'cse'])
+def test_generated_statements_with_options(options):
+    assert_same_output(generated_source(100), **options)